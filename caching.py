@@ -7,12 +7,14 @@
 #     keep list of which macros have been used, i.e.
 #        the dependency list of macros.
 #     keep list of all C-stuff which has been added.
-#     check last change time of file and all other files we open from here
-#        and also store this list.
+#     store size, mtime and content digest of the file and all other files
+#        we open from here.
 #     save all.
-#  when opening a new file, macro-dependencies, check the last change time
-#     of all files and if everything matches, use the cache.
+#  when opening a new file, check macro-dependencies and the files
+#     (size+mtime first, the content digest only if those differ)
+#     and if everything matches, use the cache.
 
+from __future__ import print_function
 import sys
 import os, os.path
 if sys.version_info.major == 2:
@@ -22,6 +24,11 @@ else:
     from . import cparser
     from .cparser_utils import *
 import types
+import hashlib
+import marshal
+import tempfile
+import time
+import json
 
 # Note: It might make sense to make this somehow configureable.
 # However, for now, I'd like to keep things as simple as possible.
@@ -29,17 +36,38 @@ import types
 # possibility. However, it makes sense to keep this more permanent
 # because when compiling a lot, it can be very time-critical if
 # we just remove all the data.
-# If wasted space becomes an issue, it is easy to write a script
-# which would remove all old/obsolete entries from the cache.
+# The size is bounded by CACHING_MAX_BYTES, see CacheIndex.
 # It makes sense also to keep this global for the whole system
 # because the caching system should be able to handle this
 # and it should thus only improve the performance.
 # It is saved though in the user directory because most probably
 # we wouldn't have write permission otherwise.
-CACHING_DIR = os.path.expanduser("~/.cparser_caching/")
+CACHING_DIR = os.environ.get("CPARSER_CACHING_DIR") or os.path.expanduser("~/.cparser_caching/")
+
+def parse_max_bytes(s):
+    """
+    :param str s: number of bytes, or "0" or "none" for no limit
+    :return: byte budget, None means unbounded
+    :rtype: int|None
+    """
+    if s.strip().lower() == "none": return None
+    return int(s) or None
+
+# Byte budget of the cache dir. The least recently used entries are removed
+# when it is exceeded. None means unbounded, set CPARSER_CACHING_MAX_BYTES=0 (or none) for that.
+CACHING_MAX_BYTES = parse_max_bytes(os.environ.get("CPARSER_CACHING_MAX_BYTES") or str(512 * 1024 * 1024))
+
+# Increase this when the layout of the cache entries changes.
+# Entries with another version (or from another parser code, see code_digest())
+# are ignored and get overwritten.
+CacheVersion = 3
+
+
+class CacheMiss(Exception):
+    """An entry cannot be used in the current state, e.g. it refers to an unknown type."""
+
 
 def sha1(obj):
-    import hashlib
     h = hashlib.sha1()
     if sys.version_info.major == 2:
         def h_update(s): h.update(s)
@@ -59,9 +87,10 @@ def sha1(obj):
             h_update(sha1(v))
             h_update(",")
         h_update("}")
-    elif isinstance(obj, (list,tuple)):
+    elif isinstance(obj, (list,tuple,set,frozenset)):
+        if isinstance(obj, (set,frozenset)): obj = sorted(obj)
         h_update("[")
-        for v in sorted(obj):
+        for v in obj:
             h_update(sha1(v))
             h_update(",")
         h_update("]")
@@ -69,6 +98,137 @@ def sha1(obj):
         h_update(str(obj))
     return h.hexdigest()
 
+def file_stat(filename):
+    """
+    :param str filename:
+    :return: (size, mtime). If both are unchanged, we assume that the content is the same.
+    :rtype: (int,float)
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+# filename -> (size, mtime, digest). Avoids rehashing within one process.
+_file_digests = {}
+
+def file_digest(filename, expected_stat=None, expected_digest=None):
+    """
+    :param str filename:
+    :param (int,float)|None expected_stat: if the file has this stat, return expected_digest without hashing
+    :param str|None expected_digest:
+    :return: sha1 of the file content
+    :rtype: str
+    """
+    fstat = file_stat(filename)
+    if expected_stat is not None and tuple(expected_stat) == fstat:
+        return expected_digest
+    memo = _file_digests.get(filename)
+    if memo is not None and memo[:2] == fstat:
+        return memo[2]
+    stats.hashed_files += 1
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data: break
+            h.update(data)
+    digest = h.hexdigest()
+    _file_digests[filename] = fstat + (digest,)
+    return digest
+
+class Stats:
+    """
+    Counters about the cache effectiveness in this process. See `stats`.
+    Set the env var CPARSER_CACHING_STATS=1 to print them at exit.
+    """
+    def __init__(self):
+        self.reset()
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.errors = 0
+        self.hashed_files = 0
+        self.func_hits = 0  # see FuncCache
+        self.func_misses = 0
+        self.func_saves = 0
+        self.miss_reasons = {}  # reason -> count
+        self.invalidations = {}  # reason -> count
+    def miss(self, reason):
+        self.misses += 1
+        self.miss_reasons[reason] = self.miss_reasons.get(reason, 0) + 1
+    def invalidate(self, reason):
+        self.invalidations[reason] = self.invalidations.get(reason, 0) + 1
+    @classmethod
+    def FromDict(cls, d):
+        obj = cls()
+        for k, v in d.items():
+            if isinstance(v, dict): v = dict(v)
+            setattr(obj, k, v)
+        return obj
+    @staticmethod
+    def accumulate(total, cur, prev):
+        """
+        :param dict[str] total: as_dict() format
+        :param dict[str] cur: as_dict() format
+        :param dict[str] prev: as_dict() format, an earlier state of cur
+        :return: total + (cur - prev)
+        :rtype: dict[str]
+        """
+        res = dict(total)
+        for k, v in cur.items():
+            if isinstance(v, dict):
+                d = dict(res.get(k, {}))
+                for reason, count in v.items():
+                    d[reason] = d.get(reason, 0) + count - prev.get(k, {}).get(reason, 0)
+                res[k] = d
+            else:
+                res[k] = res.get(k, 0) + v - prev.get(k, 0)
+        return res
+    def as_dict(self):
+        return dict(
+            hits=self.hits, misses=self.misses, saves=self.saves, errors=self.errors,
+            hashed_files=self.hashed_files,
+            func_hits=self.func_hits, func_misses=self.func_misses, func_saves=self.func_saves,
+            miss_reasons=dict(self.miss_reasons), invalidations=dict(self.invalidations))
+    def __str__(self):
+        lookups = self.hits + self.misses
+        s = "cparser cache: %i hits, %i misses (%.1f%% hit rate), %i saves, %i errors, %i hashed files" % (
+            self.hits, self.misses, 100.0 * self.hits / max(lookups, 1), self.saves, self.errors, self.hashed_files)
+        if self.func_hits or self.func_misses:
+            s += "\n  translated functions: %i hits, %i misses, %i saves" % (
+                self.func_hits, self.func_misses, self.func_saves)
+        for title, d in (("miss reasons", self.miss_reasons), ("invalidations", self.invalidations)):
+            if d:
+                s += "\n  %s: %s" % (title, ", ".join(["%s: %i" % (k, v) for (k, v) in sorted(d.items())]))
+        return s
+
+stats = Stats()
+
+if os.environ.get("CPARSER_CACHING_STATS"):
+    import atexit
+    atexit.register(lambda: print(stats))
+
+_code_digest = None
+
+def code_digest():
+    """
+    :return: sha1 of the parser code. The parse results depend on it.
+    :rtype: str
+    """
+    global _code_digest
+    if _code_digest is None:
+        h = hashlib.sha1()
+        for mod in (cparser, sys.modules[__name__]):
+            fn = mod.__file__
+            if fn.endswith(".pyc"): fn = fn[:-1]
+            with open(fn, "rb") as f:
+                h.update(f.read())
+        _code_digest = h.hexdigest()
+    return _code_digest
+
+def _file_header():
+    return ("cparser-cache %i %s\n" % (CacheVersion, code_digest())).encode("utf-8")
+
 class MyDict(dict):
     def __setattr__(self, key, value):
         assert isinstance(key, (str,unicode))
@@ -79,6 +239,418 @@ class MyDict(dict):
     def __repr__(self): return "MyDict(" + dict.__repr__(self) + ")"
     def __str__(self): return "MyDict(" + dict.__str__(self) + ")"
 
+# State dicts whose objects are referenced by name from other cache entries.
+ObjRefDicts = ("typedefs", "structs", "unions", "enums", "funcs", "vars", "enumconsts")
+
+# Format of the serialized entries, see _Serializer.
+FormatVersion = 1
+
+# Tags of composite values. All other values are not tuples and stored as-is
+# (None, bool, int, float, str, bytes).
+_TagRef, _TagList, _TagTuple, _TagDict, _TagSet, _TagState, _TagStateObj = range(7)
+
+# Kinds of attribute values, part of the shape of a record. See _Serializer._kind().
+(_KindRaw, _KindRef, _KindEmptyList, _KindRefList, _KindScalarList, _KindEmptyDict, _KindState,
+ _KindTagged) = range(8)
+
+_ScalarTypes = (type(None), bool, int, long, float, str, unicode, bytes)
+
+# Attributes which are only caches, e.g. see getCType(). They are recreated on demand.
+TransientAttribs = (
+    (cparser._CBaseWithOptBody, ("_ctype", "_ctype_cached")),
+    (cparser.Macro, ("_tokens", "_template", "_tokenTemplate")),
+)
+
+_classes_by_name = None
+
+def _get_classes_by_name():
+    """
+    :return: all classes which can be serialized, by name
+    :rtype: dict[str,type]
+    """
+    global _classes_by_name
+    if _classes_by_name is None:
+        classes = {"list": list, "dict": dict, "set": set}
+        for mod in (cparser, sys.modules[__name__]):
+            for name, obj in vars(mod).items():
+                if isinstance(obj, type) and obj.__module__ == mod.__name__:
+                    classes[name] = obj
+        _classes_by_name = classes
+    return _classes_by_name
+
+class _Serializer:
+    """
+    Serializes the parser object model (CStruct, CFunc, CTypedef, CVarDecl, Macro, tokens, ...)
+    into a table form, which is written via marshal:
+
+      (FormatVersion, class names, shapes, groups, root value)
+
+    Every instance, and every list/dict/set which is referenced more than once, is a record,
+    and it is referenced by its index. That keeps shared objects and cycles (e.g. via parent).
+    The shape of an instance record is (class index, attribute names, value kinds),
+    and (class index, None, None) for a container record.
+    Records of the same shape are stored together in a group, as one flat tuple of values,
+    so that _Deserializer can fill them with a specialized function.
+    Equal strings are stored only once because marshal references repeated objects.
+    The State, and objects which were added to the State outside of the serialized entry,
+    are stored by name and resolved on load.
+    """
+    def __init__(self, stateStruct=None, ownObjs=()):
+        self.objRefs = {}
+        if stateStruct is not None:
+            state = _unwrapped_state(stateStruct)
+            for dictName in ObjRefDicts:
+                for name, obj in getattr(state, dictName).items():
+                    self.objRefs[id(obj)] = (dictName, name)
+        for obj in ownObjs:
+            self.objRefs.pop(id(obj), None)
+        self.classNames = []
+        self.classIdxs = {}  # class -> idx
+        self.transient = {}  # class -> attrib names
+        self.shapes = []
+        self.shapeIdxs = {}  # shape -> idx
+        self.strings = {}
+        self.sharedContainers = set()  # ids
+        self.recordIdxs = {}  # id(obj) -> idx
+
+    def dumps(self, obj):
+        """
+        :param obj:
+        :rtype: bytes
+        """
+        self._findSharedContainers(obj)
+        groups = self._collectRecords(obj)
+        idx = 0
+        for shapeIdx, objs in groups:
+            for o in objs:
+                self.recordIdxs[id(o)] = idx
+                idx += 1
+        encGroups = []
+        for shapeIdx, objs in groups:
+            _, keys, kinds = self.shapes[shapeIdx]
+            if keys is None:
+                values = tuple([self._encItems(o) for o in objs])
+            else:
+                values = []
+                for o in objs:
+                    d = o.__dict__
+                    values.extend([self._encKind(d[k], kind) for (k, kind) in zip(keys, kinds)])
+                values = tuple(values)
+            encGroups.append((shapeIdx, len(objs), values))
+        root = self._enc(obj)
+        return marshal.dumps((FormatVersion, self.classNames, self.shapes, encGroups, root))
+
+    def _isScalar(self, o):
+        return type(o) in _ScalarTypes
+
+    def _isRecord(self, o):
+        if isinstance(o, (list, dict, set)):
+            return id(o) in self.sharedContainers
+        if type(o) in _ScalarTypes or type(o) is tuple:
+            return False
+        return id(o) not in self.objRefs and not isinstance(o, (cparser.State, StateWrapper))
+
+    def _findSharedContainers(self, obj):
+        seen = set()
+        stack = [obj]
+        while stack:
+            o = stack.pop()
+            if type(o) in _ScalarTypes:
+                continue
+            if id(o) in seen:
+                if isinstance(o, (list, dict, set)):
+                    self.sharedContainers.add(id(o))
+                continue
+            seen.add(id(o))
+            if isinstance(o, dict):
+                stack.extend(o.keys())
+                stack.extend(o.values())
+            elif isinstance(o, (list, tuple, set)):
+                stack.extend(o)
+            elif self._isRecord(o):
+                stack.extend(getattr(o, "__dict__", {}).values())
+        self.sharedContainers.discard(id(obj))
+
+    def _collectRecords(self, obj):
+        """
+        :return: list of (shape idx, list of objects)
+        """
+        groups = {}  # shape idx -> objs
+        seen = set([id(obj)])  # the root is encoded inline
+        stack = [obj]
+        while stack:
+            o = stack.pop()
+            if type(o) in _ScalarTypes:
+                continue
+            if o is not obj:
+                if id(o) in seen:
+                    continue
+                seen.add(id(o))
+            if isinstance(o, dict):
+                stack.extend(o.keys())
+                stack.extend(o.values())
+            elif isinstance(o, (list, tuple, set)):
+                stack.extend(o)
+            else:
+                if not self._isRecord(o):
+                    continue
+                cls = o.__class__
+                clsIdx = self._classIdx(cls)
+                if not hasattr(o, "__dict__") or hasattr(cls, "__slots__"):
+                    raise TypeError("cannot serialize %r" % o)
+                d = o.__dict__
+                transient = self.transient[cls]
+                keys = tuple([self.strings.setdefault(k, k) for k in d if k not in transient])
+                kinds = tuple([self._kind(d[k]) for k in keys])
+                groups.setdefault(self._shapeIdx((clsIdx, keys, kinds)), []).append(o)
+                stack.extend([d[k] for k in keys])
+                continue
+            if o is not obj and id(o) in self.sharedContainers:
+                groups.setdefault(self._shapeIdx((self._classIdx(o.__class__), None, None)), []).append(o)
+        return sorted(groups.items())
+
+    def _kind(self, v):
+        t = type(v)
+        if t in _ScalarTypes:
+            return _KindRaw
+        if t is tuple and all([type(x) in _ScalarTypes for x in v]):
+            return _KindRaw
+        if self._isRecord(v):
+            return _KindRef
+        if t is list:
+            if not v:
+                return _KindEmptyList
+            if all([type(x) in _ScalarTypes for x in v]):
+                return _KindScalarList
+            if all([type(x) not in _ScalarTypes and self._isRecord(x) for x in v]):
+                return _KindRefList
+        if t is dict and not v:
+            return _KindEmptyDict
+        if isinstance(v, (cparser.State, StateWrapper)):
+            return _KindState
+        return _KindTagged
+
+    def _encKind(self, v, kind):
+        """
+        :param v: attribute value
+        :param int kind: _kind(v)
+        """
+        if kind == _KindRaw:
+            if type(v) is tuple:
+                return tuple([self._enc(x) for x in v])
+            return self._enc(v)
+        if kind == _KindRef:
+            return self.recordIdxs[id(v)]
+        if kind == _KindRefList:
+            return tuple([self.recordIdxs[id(x)] for x in v])
+        if kind == _KindScalarList:
+            return tuple([self._enc(x) for x in v])
+        if kind == _KindTagged:
+            return self._enc(v)
+        return None  # the kind itself determines the value
+
+    def _classIdx(self, cls):
+        idx = self.classIdxs.get(cls)
+        if idx is None:
+            if _get_classes_by_name().get(cls.__name__) is not cls:
+                raise TypeError("cannot serialize objects of class %r" % cls)
+            idx = len(self.classNames)
+            self.classNames.append(cls.__name__)
+            self.classIdxs[cls] = idx
+            transient = set()
+            for base, attribs in TransientAttribs:
+                if issubclass(cls, base):
+                    transient.update(attribs)
+            self.transient[cls] = transient
+        return idx
+
+    def _shapeIdx(self, shape):
+        idx = self.shapeIdxs.get(shape)
+        if idx is None:
+            idx = len(self.shapes)
+            self.shapes.append(shape)
+            self.shapeIdxs[shape] = idx
+        return idx
+
+    def _encItems(self, obj):
+        if isinstance(obj, dict):
+            items = []
+            for k, v in obj.items():
+                items.append(self._enc(k))
+                items.append(self._enc(v))
+            return tuple(items)
+        return tuple([self._enc(v) for v in obj])
+
+    def _enc(self, v):
+        """
+        :return: v itself if it is a scalar, otherwise a tagged tuple
+        """
+        t = type(v)
+        if t is str:
+            return self.strings.setdefault(v, v)
+        if t in _ScalarTypes:
+            return v
+        idx = self.recordIdxs.get(id(v))
+        if idx is not None:
+            return _TagRef, idx
+        if t is tuple:
+            return _TagTuple, tuple([self._enc(x) for x in v])
+        if isinstance(v, (list, dict, set)):
+            tag = _TagDict if isinstance(v, dict) else (_TagSet if isinstance(v, set) else _TagList)
+            if t in (list, dict, set):
+                return tag, self._encItems(v)
+            return tag, self._encItems(v), self._classIdx(t)
+        if isinstance(v, (cparser.State, StateWrapper)):
+            return (_TagState,)
+        ref = self.objRefs.get(id(v))
+        if ref is not None:
+            return (_TagStateObj,) + ref
+        raise TypeError("cannot serialize %r" % v)
+
+# (keys, kinds) -> function, see _make_filler()
+_fillers = {}
+
+def _make_filler(keys, kinds):
+    """
+    :param tuple[str] keys: attribute names
+    :param tuple[int] kinds: see _Serializer._kind()
+    :return: function (objs, start, count, values, dec, state) which sets the attributes of objs[start:start+count]
+    """
+    func = _fillers.get((keys, kinds))
+    if func is not None:
+        return func
+    exprs = []
+    for k, (key, kind) in enumerate(zip(keys, kinds)):
+        v = "values[i + %i]" % k
+        exprs.append("%r: %s" % (key, {
+            _KindRaw: v,
+            _KindRef: "objs[%s]" % v,
+            _KindEmptyList: "[]",
+            _KindRefList: "[objs[j] for j in %s]" % v,
+            _KindScalarList: "list(%s)" % v,
+            _KindEmptyDict: "{}",
+            _KindState: "state",
+            _KindTagged: "dec(%s)" % v}[kind]))
+    src = "\n".join([
+        "def fill(objs, start, count, values, dec, state):",
+        "    i = 0",
+        "    for o in objs[start:start + count]:",
+        "        o.__dict__ = {%s}" % ", ".join(exprs),
+        "        i += %i" % len(keys),
+        ""])
+    d = {}
+    exec(compile(src, "<cparser.caching filler>", "exec"), d)
+    func = _fillers[(keys, kinds)] = d["fill"]
+    return func
+
+class _Deserializer:
+    """
+    Loads what _Serializer dumped. Raises CacheMiss if the data cannot be used
+    in the current state, e.g. it refers to an unknown type, or has another format version.
+    """
+    def __init__(self, stateStruct=None):
+        self.stateStruct = stateStruct
+        self.objs = None
+        self.classes = None
+
+    def loads(self, data):
+        """
+        :param bytes data:
+        :return: the object
+        """
+        import gc
+        # Creating many container objects triggers the GC a lot, and there is no garbage.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._loads(data)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _loads(self, data):
+        try:
+            version, classNames, shapes, groups, root = marshal.loads(data)
+        except (ValueError, EOFError, TypeError):
+            raise CacheMiss("corrupt data")
+        if version != FormatVersion:
+            raise CacheMiss("format version %r" % (version,))
+        classesByName = _get_classes_by_name()
+        for name in classNames:
+            if name not in classesByName:
+                raise CacheMiss("unknown class %r" % name)
+        self.classes = classes = [classesByName[name] for name in classNames]
+        if self.stateStruct is None and any([kinds and _KindState in kinds for (_, _, kinds) in shapes]):
+            raise CacheMiss("no state")
+        self.objs = objs = []
+        for shapeIdx, count, _ in groups:
+            clsIdx, keys, _ = shapes[shapeIdx]
+            cls = classes[clsIdx]
+            if keys is None:
+                objs.extend([cls() for _ in range(count)])
+            else:
+                new = cls.__new__
+                objs.extend([new(cls) for _ in range(count)])
+        dec = self._dec
+        start = 0
+        for shapeIdx, count, values in groups:
+            _, keys, kinds = shapes[shapeIdx]
+            if keys is None:
+                for obj, items in zip(objs[start:start + count], values):
+                    items = [v if type(v) is not tuple else dec(v) for v in items]
+                    if isinstance(obj, dict):
+                        obj.update(zip(items[::2], items[1::2]))
+                    elif isinstance(obj, set):
+                        obj.update(items)
+                    else:
+                        obj.extend(items)
+            else:
+                _make_filler(keys, kinds)(objs, start, count, values, dec, self.stateStruct)
+            start += count
+        if type(root) is tuple:
+            return dec(root)
+        return root
+
+    def _dec(self, v):
+        if type(v) is not tuple:
+            return v
+        tag = v[0]
+        if tag == _TagRef:
+            return self.objs[v[1]]
+        if tag == _TagStateObj:
+            return self._stateObj(v[1], v[2])
+        if tag == _TagState:
+            if self.stateStruct is None:
+                raise CacheMiss("no state")
+            return self.stateStruct
+        dec = self._dec
+        items = [x if type(x) is not tuple else dec(x) for x in v[1]]
+        if tag == _TagList:
+            if len(v) > 2: return self.classes[v[2]](items)
+            return items
+        if tag == _TagTuple:
+            return tuple(items)
+        if tag == _TagDict:
+            d = zip(items[::2], items[1::2])
+            if len(v) > 2: return self.classes[v[2]](d)
+            return dict(d)
+        if tag == _TagSet:
+            return set(items)
+        raise CacheMiss("corrupt data, tag %r" % (tag,))
+
+    def _stateObj(self, dictName, name):
+        if self.stateStruct is None:
+            raise CacheMiss("no state to resolve %s %r" % (dictName, name))
+        d = getattr(_unwrapped_state(self.stateStruct), dictName)
+        if name not in d:
+            raise CacheMiss("%s %r is unknown" % (dictName, name))
+        return d[name]
+
+def _unwrapped_state(stateStruct):
+    if isinstance(stateStruct, StateWrapper):
+        return stateStruct._stateStruct
+    return stateStruct
+
 class DbObj:
     @classmethod
     def GetFilePath(cls, key):
@@ -86,61 +658,306 @@ class DbObj:
         prefix = CACHING_DIR + cls.Namespace
         return prefix + "/" + h[:2] + "/" + h[2:]
     @classmethod
-    def Load(cls, key, create=False):
+    def Load(cls, key, create=False, stateStruct=None):
+        """
+        :param key:
+        :param bool create: create a new empty object if there is no (valid) entry
+        :param stateStruct: used to resolve references, see _Serializer
+        :return: the object, or None if there is no (valid) entry and not create
+        """
         fn = cls.GetFilePath(key)
-        try: f = open(fn, "b")
-        except:
-            if create:
-                obj = cls()
-                obj.__dict__["_key"] = key
-                return obj
-            else:
-                return None
-        import pickle
-        obj = pickle.load(f)
-        f.close()
+        obj = None
+        try:
+            f = open(fn, "rb")
+        except (IOError, OSError):
+            pass
+        else:
+            with f:
+                if f.readline() == _file_header():
+                    obj = _Deserializer(stateStruct=stateStruct).loads(f.read())
+                    get_index().touch(fn, os.fstat(f.fileno()).st_size)
+                else:
+                    stats.invalidate("version")
+        if obj is None and create:
+            obj = cls()
+        if obj is not None:
+            obj.__dict__["_key"] = key
         return obj
     @classmethod
     def Delete(cls, key):
         fn = cls.GetFilePath(key)
-        os.remove(fn)
+        get_index().remove(fn)
+        try: os.remove(fn)
+        except (IOError, OSError): pass # does not exist anymore
     def delete(self): self.Delete(self._key)
-    def save(self):
+    def save(self, stateStruct=None, ownObjs=()):
+        """
+        Writes to a temporary file and renames it, so that concurrent readers
+        never see partial entries.
+        """
         fn = self.GetFilePath(self._key)
-        try: os.makedirs(os.path.dirname(fn))
-        except: pass # ignore file-exists or other errors
-        f = open(fn, "wb")
-        import pickle
-        pickle.dump(self, f)
-        f.close()
+        def write(f):
+            f.write(_file_header())
+            f.write(_Serializer(stateStruct=stateStruct, ownObjs=ownObjs).dumps(self))
+        size = _atomic_write(fn, write)
+        get_index().touch(fn, size)
+
+_os_replace = getattr(os, "replace", os.rename)
+
+# Prefix of the temporary files of _atomic_write. Leftovers are removed by CacheIndex.prune().
+TmpFilePrefix = ".tmp-"
+
+def _atomic_write(fn, write):
+    """
+    Writes to a temporary file and renames it, so that concurrent readers
+    never see partial files.
+
+    :param str fn:
+    :param (file)->None write: gets the file object, opened in binary mode
+    :return: written size
+    :rtype: int
+    """
+    dirname = os.path.dirname(fn)
+    try: os.makedirs(dirname)
+    except (IOError, OSError): pass # ignore file-exists or other errors
+    fd, tmp_fn = tempfile.mkstemp(dir=dirname, prefix=TmpFilePrefix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            size = f.tell()
+        _os_replace(tmp_fn, fn)
+    except BaseException:
+        try: os.remove(tmp_fn)
+        except (IOError, OSError): pass
+        raise
+    return size
+
+class CacheIndex:
+    """
+    Keeps size and last access time of all entries of a cache dir, for the LRU eviction,
+    and the accumulated Stats of all processes which used the cache.
+    Accesses are collected in memory and merged into the index file by flush().
+    Concurrent flushes might lose some updates. That only affects the eviction order,
+    and prune() recovers entries which are missing in the index.
+    """
+    Filename = "index.json"
+    # Subdirs of the cache dir which contain our entries.
+    Namespaces = ("file-cache-refs", "file-cache", "func-cache")
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.touched = {}  # relative filename -> (size, atime)
+        self.removed = set()  # relative filenames
+        self.flushed_stats = Stats().as_dict()
+    def _rel(self, fn):
+        return os.path.relpath(fn, self.cache_dir)
+    def touch(self, fn, size):
+        rel = self._rel(fn)
+        self.touched[rel] = (size, time.time())
+        self.removed.discard(rel)
+    def remove(self, fn):
+        rel = self._rel(fn)
+        self.touched.pop(rel, None)
+        self.removed.add(rel)
+    def load(self):
+        """
+        :return: index data, dict with "entries" (relative filename -> [size, atime]) and "stats"
+        :rtype: dict[str]
+        """
+        try:
+            with open(self.cache_dir + self.Filename, "r") as f:
+                data = json.load(f)
+            assert isinstance(data.get("entries"), dict) and isinstance(data.get("stats"), dict)
+        except (IOError, OSError, ValueError, AssertionError):
+            data = {"entries": {}, "stats": {}}
+        return data
+    def _save(self, data):
+        _atomic_write(self.cache_dir + self.Filename, lambda f: f.write(json.dumps(data).encode("utf-8")))
+    def flush(self, max_bytes=None):
+        """
+        Merges the accesses and the stats of this process into the index file.
+
+        :param int|None max_bytes: if given and exceeded, calls prune()
+        """
+        cur_stats = stats.as_dict()
+        if not self.touched and not self.removed and cur_stats == self.flushed_stats:
+            return
+        data = self.load()
+        entries = data["entries"]
+        for rel in self.removed:
+            entries.pop(rel, None)
+        entries.update(self.touched)
+        data["stats"] = Stats.accumulate(data["stats"], cur_stats, self.flushed_stats)
+        self._save(data)
+        self.touched.clear()
+        self.removed.clear()
+        self.flushed_stats = cur_stats
+        if max_bytes is not None and sum([e[0] for e in entries.values()]) > max_bytes:
+            self.prune(max_bytes)
+    def _scan(self):
+        """
+        :return: all entries on disk: relative filename -> (size, mtime)
+        :rtype: dict[str,(int,float)]
+        """
+        files = {}
+        for namespace in self.Namespaces:
+            for dirpath, _, filenames in os.walk(self.cache_dir + namespace):
+                for fn in filenames:
+                    fn = os.path.join(dirpath, fn)
+                    try: st = os.stat(fn)
+                    except OSError: continue # removed in the meantime
+                    if os.path.basename(fn).startswith(TmpFilePrefix):
+                        # Leftover from a killed process. Leave the recent ones, they might be in use.
+                        if st.st_mtime < time.time() - 60 * 60:
+                            try: os.remove(fn)
+                            except OSError: pass
+                        continue
+                    files[self._rel(fn)] = (st.st_size, st.st_mtime)
+        return files
+    def prune(self, max_bytes):
+        """
+        Syncs the index with the entries on disk and removes the least recently used entries
+        until the total size is at most max_bytes.
+
+        :param int|None max_bytes: None means unbounded, i.e. only the sync
+        :return: number of removed entries and their total size
+        :rtype: (int,int)
+        """
+        data = self.load()
+        entries = {}
+        for rel, (size, mtime) in self._scan().items():
+            if rel in self.touched:
+                entries[rel] = self.touched[rel]
+            elif rel in data["entries"]:
+                entries[rel] = (size, data["entries"][rel][1])
+            else:
+                entries[rel] = (size, mtime)
+        total = sum([e[0] for e in entries.values()])
+        num_removed, removed_size = 0, 0
+        if max_bytes is not None:
+            for rel, (size, atime) in sorted(entries.items(), key=lambda item: item[1][1]):
+                if total <= max_bytes: break
+                try: os.remove(self.cache_dir + rel)
+                except OSError: pass # removed in the meantime
+                del entries[rel]
+                total -= size
+                num_removed += 1
+                removed_size += size
+        # A reference to a removed entry is handled like an outdated entry, see check_cache().
+        data["entries"] = entries
+        self._save(data)
+        self.touched.clear()
+        self.removed.clear()
+        return num_removed, removed_size
+    def clear(self):
+        """
+        Removes all entries, the index and the stats.
+        """
+        import shutil
+        for namespace in self.Namespaces:
+            shutil.rmtree(self.cache_dir + namespace, ignore_errors=True)
+        try: os.remove(self.cache_dir + self.Filename)
+        except OSError: pass
+        self.touched.clear()
+        self.removed.clear()
 
-def getLastChangeUnixTime(filename):
-    import os.path
-    return os.path.getmtime(filename)
+_index = None
+
+def get_index():
+    """
+    :return: the index of the current CACHING_DIR
+    :rtype: CacheIndex
+    """
+    global _index
+    if _index is None or _index.cache_dir != CACHING_DIR:
+        _index = CacheIndex(CACHING_DIR)
+    return _index
+
+def flush():
+    """
+    Writes the recorded accesses and stats to the index and enforces CACHING_MAX_BYTES.
+    This is called at the end of cparser.parse(..., cache=True).
+    """
+    try:
+        get_index().flush(max_bytes=CACHING_MAX_BYTES)
+    except Exception as e:
+        print("(Safe to ignore) Error while writing C parser cache index : %s" % str(e))
+
+_flush_at_exit = False
+
+def flush_at_exit():
+    """
+    Calls flush() at exit. For users of the cache which have no natural end, like the interpreter.
+    """
+    global _flush_at_exit
+    if not _flush_at_exit:
+        import atexit
+        atexit.register(flush)
+        _flush_at_exit = True
+
+def _macro_sig(macro):
+    """
+    :param cparser.Macro|None macro:
+    :return: what identifies the macro definition. Macro objects themselves only compare by identity.
+    :rtype: (str,tuple[str]|None,str)|None
+    """
+    if macro is None: return None
+    return macro.__class__.__name__, tuple(macro.args) if macro.args is not None else None, macro.rightside
 
 class FileCacheRef(MyDict):
     @classmethod
-    def FromCacheData(cls, cache_data):
+    def FromCacheData(cls, cache_data, full_filename):
         ref = cls()
-        ref.filedepslist = map(lambda fn: (fn,getLastChangeUnixTime(fn)), cache_data.filenames)
+        # (filename, (size, mtime), digest). Includes the file itself.
+        ref.filedepslist = [
+            (fn, file_stat(fn), file_digest(fn)) for fn in sorted(cache_data.filenames | set([full_filename]))]
+        # See _macro_sig(). None means that the macro was not defined.
         ref.macros = {}
         for m in cache_data.macroAccessSet:
-            ref.macros[m] = cache_data.oldMacros[m]
+            ref.macros[m] = _macro_sig(cache_data.oldMacros.get(m))
+        # Key of the FileCache entry.
+        ref.key = sha1([full_filename, ref.filedepslist, ref.macros])
         return ref
     def match(self, stateStruct):
-        for macro in self.macros:
-            if stateStruct.macros[macro] != self.macros[macro]:
+        macros = stateStruct.macros
+        for name, sig in self.macros.items():
+            if name in macros:
+                if _macro_sig(macros[name]) != sig:
+                    return False
+            elif sig is not None:
                 return False
         return True
     def checkFileDepListUpToDate(self):
-        for fn,unixtime in self.filedepslist:
-            if getLastChangeUnixTime(fn) > unixtime:
-                return False
-        return True
+        """
+        Dependencies whose size/mtime changed but whose content is the same (e.g. touched files)
+        get their new stat in filedepslist, so that they are not hashed again next time.
+        The caller must save the entry if filedepslist changed.
+
+        :return: None if all dependencies are unchanged, otherwise the invalidation reason
+        :rtype: str|None
+        """
+        for i, (fn, fstat, digest) in enumerate(self.filedepslist):
+            try:
+                cur_stat = file_stat(fn)
+                if tuple(fstat) == cur_stat: continue
+                if file_digest(fn) != digest:
+                    return "dep-changed"
+            except (IOError, OSError):
+                return "dep-removed"
+            self.filedepslist[i] = (fn, cur_stat, digest)
+        return None
 
 class FileCacheRefs(DbObj, list):
     Namespace = "file-cache-refs"
 
+class FuncCache(DbObj, MyDict):
+    """
+    Translated function of the interpreter, see Interpreter.getFunc().
+    Keys: "code" (marshaled code object), "source" (its Python source),
+    "valueNames" (names of the wrapped values it refers to, see WrappedValues).
+    """
+    Namespace = "func-cache"
+
 class FileCache(DbObj, MyDict):
     Namespace = "file-cache"
     @classmethod
@@ -148,7 +965,18 @@ class FileCache(DbObj, MyDict):
         obj = cls()
         obj.__dict__["_key"] = key
         obj.additions = cache_data.additions
+        obj.filenames = sorted(cache_data.filenames)
         return obj
+    def ownObjs(self):
+        """
+        :return: objects added by this entry. They are saved by value.
+        """
+        for k, l in self.additions.items():
+            if k in StateWrapper.WrappedLists:
+                for v in l: yield v
+            else:
+                for _, v in l:
+                    if v is not None: yield v
     def apply(self, stateStruct):
         for k,l in self.additions.items():
             a = getattr(stateStruct, k)
@@ -157,143 +985,213 @@ class FileCache(DbObj, MyDict):
             elif isinstance(a, (dict,StateDictWrapper)):
                 for dk,dv in l:
                     if dv is None:
-                        a.pop(dk)
+                        if dk in a: a.pop(dk)
                     else:
                         a[dk] = dv
             else:
                 assert False, "unknown attribute " + k + ": " + str(a)
+        if isinstance(stateStruct, StateWrapper) and stateStruct._cache_stack:
+            # The including file depends on our files.
+            stateStruct._filenames.update(self.filenames)
 
 def check_cache(stateStruct, full_filename):
+    """
+    :param StateWrapper stateStruct:
+    :param str full_filename:
+    :return: the cache entry for the file in the current state, or None
+    :rtype: FileCache|None
+    """
     filecaches = FileCacheRefs.Load(full_filename)
-    if filecaches is None: return None
+    if filecaches is None:
+        stats.miss("no-entry")
+        return None
 
-    for filecacheref in filecaches:
+    miss_reason = "macros"
+    for filecacheref in list(filecaches):
         if not filecacheref.match(stateStruct):
             continue
-        if not filecacheref.checkFileDepListUpToDate():
-            FileCache.Delete(filecacheref)
-            filecaches.remove(filecacheref)
-            filecaches.save()
-            return None
-        filecache = FileCache.Load(filecacheref)
-        assert filecache is not None, sha1(filecacheref) + " not found in " + FileCache.Namespace
-        return filecache
+        old_filedepslist = list(filecacheref.filedepslist)
+        invalid_reason = filecacheref.checkFileDepListUpToDate()
+        if invalid_reason is None:
+            if filecacheref.filedepslist != old_filedepslist:
+                filecaches.save()
+            try:
+                filecache = FileCache.Load(filecacheref.key, stateStruct=stateStruct)
+            except CacheMiss:
+                miss_reason = "unresolved-ref"
+                continue
+            if filecache is not None:
+                stats.hits += 1
+                return filecache
+            invalid_reason = "entry-lost"
+        stats.invalidate(invalid_reason)
+        miss_reason = invalid_reason
+        FileCache.Delete(filecacheref.key)
+        filecaches.remove(filecacheref)
+        filecaches.save()
 
+    stats.miss(miss_reason)
     return None
 
-def save_cache(cache_data, full_filename):
+def save_cache(stateStruct, cache_data, full_filename):
     filecaches = FileCacheRefs.Load(full_filename, create=True)
-    filecacheref = FileCacheRef.FromCacheData(cache_data)
+    filecacheref = FileCacheRef.FromCacheData(cache_data, full_filename)
+    filecache = FileCache.FromCacheData(cache_data, key=filecacheref.key)
+    filecache.save(stateStruct=stateStruct, ownObjs=list(filecache.ownObjs()))
     filecaches.append(filecacheref)
     filecaches.save()
-    filecache = FileCache.FromCacheData(cache_data, key=filecacheref)
-    filecache.save()
+    stats.saves += 1
 
-# Note: This does more than State.preprocess. In case it hits a cache,
+# Note: This does more than State.preprocess_chunks. In case it hits a cache,
 # it applies all effects up to cpre3 and ignores the preprocessing.
 # Note also: This is a generator. In the cache hit case, it yields nothing.
 # Otherwise, it doesn't do any further processing and it just yields the rest.
+# Only included files are cached, not the main file, and only if they are
+# included at the base level (not e.g. inside of a struct body).
 def State__cached_preprocess(stateStruct, reader, full_filename, filename):
-    if not full_filename:
+    preprocess_chunks = generic_class_method(cparser.State.preprocess_chunks)
+    if not full_filename or not stateStruct._preprocessIncludeLevel:
         # shortcut. we cannot use caching if we don't have the full filename.
-        for c in generic_class_method(cparser.State.preprocess)(stateStruct, reader, full_filename, filename):
+        for c in preprocess_chunks(stateStruct, reader, full_filename, filename):
             yield c
         return
 
-    if stateStruct._cpre3_atBaseLevel:
+    atBaseLevel = stateStruct._cpre3_atBaseLevel
+    if atBaseLevel:
         try:
             cached_entry = check_cache(stateStruct, full_filename)
-            if cached_entry is not None:
-                cached_entry.apply(stateStruct)
-                return
         except Exception as e:
+            cached_entry = None
+            stats.errors += 1
+            stats.miss("error")
             print("(Safe to ignore) Error while reading C parser cache for %s : %s" % (filename, str(e)))
             # Try to delete old references if possible. Otherwise we might always hit this.
             try: FileCacheRefs.Delete(full_filename)
-            except: pass
+            except Exception: pass
+        if cached_entry is not None:
+            cached_entry.apply(stateStruct)
+            return
 
     assert isinstance(stateStruct, StateWrapper)
     stateStruct.cache_pushLevel()
     stateStruct._filenames.add(full_filename)
-    for c in generic_class_method(cparser.State.preprocess)(stateStruct, reader, full_filename, filename):
+    for c in preprocess_chunks(stateStruct, reader, full_filename, filename):
         yield c
     cache_data = stateStruct.cache_popLevel()
 
-    save_cache(cache_data, full_filename)
+    if atBaseLevel and stateStruct._cpre3_atBaseLevel:
+        try:
+            save_cache(stateStruct, cache_data, full_filename)
+        except Exception as e:
+            stats.errors += 1
+            print("(Safe to ignore) Error while writing C parser cache for %s : %s" % (filename, str(e)))
 
 class StateDictWrapper:
-    def __init__(self, d, addList, addSet=None, accessSet=None):
-        self._addList = addList
-        self._addSet = addSet
-        self._accessSet = accessSet
-        self._dict = d
+    """
+    Wraps a State dict. While a cache level is active (see StateWrapper.cache_pushLevel),
+    all changes are recorded, and for the macros also the accesses.
+    """
+    def __init__(self, stateWrapper, attrib):
+        self._stateWrapper = stateWrapper
+        self._attrib = attrib
+    @property
+    def _dict(self):
+        return getattr(self._stateWrapper._stateStruct, self._attrib)
+    def _level(self):
+        stack = self._stateWrapper._cache_stack
+        if stack: return stack[-1]
+        return None
+    def _recordAccess(self, k):
+        if self._attrib != "macros": return
+        level = self._level()
+        if level is not None and k not in level.macroAddSet:
+            # we only care about it if we didn't add it ourself
+            level.macroAccessSet.add(k)
     def __getattr__(self, k):
         return getattr(self._dict, k)
     def __setitem__(self, k, v):
         assert v is not None
         self._dict[k] = v
-        self._addList.append((k,v))
-        if self._addSet is not None:
-            self._addSet.add(k)
+        level = self._level()
+        if level is not None:
+            level.additions[self._attrib].append((k,v))
+            if self._attrib == "macros":
+                level.macroAddSet.add(k)
     def __getitem__(self, k):
-        if self._accessSet is not None:
-            assert self._addSet is not None
-            if not k in self._addSet: # we only care about it if we didn't add it ourself
-                self._accessSet.add(k)
+        self._recordAccess(k)
         return self._dict[k]
+    def get(self, k, default=None):
+        self._recordAccess(k)
+        return self._dict.get(k, default)
     def __contains__(self, k): return self.has_key(k)
     def has_key(self, k):
-        haskey = self._dict.__contains__(k)
-        if haskey and self._accessSet is not None:
-            assert self._addSet is not None
-            if not k in self._addSet: # we only care about it if we didn't add it ourself
-                self._accessSet.add(k)
-        return haskey
-    def pop(self, k):
-        self._dict.pop(k)
-        self._addList.append((k,None))
-        if self._addSet is not None:
-            self._addSet.discard(k)
+        self._recordAccess(k)
+        return k in self._dict
+    def pop(self, k, *default):
+        self._recordAccess(k)
+        v = self._dict.pop(k, *default)
+        level = self._level()
+        if level is not None:
+            level.additions[self._attrib].append((k,None))
+            if self._attrib == "macros":
+                level.macroAddSet.discard(k)
+        return v
+    def __iter__(self): return iter(self._dict)
+    def __len__(self): return len(self._dict)
     def __repr__(self): return "StateDictWrapper(" + repr(self._dict) + ")"
     def __str__(self): return "StateDictWrapper(" + str(self._dict) + ")"
 
 class StateListWrapper:
-    def __init__(self, l, addList):
-        self._addList = addList
-        self._list = l
+    """
+    Wraps a State list. While a cache level is active, all additions are recorded.
+    """
+    def __init__(self, stateWrapper, attrib):
+        self._stateWrapper = stateWrapper
+        self._attrib = attrib
+    @property
+    def _list(self):
+        return getattr(self._stateWrapper._stateStruct, self._attrib)
+    def _addList(self):
+        stack = self._stateWrapper._cache_stack
+        if stack: return stack[-1].additions[self._attrib]
+        return None
     def __getattr__(self, k):
         return getattr(self._list, k)
     def __iadd__(self, l):
-        self._list.extend(l)
-        self._addList.extend(l)
+        self.extend(l)
         return self
     def append(self, v):
         self._list.append(v)
-        self._addList.append(v)
+        addList = self._addList()
+        if addList is not None: addList.append(v)
     def extend(self, l):
+        l = list(l)
         self._list.extend(l)
-        self._addList.extend(l)
+        addList = self._addList()
+        if addList is not None: addList.extend(l)
+    def __iter__(self): return iter(self._list)
+    def __len__(self): return len(self._list)
+    def __getitem__(self, i): return self._list[i]
     def __repr__(self): return "StateListWrapper(" + repr(self._list) + ")"
     def __str__(self): return "StateListWrapper(" + str(self._list) + ")"
 
 class StateWrapper:
     WrappedDicts = ("macros","typedefs","structs","unions","enums","funcs","vars","enumconsts")
-    WrappedLists = ("contentlist",)
-    LocalAttribs = ("_stateStruct", "_cache_stack", "_additions", "_macroAccessSet", "_macroAddSet", "_filenames", "_cpre3_atBaseLevel")
+    WrappedLists = ("contentlist", "_errors")
+    LocalAttribs = ("_stateStruct", "_cache_stack", "_wrappers", "_additions", "_macroAccessSet", "_macroAddSet", "_filenames", "_cpre3_atBaseLevel")
     def __init__(self, stateStruct):
         self._stateStruct = stateStruct
         self._cache_stack = []
+        self._cpre3_atBaseLevel = True
+        self._wrappers = {}
+        for k in self.WrappedDicts:
+            self._wrappers[k] = StateDictWrapper(self, k)
+        for k in self.WrappedLists:
+            self._wrappers[k] = StateListWrapper(self, k)
     def __getattr__(self, k):
-        if k in self.LocalAttribs: raise AttributeError # normally we shouldn't get here but just in case
-        if len(self._cache_stack) > 0:
-            if k in self.WrappedDicts:
-                kwattr = {'d': getattr(self._stateStruct, k), 'addList': self._additions[k]}
-                if k == "macros":
-                    kwattr["accessSet"] = self._macroAccessSet
-                    kwattr["addSet"] = self._macroAddSet
-                return StateDictWrapper(**kwattr)
-            if k in self.WrappedLists:
-                return StateListWrapper(getattr(self._stateStruct, k), addList=self._additions[k])
+        if k in self.LocalAttribs: raise AttributeError(k) # normally we shouldn't get here but just in case
+        if k in self._wrappers:
+            return self._wrappers[k]
         attr = getattr(self._stateStruct, k)
         if isinstance(attr, types.MethodType):
             attr = rebound_instance_method(attr, self)
@@ -343,25 +1241,15 @@ class StateWrapper:
                     self._macroAccessSet.add(k)
             self._filenames.update(cache_data.filenames)
         return cache_data
-    preprocess = State__cached_preprocess
-    def __getstate__(self):
-        # many C structure objects refer to this as their parent.
-        # when we pickle those objects, it should be safe to ignore to safe this.
-        # we also don't really have any other option because we don't want to
-        # dump this whole object.
-        return None
+    preprocess_chunks = State__cached_preprocess
+    def cache_flush(self):
+        flush()
 
 def parse(filename, state = None):
-    if state is None:
-        state = cparser.State()
-        state.autoSetupSystemMacros()
-
-    wrappedState = StateWrapper(state)
-    preprocessed = wrappedState.preprocess_file(filename, local=True)
-    tokens = cparser.cpre2_parse(wrappedState, preprocessed)
-    cparser.cpre3_parse(wrappedState, tokens)
-
-    return state
+    """
+    Like cparser.parse(filename, state, cache=True).
+    """
+    return cparser.parse(filename, state, cache=True)
 
 def test():
     import better_exchook
@@ -371,5 +1259,32 @@ def test():
 
     return state
 
+def main(argv=None):
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        prog="python -m cparser.caching", description="Maintenance of the C parser cache.")
+    arg_parser.add_argument("command", choices=["stats", "prune", "clear"])
+    arg_parser.add_argument("--dir", default=CACHING_DIR, help="cache dir. default: %(default)s")
+    arg_parser.add_argument(
+        "--max-bytes", type=parse_max_bytes, default=CACHING_MAX_BYTES,
+        help="byte budget for prune, 0 or none means unbounded. default: %(default)s (env CPARSER_CACHING_MAX_BYTES)")
+    args = arg_parser.parse_args(argv)
+    cache_dir = os.path.join(args.dir, "")
+    index = CacheIndex(cache_dir)
+    if args.command == "stats":
+        data = index.load()
+        entries = data["entries"]
+        print("cache dir: %s" % cache_dir)
+        print("entries: %i, %i bytes, budget %s" % (
+            len(entries), sum([e[0] for e in entries.values()]),
+            "unbounded" if args.max_bytes is None else "%i bytes" % args.max_bytes))
+        print(Stats.FromDict(data["stats"]))
+    elif args.command == "prune":
+        num_removed, removed_size = index.prune(args.max_bytes)
+        print("removed %i entries, %i bytes" % (num_removed, removed_size))
+    elif args.command == "clear":
+        index.clear()
+        print("cleared %s" % cache_dir)
+
 if __name__ == '__main__':
-    print(test())
+    main()
@@ -12,6 +12,7 @@ import ctypes
 import _ctypes
 import os
 import re
+import itertools
 from inspect import isclass
 from .cparser_utils import unicode, long, unichr, py_safe_identifier
 
@@ -237,120 +238,165 @@ def escape_cchar(c):
     return c
 
 
-def parse_macro_def_rightside(stateStruct, argnames, input):
-    assert input is not None
-    if stateStruct is None:
-        class Dummy:
-            def error(self, s): pass
-        stateStruct = Dummy()
+# Ops of a compiled macro right side, see compile_macro_def_rightside().
+MacroTplLiteral = 0  # value: str
+MacroTplArg = 1  # value: arg name, substituted as-is
+MacroTplStringify = 2  # value: arg name, substituted as C str ("#x")
+MacroTplRStrip = 3  # value: None. strip trailing whitespace of the output so far ("##")
+MacroTplError = 4  # value: error msg, reported on every substitution
+# Additional ops of token templates, see Macro._getTokenTemplate().
+# There, MacroTplLiteral has a token as value, and the arg ops have the arg index.
+MacroTplArgUnexpanded = 5  # value: arg index. operand of "##", thus not macro-expanded
+MacroTplPaste = 6  # value: None. "##", paste the last token before with the first one after
 
-    def f(*args):
-        assert len(args) == len(argnames or ())
-        args = {k: v for (k, v) in zip(argnames or (), args)}
 
-        ret = ""
-        state = 0
-        lastidentifier = ""
-        for c in input:
-            if state == 0:
-                if c in SpaceChars: ret += c
-                elif c in LetterChars + "_":
-                    state = 1
-                    lastidentifier = c
-                elif c in NumberChars:
-                    state = 2
-                    ret += c
-                elif c == '"':
-                    state = 4
-                    ret += c
-                elif c == "#": state = 6
-                else: ret += c
-            elif state == 1: # identifier
-                if c in LetterChars + NumberChars + "_":
-                    lastidentifier += c
-                elif c == "#":
-                    if lastidentifier in args:
-                        ret += args[lastidentifier]
-                    else:
-                        ret += lastidentifier
-                    lastidentifier = ""
-                    state = 9
-                else:
-                    if lastidentifier in args:
-                        ret += args[lastidentifier]
-                    else:
-                        ret += lastidentifier
-                    lastidentifier = ""
-                    ret += c
-                    state = 0
-            elif state == 2: # number
-                ret += c
-                if c in NumberChars: pass
-                elif c == "x": state = 3
-                elif c in LetterChars + "_": pass # even if invalid, stay in this state
-                else: state = 0
-            elif state == 3: # hex number
-                ret += c
-                if c in NumberChars + LetterChars + "_": pass # also ignore invalids
-                else: state = 0
-            elif state == 4: # str
-                ret += c
-                if c == "\\": state = 5
-                elif c == '"': state = 0
-                else: pass
-            elif state == 5: # escape in str
+def compile_macro_def_rightside(argnames, input):
+    """
+    :param tuple[str]|list[str]|None argnames:
+    :param str input: macro right side
+    :return: template, i.e. list of (op, value), see MacroTplLiteral & co.
+      Substitute args via eval_macro_template().
+    :rtype: list[(int,str|None)]
+    """
+    assert input is not None
+    argnames = set(argnames or ())
+    tpl = []
+    lit = []
+
+    def emit(op, value):
+        if lit:
+            tpl.append((MacroTplLiteral, "".join(lit)))
+            del lit[:]
+        tpl.append((op, value))
+
+    def emit_identifier(name):
+        if name in argnames:
+            emit(MacroTplArg, name)
+        else:
+            lit.append(name)
+
+    state = 0
+    lastidentifier = ""
+    for c in input:
+        if state == 0:
+            if c in SpaceChars: lit.append(c)
+            elif c in LetterChars + "_":
+                state = 1
+                lastidentifier = c
+            elif c in NumberChars:
+                state = 2
+                lit.append(c)
+            elif c == '"':
                 state = 4
-                ret += simple_escape_char(c)
-            elif state == 6: # after "#"
-                if c in SpaceChars + LetterChars + "_":
-                    lastidentifier = c.strip()
-                    state = 7
-                elif c == "#":
-                    ret = ret.rstrip()
-                    state = 8
-                else:
-                    # unexpected, just recover
-                    stateStruct.error("unfold macro: unexpected char '" + c + "' after #")
-                    state = 0
-            elif state == 7: # after single "#"	with identifier
-                if c in LetterChars + NumberChars + "_":
-                    lastidentifier += c
-                else:
-                    if lastidentifier not in args:
-                        stateStruct.error("unfold macro: cannot stringify " + lastidentifier + ": not found")
-                    else:
-                        ret += '"' + escape_cstr(args[lastidentifier]) + '"'
-                    lastidentifier = ""
-                    state = 0
-                    ret += c
-            elif state == 8: # after "##"
-                if c in SpaceChars: pass
-                else:
-                    lastidentifier = c
-                    state = 1
-            elif state == 9: # after identifier + "#"
-                if c == "#": state = 10
-                else:
-                    stateStruct.error("unfold macro: unexpected char %r after in state %i" % (c, state))
-                    state = 0  # recover
-            elif state == 10: # after identifier + "##"
-                if c in LetterChars + "_":
-                    lastidentifier = c
-                    state = 1
+                lit.append(c)
+            elif c == "#": state = 6
+            else: lit.append(c)
+        elif state == 1: # identifier
+            if c in LetterChars + NumberChars + "_":
+                lastidentifier += c
+            elif c == "#":
+                emit_identifier(lastidentifier)
+                lastidentifier = ""
+                state = 9
+            else:
+                emit_identifier(lastidentifier)
+                lastidentifier = ""
+                lit.append(c)
+                state = 0
+        elif state == 2: # number
+            lit.append(c)
+            if c in NumberChars: pass
+            elif c == "x": state = 3
+            elif c in LetterChars + "_": pass # even if invalid, stay in this state
+            else: state = 0
+        elif state == 3: # hex number
+            lit.append(c)
+            if c in NumberChars + LetterChars + "_": pass # also ignore invalids
+            else: state = 0
+        elif state == 4: # str
+            lit.append(c)
+            if c == "\\": state = 5
+            elif c == '"': state = 0
+            else: pass
+        elif state == 5: # escape in str
+            state = 4
+            lit.append(simple_escape_char(c))
+        elif state == 6: # after "#"
+            if c in SpaceChars + LetterChars + "_":
+                lastidentifier = c.strip()
+                state = 7
+            elif c == "#":
+                emit(MacroTplRStrip, None)
+                state = 8
+            else:
+                # unexpected, just recover
+                emit(MacroTplError, "unfold macro: unexpected char '" + c + "' after #")
+                state = 0
+        elif state == 7: # after single "#"	with identifier
+            if c in LetterChars + NumberChars + "_":
+                lastidentifier += c
+            else:
+                if lastidentifier not in argnames:
+                    emit(MacroTplError, "unfold macro: cannot stringify " + lastidentifier + ": not found")
                 else:
-                    stateStruct.error("unfold macro: unexpected char %r after in state %i" % (c, state))
-                    state = 0  # recover
+                    emit(MacroTplStringify, lastidentifier)
+                lastidentifier = ""
+                state = 0
+                lit.append(c)
+        elif state == 8: # after "##"
+            if c in SpaceChars: pass
+            else:
+                lastidentifier = c
+                state = 1
+        elif state == 9: # after identifier + "#"
+            if c == "#": state = 10
             else:
-                stateStruct.error("unfold macro: internal error, char %r, in state %i" % (c, state))
+                emit(MacroTplError, "unfold macro: unexpected char %r after in state %i" % (c, state))
                 state = 0  # recover
-        # Final check.
-        if state == 1:
-            if lastidentifier in args:
-                ret += args[lastidentifier]
+        elif state == 10: # after identifier + "##"
+            if c in LetterChars + "_":
+                lastidentifier = c
+                state = 1
             else:
-                ret += lastidentifier
+                emit(MacroTplError, "unfold macro: unexpected char %r after in state %i" % (c, state))
+                state = 0  # recover
+        else:
+            emit(MacroTplError, "unfold macro: internal error, char %r, in state %i" % (c, state))
+            state = 0  # recover
+    # Final check.
+    if state == 1:
+        emit_identifier(lastidentifier)
+    if lit:
+        tpl.append((MacroTplLiteral, "".join(lit)))
+    return tpl
+
+
+def eval_macro_template(stateStruct, tpl, argnames, args):
+    """
+    :param State|None stateStruct: for error reporting
+    :param list[(int,str|None)] tpl: from compile_macro_def_rightside()
+    :param tuple[str]|list[str]|None argnames:
+    :param tuple[str]|list[str] args: arg values, in C code
+    :return: the substituted right side
+    :rtype: str
+    """
+    assert len(args) == len(argnames or ())
+    args = dict(zip(argnames or (), args))
+    ret = []
+    for op, value in tpl:
+        if op == MacroTplLiteral: ret.append(value)
+        elif op == MacroTplArg: ret.append(args[value])
+        elif op == MacroTplStringify: ret.append('"' + escape_cstr(args[value]) + '"')
+        elif op == MacroTplRStrip: ret = ["".join(ret).rstrip()]
+        elif stateStruct is not None: stateStruct.error(value)
+    return "".join(ret)
+
+
+def parse_macro_def_rightside(stateStruct, argnames, input):
+    tpl = compile_macro_def_rightside(argnames, input)
 
-        return ret
+    def f(*args):
+        return eval_macro_template(stateStruct, tpl, argnames, args)
 
     return f
 
@@ -362,6 +408,8 @@ class Macro(object):
         self.rightside = rightside if (rightside is not None) else ""
         self.defPos = state.curPosAsStr() if state else "<unknown>"
         self._tokens = None
+        self._template = None  # (args, rightside, template), see _getTemplate()
+        self._tokenTemplate = None  # (args, rightside, template), see _getTokenTemplate()
     def __str__(self):
         if self.args is not None:
             return "(" + ", ".join(self.args) + ") -> " + self.rightside
@@ -371,8 +419,53 @@ class Macro(object):
         return "<Macro: " + str(self) + ">"
     def eval(self, state, args):
         if len(args) != len(self.args or ()): raise TypeError("invalid number of args (" + str(args) + ") for " + repr(self))
-        func = parse_macro_def_rightside(state, self.args, self.rightside)
-        return func(*args)
+        return eval_macro_template(state, self._getTemplate(), self.args, args)
+    def _getTemplate(self):
+        """
+        :return: the compiled right side, see compile_macro_def_rightside().
+          Compiled once, and again only if args or rightside were reassigned.
+        :rtype: list[(int,str|None)]
+        """
+        cached = self._template
+        if cached is not None and cached[0] == self.args and cached[1] == self.rightside:
+            return cached[2]
+        tpl = compile_macro_def_rightside(self.args, self.rightside)
+        self._template = (self.args, self.rightside, tpl)
+        return tpl
+    def _getTokenTemplate(self, stateStruct):
+        """
+        :param State stateStruct: for errors while tokenizing
+        :return: the tokenized right side, for cpre2_parse_expand(), i.e. list of (op, value).
+          Compiled once, and again only if args or rightside were reassigned.
+        :rtype: list[(int,_CBase|int|None)]
+        """
+        cached = self._tokenTemplate
+        if cached is not None and cached[0] == self.args and cached[1] == self.rightside:
+            return cached[2]
+        argidx = {name: i for (i, name) in enumerate(self.args or ())}
+        tokens = list(cpre2_parse_regex(stateStruct, self.rightside, raw=True))
+        tpl = []
+        i = 0
+        while i < len(tokens):
+            t = tokens[i]
+            if t.__class__ is COp and t.content == "##":
+                if tpl and tpl[-1][0] == MacroTplArg:
+                    tpl[-1] = (MacroTplArgUnexpanded, tpl[-1][1])
+                tpl.append((MacroTplPaste, None))
+            elif (t.__class__ is COp and t.content == "#" and i + 1 < len(tokens) and
+                    tokens[i + 1].__class__ is CIdentifier and tokens[i + 1].content in argidx):
+                tpl.append((MacroTplStringify, argidx[tokens[i + 1].content]))
+                i += 1
+            elif t.__class__ is CIdentifier and t.content in argidx:
+                if tpl and tpl[-1][0] == MacroTplPaste:
+                    tpl.append((MacroTplArgUnexpanded, argidx[t.content]))
+                else:
+                    tpl.append((MacroTplArg, argidx[t.content]))
+            else:
+                tpl.append((MacroTplLiteral, t))
+            i += 1
+        self._tokenTemplate = (self.args, self.rightside, tpl)
+        return tpl
     def __call__(self, *args):
         return self.eval(None, args)
     def __eq__(self, other):
@@ -753,6 +846,40 @@ class State(object):
     # those.
     PointerSize = None
 
+    # If set, ``preprocess`` uses ``cpreprocess_parse_chunks`` (regex-driven,
+    # works on whole slices) instead of the per-char ``cpreprocess_parse``.
+    # The output is the same.  The include-level position (``curPosAsStr``)
+    # is only updated per chunk then, i.e. errors reported while tokenizing
+    # point to the start of the current line instead of the exact char.
+    ChunkedPreprocess = False
+
+    # If set, ``cpre2_parse`` uses ``cpre2_parse_regex`` (one master regex
+    # per token) instead of the per-char state machine ``cpre2_parse_chars``.
+    # Tokens are the same, except that a token never continues over the end
+    # of a macro expansion (see ``cpre2_parse_regex``).
+    RegexTokenizer = False
+
+    # If set, ``cpre2_parse`` uses ``cpre2_parse_expand``, which substitutes
+    # macros on token lists with hide-sets, instead of re-tokenizing the
+    # substituted text.  This has precedence over ``RegexTokenizer``.
+    TokenMacroExpansion = False
+
+    # If set, ``cpreprocess_evaluate_cond`` memoizes the value of each #if/#elif
+    # condition text, and reuses it while none of the macros it references
+    # (directly or via other macros) was redefined or undefined.
+    MemoizePreprocessConditions = False
+
+    # If set, local includes which are completely wrapped in an include guard
+    # (``#ifndef X`` ... ``#endif``) or which had ``#pragma once`` are remembered
+    # by their file identity (device, inode), and later includes of them are
+    # skipped without reading the file while the guard macro is defined.
+    SkipGuardedIncludes = False
+
+    # If set, the preprocessor jumps over inactive ``#if`` regions with
+    # ``str.find``/regex searches (see ``cpreprocess_skip_inactive``) instead of
+    # running every char through its state machine.  The output is the same.
+    FastSkipInactiveRegions = False
+
     EmptyMacro = Macro(None, None, (), "")
     CBuiltinTypes = {
         ("void",): CVoidType(),
@@ -830,6 +957,8 @@ class State(object):
         self.enumconsts = {} # name -> CEnumConst
         self.contentlist = []
         self._preprocessIfLevels = []
+        self._preprocessCondCache = {}  # condstr -> (deps, value), see cpreprocess_evaluate_cond
+        self._includeGuards = {}  # (dev, inode) -> ((size, mtime), macro name or True), see SkipGuardedIncludes
         self._preprocessIgnoreCurrent = False
         # 0->didnt got true yet, 1->in true part, 2->after true part. and that as a stack
         self._preprocessIncludeLevel = []
@@ -976,6 +1105,10 @@ class State(object):
         except Exception as e:
             self.error("cannot open local include-file '" + filename + "': " + str(e))
             return "", None
+        if self.SkipGuardedIncludes:
+            guard = find_include_guard(content)
+            if guard is not None:
+                self._setIncludeGuard(fullfilename, guard, overwrite=False)
 
         # ``iter(content)`` yields characters one at a time at C speed.
         # Reading the whole file once (vs ``f.read(1)`` per char) cuts
@@ -983,6 +1116,47 @@ class State(object):
         # times and is expensive per call.
         return iter(content), fullfilename
 
+    def _includeFileIdentity(self, fullfilename):
+        """
+        :param str fullfilename:
+        :return: (dev, inode), (size, mtime), or None if the file cannot be stat'ed
+        :rtype: ((int,int),(int,float))|None
+        """
+        try:
+            st = os.stat(fullfilename)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino), (st.st_size, st.st_mtime)
+
+    def _setIncludeGuard(self, fullfilename, guard, overwrite=True):
+        """
+        :param str fullfilename:
+        :param str|bool guard: macro name, or True for ``#pragma once``
+        :param bool overwrite: if False, keep an existing entry for the unchanged file
+        """
+        identity = self._includeFileIdentity(fullfilename)
+        if identity is None: return
+        key, stamp = identity
+        if not overwrite:
+            entry = self._includeGuards.get(key)
+            if entry is not None and entry[0] == stamp: return
+        self._includeGuards[key] = (stamp, guard)
+
+    def _isGuardedInclude(self, fullfilename):
+        """
+        :param str fullfilename:
+        :return: whether including the file again would not produce anything, see SkipGuardedIncludes
+        :rtype: bool
+        """
+        if not self._includeGuards: return False
+        identity = self._includeFileIdentity(fullfilename)
+        if identity is None: return False
+        key, stamp = identity
+        entry = self._includeGuards.get(key)
+        if entry is None or entry[0] != stamp: return False
+        guard = entry[1]
+        return guard is True or guard in self.macros
+
     def readGlobalInclude(self, filename):
         """
         :param str filename:
@@ -1001,13 +1175,26 @@ class State(object):
         :return: yields chars
         :rtype: typing.Generator[str]
         """
+        for chunk in self.preprocess_file_chunks(filename, local):
+            for c in chunk:
+                yield c
+
+    def preprocess_file_chunks(self, filename, local):
+        """
+        :param str filename:
+        :param bool local:
+        :return: yields str chunks. see preprocess_chunks()
+        :rtype: typing.Generator[str]
+        """
         if local:
+            if self.SkipGuardedIncludes and self._isGuardedInclude(self.findIncludeFullFilename(filename, True)):
+                return
             reader, fullfilename = self.readLocalInclude(filename)
         else:
             reader, fullfilename = self.readGlobalInclude(filename)
 
-        for c in self.preprocess(reader, fullfilename, filename):
-            yield c
+        for chunk in self.preprocess_chunks(reader, fullfilename, filename):
+            yield chunk
 
     def preprocess_source_code(self, source_code, dummy_filename="<input>"):
         """
@@ -1019,6 +1206,16 @@ class State(object):
         for c in self.preprocess(source_code, dummy_filename, dummy_filename):
             yield c
 
+    def preprocess_source_code_chunks(self, source_code, dummy_filename="<input>"):
+        """
+        :param str source_code:
+        :param str dummy_filename:
+        :return: yields str chunks. see preprocess_chunks()
+        :rtype: typing.Generator[str]
+        """
+        for chunk in self.preprocess_chunks(source_code, dummy_filename, dummy_filename):
+            yield chunk
+
     def preprocess(self, reader, fullfilename, filename):
         """
         :param reader:
@@ -1027,14 +1224,73 @@ class State(object):
         :return: yields chars
         :rtype: typing.Generator[str]
         """
+        for chunk in self.preprocess_chunks(reader, fullfilename, filename):
+            for c in chunk:
+                yield c
+
+    def preprocess_chunks(self, reader, fullfilename, filename):
+        """
+        :param reader:
+        :param str|None fullfilename:
+        :param str filename:
+        :return: yields str chunks. Single chars, unless ChunkedPreprocess is set.
+          The include-level position (curPosAsStr()) is updated whenever
+          a new chunk is generated, so it corresponds to the chunk
+          which the consumer is currently working on.
+        :rtype: typing.Generator[str]
+        """
         self.incIncludeLineChar(fullfilename=fullfilename, inc=filename)
-        for c in cpreprocess_parse(self, reader):
-            yield c
+        if self.ChunkedPreprocess:
+            for chunk in cpreprocess_parse_chunks(self, reader):
+                yield chunk
+        else:
+            for c in cpreprocess_parse(self, reader):
+                yield c
         self._preprocessIncludeLevel = self._preprocessIncludeLevel[:-1]
 
     def depth(self): return 0
 
 
+_cpp_guard_strip_re = re.compile(
+    r"//[^\n]*|/\*.*?\*/|\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*'", re.DOTALL)
+_cpp_guard_start_re = re.compile(
+    r"\s*#\s*(?:ifndef\s+([A-Za-z_]\w*)|if\s*!\s*defined\s*(?:\(\s*([A-Za-z_]\w*)\s*\)|\s([A-Za-z_]\w*)))\s*$")
+_cpp_guard_directive_re = re.compile(r"\s*#\s*([A-Za-z_]\w*)")
+
+
+def find_include_guard(content):
+    """
+    Checks for the classic include guard pattern, i.e. that everything in the file
+    is inside ``#ifndef X`` (or ``#if !defined(X)``) ... ``#endif``.
+    This is a static check on the text, before any preprocessing.
+
+    :param str content: file content
+    :return: the guard macro name X, or None if the file does not have this form
+    :rtype: str|None
+    """
+    content = content.replace("\\\r\n", "").replace("\\\n", "")
+    content = _cpp_guard_strip_re.sub(lambda m: " " if m.group(0)[0] == "/" else '""', content)
+    guard = None
+    depth = 0
+    for line in content.split("\n"):
+        if not line.strip(): continue
+        if guard is None:
+            m = _cpp_guard_start_re.match(line)
+            if not m: return None
+            guard = m.group(1) or m.group(2) or m.group(3)
+            depth = 1
+            continue
+        if depth == 0: return None  # something after the final #endif
+        m = _cpp_guard_directive_re.match(line)
+        if not m: continue
+        cmd = m.group(1)
+        if cmd in ("if", "ifdef", "ifndef"): depth += 1
+        elif cmd == "endif": depth -= 1
+        elif cmd in ("else", "elif") and depth == 1: return None
+    if depth != 0: return None
+    return guard
+
+
 def is_valid_defname(defname):
     if not defname: return False
     gotValidPrefix = False
@@ -1084,7 +1340,69 @@ def cpreprocess_evaluate_single(state, arg):
     return cpreprocess_evaluate_cond(state, resolved)
 
 
+_cpp_cond_ident_re = re.compile(r"\b[A-Za-z_][A-Za-z_0-9]*")
+
+
+def _cpreprocess_cond_deps(stateStruct, condstr):
+    """
+    :param State stateStruct:
+    :param str condstr: #if condition
+    :return: all macros the evaluation of condstr can depend on, i.e. the identifiers in condstr
+      and, transitively, in the right sides of the referenced macros, with their current definition.
+      None if the evaluation could see identifiers which are not in the text (via ## pasting).
+    :rtype: tuple[(str,Macro|None,tuple[str]|None,str|None)]|None
+    """
+    macros = stateStruct.macros
+    deps = []
+    seen = set()
+    todo = [condstr]
+    while todo:
+        for name in _cpp_cond_ident_re.findall(todo.pop()):
+            if name in seen: continue
+            seen.add(name)
+            macro = macros.get(name)
+            if macro is None:
+                deps.append((name, None, None, None))
+                continue
+            if "##" in macro.rightside: return None
+            deps.append((name, macro, macro.args, macro.rightside))
+            todo.append(macro.rightside)
+    return tuple(deps)
+
+
 def cpreprocess_evaluate_cond(stateStruct, condstr):
+    """
+    Evaluates the #if/#elif condition condstr with the current macros.
+    With State.MemoizePreprocessConditions, the result is memoized per condition text,
+    together with the definitions of all macros it can depend on (_cpreprocess_cond_deps),
+    and reused as long as none of them was redefined or undefined.
+
+    :param State stateStruct:
+    :param str condstr:
+    """
+    if not stateStruct.MemoizePreprocessConditions:
+        return _cpreprocess_evaluate_cond_uncached(stateStruct, condstr)
+    cache = stateStruct._preprocessCondCache
+    cached = cache.get(condstr)
+    if cached is not None:
+        deps, result = cached
+        macros = stateStruct.macros
+        for name, macro, args, rightside in deps:
+            cur = macros.get(name)
+            if cur is not macro: break
+            if macro is not None and (macro.args is not args or macro.rightside is not rightside): break
+        else:
+            return result
+    numErrors = len(stateStruct._errors)
+    result = _cpreprocess_evaluate_cond_uncached(stateStruct, condstr)
+    if len(stateStruct._errors) == numErrors:  # errors are reported on each evaluation
+        deps = _cpreprocess_cond_deps(stateStruct, condstr)
+        if deps is not None:
+            cache[condstr] = (deps, result)
+    return result
+
+
+def _cpreprocess_evaluate_cond_uncached(stateStruct, condstr):
     state = 0
     bracketLevel = 0
     substr = ""
@@ -1438,7 +1756,7 @@ def cpreprocess_handle_include(state, arg):
     else:
         state.error("invalid include argument: '" + arg + "'")
         return
-    for c in state.preprocess_file(filename=filename, local=local): yield c
+    for chunk in state.preprocess_file_chunks(filename=filename, local=local): yield chunk
 
 def cpreprocess_handle_def(stateStruct, arg):
     state = 0
@@ -1506,6 +1824,10 @@ def cpreprocess_handle_pragma(state, arg):
     Unknown pragmas are ignored.
     """
     arg = arg.strip()
+    if arg == "once":
+        if state.SkipGuardedIncludes and state._preprocessIncludeLevel and state._preprocessIncludeLevel[-1][0]:
+            state._setIncludeGuard(state._preprocessIncludeLevel[-1][0], True)
+        return
     if not arg.startswith("pack"):
         return  # ignore all other pragmas
     inner = arg[len("pack"):].strip()
@@ -1608,6 +1930,71 @@ def handle_cpreprocess_cmd(state, cmd, arg):
     state._preprocessIgnoreCurrent = any(map(lambda x: x != 1, state._preprocessIfLevels))
 
 
+_cpp_inactive_special_re = re.compile(r"[#/\"']")
+
+
+def cpreprocess_skip_inactive(s, i):
+    """
+    :param str s: not-yet preprocessed C code
+    :param int i: offset in s, in code (i.e. not in a comment or str), inside an inactive region
+    :return: offset of the next "#" which the state machine of cpreprocess_parse() would see
+      as start of a preprocessor command, or len(s).
+      Comments and str/char literals are skipped like cpreprocess_parse() does
+      (they can span lines and hide a "#").
+    :rtype: int
+    """
+    n = len(s)
+    while True:
+        m = _cpp_inactive_special_re.search(s, i)
+        if m is None: return n
+        j = m.start()
+        c = s[j]
+        if c == "#": return j
+        if c == "/":
+            c2 = s[j + 1:j + 2]
+            if c2 == "*":
+                e = s.find("*/", j + 2)
+                if e < 0: return n  # runaway comment
+                i = e + 2
+            elif c2 == "/":
+                e = s.find("\n", j + 2)
+                if e < 0: return n
+                i = e
+            else:
+                i = j + 2  # like cpreprocess_parse, the char after "/" is not checked
+        else:
+            e = _cpp_code_str_body_re[c].match(s, j + 1).end()
+            if e >= n: return n  # runaway str
+            i = e + 1
+
+
+def _cpreprocess_advance_pos(stateStruct, s, start, end):
+    """
+    Updates the include-level position like the per-char updates in cpreprocess_parse() for s[start:end].
+
+    :param State stateStruct:
+    :param str s:
+    :param int start:
+    :param int end:
+    """
+    stateStruct.incIncludeLineChar()  # make sure there is some level
+    level = stateStruct._preprocessIncludeLevel[-1]
+    numLines = s.count("\n", start, end)
+    if numLines:
+        level[2] += numLines
+        start = s.rfind("\n", start, end) + 1
+        col = 0
+    else:
+        col = level[3]
+    if "\t" not in s[start:end]:
+        col += end - start
+    else:
+        for k in range(start, end):
+            if s[k] == "\t": col += 4 - col % 4
+            else: col += 1
+    level[3] = col
+
+
 def cpreprocess_parse(stateStruct, input):
     """
     :param State stateStruct:
@@ -1623,7 +2010,12 @@ def cpreprocess_parse(stateStruct, input):
     arg = ""
     state = 0
     statebeforecomment = None
-    for c in input:
+    fastSkip = stateStruct.FastSkipInactiveRegions
+    if fastSkip:
+        text = input if isinstance(input, str) else "".join(input)
+        input = iter(text)
+    skipped = 0  # number of chars consumed by the fast skipping, i.e. not counted by enumerate()
+    for i, c in enumerate(input):
         breakLoop = False
         while not breakLoop:
             breakLoop = True
@@ -1749,7 +2141,15 @@ def cpreprocess_parse(stateStruct, input):
                 stateStruct.error("internal error: invalid state " + str(state))
                 state = 0 # reset. it's the best we can do
 
-        if c == "\n": stateStruct.incIncludeLineChar(line=1)
+        if c == "\n":
+            stateStruct.incIncludeLineChar(line=1)
+            if fastSkip and state == 0 and stateStruct._preprocessIgnoreCurrent:
+                start = i + skipped + 1
+                end = cpreprocess_skip_inactive(text, start)
+                if end > start:
+                    _cpreprocess_advance_pos(stateStruct, text, start, end)
+                    next(itertools.islice(input, end - start - 1, None), None)
+                    skipped += end - start
         elif c == "\t": stateStruct.incIncludeLineChar(char=4, charMod=4)
         else: stateStruct.incIncludeLineChar(char=1)
 
@@ -1757,6 +2157,222 @@ def cpreprocess_parse(stateStruct, input):
     yield "\n"
 
 
+# Regexes for ``cpreprocess_parse_chunks``.  Each one finds the next char
+# where the ``cpreprocess_parse`` state machine would leave its current
+# state; everything in between is copied (or skipped) as one slice.
+_cpp_code_special_re = re.compile(r"[#/\"'\n]")
+_cpp_cmd_special_re = re.compile(r"[ \t\x0b\x0c(/\"'\\\n]")  # while reading the cmd name
+_cpp_arg_special_re = re.compile(r"[/\"'\\\n]")  # while reading the cmd arg
+_cpp_code_str_body_re = {
+    '"': re.compile(r'(?:[^"\\]+|\\.)*', re.DOTALL),
+    "'": re.compile(r"(?:[^'\\]+|\\.)*", re.DOTALL)}
+_cpp_arg_str_body_re = {
+    '"': re.compile(r'(?:[^"\\\n]+|\\.)*', re.DOTALL),
+    "'": re.compile(r"(?:[^'\\\n]+|\\.)*", re.DOTALL)}
+_cpp_spaces_re = re.compile(r"[ \t\x0b\x0c]*")
+
+
+class _PreprocessPosTracker:
+    """
+    Keeps the current include-level position (see ``State.incIncludeLineChar``)
+    in sync with an offset into the raw input of ``cpreprocess_parse_chunks``.
+    Line and column are derived from the offsets via ``str.count``/``rfind``
+    instead of being incremented per char.
+    """
+
+    def __init__(self, stateStruct, text):
+        stateStruct.incIncludeLineChar()  # make sure there is some level
+        self.level = stateStruct._preprocessIncludeLevel[-1]
+        self.text = text
+        self.offset = 0
+        self.lineStart = 0
+        self.lineStartCol = self.level[3]
+
+    def update(self, offset):
+        if offset <= self.offset: return
+        text = self.text
+        n = text.count("\n", self.offset, offset)
+        if n:
+            self.level[2] += n
+            self.lineStart = text.rfind("\n", self.offset, offset) + 1
+            self.lineStartCol = 0
+        self.offset = offset
+        seg = text[self.lineStart:offset]
+        if "\t" not in seg:
+            col = len(seg)
+        elif "\r" not in seg:
+            col = len(seg.expandtabs(4))
+        else:  # expandtabs() would restart at "\r"
+            col = 0
+            for c in seg:
+                if c == "\t": col += 4 - col % 4
+                else: col += 1
+        self.level[3] = self.lineStartCol + col
+
+
+def cpreprocess_parse_chunks(stateStruct, input):
+    """
+    :param State stateStruct:
+    :param str|typing.Iterable[str] input: not-yet preprocessed C code (str or iterable over chars)
+    :returns preprocessed C code, iterator of str chunks
+    This is the same as cpreprocess_parse() and the concatenated output is
+    identical, but it scans the input with regexes (code runs, comments,
+    string literals, preprocessor commands) and yields whole slices,
+    usually one per line, instead of single chars.
+    The include-level position is updated at every chunk start
+    and at every preprocessor command.
+    :rtype: typing.Generator[str]
+    """
+    if isinstance(input, str):
+        s = input
+    else:
+        s = "".join(input)
+    pos = _PreprocessPosTracker(stateStruct, s)
+    fastSkip = stateStruct.FastSkipInactiveRegions
+    n = len(s)
+    out = []  # pending output of the current line
+    outStart = 0
+    i = 0
+    while i < n:
+        if fastSkip and stateStruct._preprocessIgnoreCurrent:
+            i = cpreprocess_skip_inactive(s, i)
+            if i >= n: break
+        m = _cpp_code_special_re.search(s, i)
+        if m is None:
+            if not stateStruct._preprocessIgnoreCurrent:
+                if not out: outStart = i
+                out.append(s[i:])
+            break
+        j = m.start()
+        c = s[j]
+        if c == "\n":
+            if not stateStruct._preprocessIgnoreCurrent:
+                if not out: outStart = i
+                out.append(s[i:j + 1])
+                pos.update(outStart)
+                yield "".join(out)
+                out = []
+            i = j + 1
+            continue
+        if j > i and not stateStruct._preprocessIgnoreCurrent:
+            if not out: outStart = i
+            out.append(s[i:j])
+        if c == '"' or c == "'":
+            e = _cpp_code_str_body_re[c].match(s, j + 1).end()
+            if e < n:
+                # Either the closing quote, or a single "\\" at the very end.
+                e += 1
+            if not stateStruct._preprocessIgnoreCurrent:
+                if not out: outStart = j
+                out.append(s[j:e])
+            i = e
+        elif c == "/":
+            if j + 1 >= n:
+                break  # unfinished, like in cpreprocess_parse
+            c2 = s[j + 1]
+            if c2 == "*":
+                e = s.find("*/", j + 2)
+                if e < 0: break  # runaway comment
+                i = e + 2
+            elif c2 == "/":
+                e = s.find("\n", j + 2)
+                if e < 0: break
+                i = e  # the newline is handled as usual
+            else:
+                if not stateStruct._preprocessIgnoreCurrent:
+                    if not out: outStart = j
+                    out.append(s[j:j + 2])
+                i = j + 2
+        else:  # "#"
+            if out:
+                pos.update(outStart)
+                yield "".join(out)
+                out = []
+            # Start of preprocessor command. Like states 1-5 in cpreprocess_parse.
+            k = _cpp_spaces_re.match(s, j + 1).end()
+            if k >= n: break
+            if s[k] == "\n":
+                i = k + 1
+                continue
+            cmd = s[k]
+            arg = None
+            k += 1
+            endOfCmd = None  # offset of the final newline
+            while k < n:
+                if arg is None:
+                    m = _cpp_cmd_special_re.search(s, k)
+                else:
+                    m = _cpp_arg_special_re.search(s, k)
+                if m is None:
+                    k = n
+                    break
+                e = m.start()
+                if e > k:
+                    if arg is None: cmd += s[k:e]
+                    else: arg += s[k:e]
+                c = s[e]
+                k = e + 1
+                if c == "\n":
+                    endOfCmd = e
+                    break
+                elif c in SpaceChars:
+                    if arg is None: arg = ""
+                    else: arg += c
+                elif c == "(":
+                    arg = c
+                elif c == "/":
+                    if k >= n: break
+                    c2 = s[k]
+                    if c2 == "*":
+                        e = s.find("*/", k + 1)
+                        if e < 0:
+                            k = n
+                            break
+                        k = e + 2
+                    elif c2 == "/":
+                        e = s.find("\n", k + 1)
+                        if e < 0:
+                            k = n
+                            break
+                        k = e  # the newline ends the command
+                    else:
+                        if arg is None: arg = ""
+                        arg += "/" + c2
+                        k += 1
+                elif c == '"' or c == "'":
+                    e = _cpp_arg_str_body_re[c].match(s, k).end()
+                    if e >= n or s[e] == "\\":
+                        k = n
+                        break
+                    if arg is None: arg = ""
+                    arg += s[k - 1:e + 1]
+                    k = e + 1
+                    if s[e] == "\n":
+                        pos.update(e)
+                        if c == '"':
+                            stateStruct.error("preproc parse: unfinished str")
+                        else:
+                            stateStruct.error("preproc parse: unfinished char str")
+                        break
+                else:  # "\\"
+                    e = s.find("\n", k)
+                    if e < 0:
+                        k = n
+                        break
+                    k = e + 1
+            i = k
+            if endOfCmd is not None:
+                pos.update(endOfCmd)
+                for c in handle_cpreprocess_cmd(stateStruct, cmd, arg): yield c
+    if out:
+        pos.update(outStart)
+        yield "".join(out)
+    pos.update(n)
+
+    # yield dummy additional new-line at end
+    yield "\n"
+
+
 class _CBase(object):
     def __init__(self, content=None, rawstr=None, **kwargs):
         self.content = content
@@ -1901,13 +2517,21 @@ def _cpre2_parse_args(stateStruct, input, brackets, separator=COp(",")):
 
 
 class _Pre2ParseStream:
-    def __init__(self, input):
+    def __init__(self, input, chunked=False):
         """
-        :param str|typing.Iterable[str] input:
+        :param str|typing.Iterable[str] input: chars, or str chunks if chunked
+        :param bool chunked: whether input yields str chunks (e.g. State.preprocess_chunks())
+          instead of single chars.
+          Chunks are kept in the bottom buffer frame and indexed directly,
+          so there is no generator resumption per char.
         """
         if isinstance(input, str):
-            input = iter(input)
+            # Any split gives the same tokens. Lines keep the buffer
+            # rebuild in add_macro() cheap.
+            input = iter(input.splitlines(True))
+            chunked = True
         self.input = input
+        self.chunked = chunked
         self.macro_blacklist = set()
         # Each frame: [macroname_or_None, buffer_str, pos].
         # We track ``pos`` as an index into ``buffer_str`` instead of
@@ -1918,6 +2542,11 @@ class _Pre2ParseStream:
         # on the next ``next_char`` call (used by escape readers to
         # "put back" a non-matching char).
         self._putback = []
+        # State whose include-level position is set to the current token, see update_pos().
+        # Only for plain char input, which fetch_input() reads ahead up to the line end.
+        self.pos_state = None
+        # [include level, line, offset in the bottom buffer, column at that offset] or None
+        self.line_pos = None
 
     def next_char(self):
         pb = self._putback
@@ -1937,6 +2566,8 @@ class _Pre2ParseStream:
                 if pos < len(buf):
                     frame[2] = pos + 1
                     return buf[pos]
+            if self.chunked:
+                return self._next_chunk_char()
             try:
                 return next(self.input)
             except StopIteration:
@@ -1948,11 +2579,26 @@ class _Pre2ParseStream:
             if pos < len(buf):
                 frame[2] = pos + 1
                 return buf[pos]
+        if self.chunked:
+            return self._next_chunk_char()
         try:
             return next(self.input)
         except StopIteration:
             return None
 
+    def _next_chunk_char(self):
+        """
+        All buffer frames are exhausted. Load the next input chunk into the
+        bottom frame and return its first char.
+        """
+        for chunk in self.input:
+            if chunk:
+                frame = self.buffer_stack[0]
+                frame[1] = chunk
+                frame[2] = 1
+                return chunk[0]
+        return None
+
     def putback_char(self, c):
         """Push *c* back so the next ``next_char()`` returns it."""
         self._putback.append(c)
@@ -1969,6 +2615,75 @@ class _Pre2ParseStream:
         below[1] = c + below[1][below[2]:]
         below[2] = 0
 
+    def push_macro(self, macroname, resolved):
+        """Like add_macro(), but there is no char to re-inject (used by cpre2_parse_regex)."""
+        self.buffer_stack.append([macroname, resolved, 0])
+        self.macro_blacklist.add(macroname)
+
+    def pop_macro(self):
+        """Remove the (exhausted) top macro frame."""
+        self.macro_blacklist.remove(self.buffer_stack.pop()[0])
+
+    def fetch_input(self):
+        """
+        Append more input to the bottom frame, dropping its consumed part.
+        Used by cpre2_parse_regex, which needs whole slices to match on.
+        Plain char input is collected up to the next newline.
+        :return: whether there was more input
+        :rtype: bool
+        """
+        frame = self.buffer_stack[0]
+        if self.chunked:
+            for chunk in self.input:
+                if chunk:
+                    break
+            else:
+                return False
+        else:
+            c = next(self.input, None)
+            if c is None:
+                return False
+            if self.pos_state is not None and self.pos_state._preprocessIncludeLevel:
+                # The position of the first char of the line. The preprocessor only
+                # moves on once we read the rest, so we remember it for update_pos().
+                level = self.pos_state._preprocessIncludeLevel[-1]
+                self.line_pos = [level, level[2], max(len(frame[1]) - frame[2], 0), level[3]]
+            cs = [c]
+            if c != "\n":
+                for c in self.input:
+                    cs.append(c)
+                    if c == "\n": break
+            chunk = "".join(cs)
+        pos = frame[2]
+        if pos < len(frame[1]):
+            chunk = frame[1][pos:] + chunk
+        frame[1] = chunk
+        frame[2] = 0
+        return True
+
+    def update_pos(self, offset):
+        """
+        Sets the include-level position of pos_state to the given offset in the bottom buffer,
+        like the per-char preprocessor would have it when the tokenizer reads that char.
+
+        :param int offset:
+        """
+        line_pos = self.line_pos
+        if line_pos is None or offset < line_pos[2]: return
+        seg = self.buffer_stack[0][1][line_pos[2]:offset]
+        col = line_pos[3]
+        if "\t" not in seg:
+            col += len(seg)
+        else:
+            for c in seg:
+                if c == "\t": col += 4 - col % 4
+                else: col += 1
+        line_pos[2] = offset
+        line_pos[3] = col
+        level = line_pos[0]
+        level[2] = line_pos[1]
+        level[3] = col
+
     def finalize_char(self, laststr):
         # Finalize buffer_stack here. Here because the macro_blacklist needs to be active
         # in the code above.
@@ -1994,6 +2709,23 @@ def cpre2_parse(stateStruct, input, brackets=None):
     :returns token iterator. this will also substitute macros
     The input comes more or less from cpreprocess_parse().
     This output will be handled by cpre3_parse().
+    Depending on State.TokenMacroExpansion and State.RegexTokenizer, this uses
+    cpre2_parse_expand(), cpre2_parse_regex() or the per-char state machine
+    cpre2_parse_chars().
+    """
+    if stateStruct.TokenMacroExpansion:
+        return cpre2_parse_expand(stateStruct, input, brackets=brackets)
+    if stateStruct.RegexTokenizer:
+        return cpre2_parse_regex(stateStruct, input, brackets=brackets)
+    return cpre2_parse_chars(stateStruct, input, brackets=brackets)
+
+
+def cpre2_parse_chars(stateStruct, input, brackets=None):
+    """
+    :param State stateStruct:
+    :param str|typing.Iterable[str]|_Pre2ParseStream input: see cpre2_parse()
+    :param list[str]|None brackets: opening brackets stack
+    :returns token iterator. see cpre2_parse()
     """
     state = 0
     if brackets is None: brackets = []
@@ -2235,6 +2967,425 @@ def cpre2_parse(stateStruct, input, brackets=None):
         input.finalize_char(laststr)
 
 
+def _cpre2_make_token_re():
+    ops = sorted(_LongOpsSet, key=len, reverse=True)
+    # Same number rules as in cpre2_parse_chars (state 10): a single "." is part
+    # of the number if there was no "e" before, and "+"/"-" directly after an "e".
+    num_rest = r"(?:[0-9A-Za-z_]|(?<=[eE])[+-])*"
+    return re.compile("|".join([
+        r"(?P<ws>[ \t\x0b\x0c\n]+)",
+        r"(?P<id>[A-Za-z_][A-Za-z0-9_]*)",
+        r"(?P<num>[0-9][0-9A-DF-Za-df-z_]*\." + num_rest + "|[0-9]" + num_rest + ")",
+        r'(?P<str>"(?:[^"\\]|\\.)*")',
+        r"(?P<chr>'(?:[^'\\]|\\.)*')",
+        r"(?P<open>[\"'])",  # unfinished str/char literal
+        r"(?P<op>" + "|".join([re.escape(op) for op in ops]) + "|[" + re.escape(OpChars) + "])",
+        r"(?P<semicolon>;)",
+        r"(?P<bracket>[\[\](){}])",
+        r"(?P<backslash>\\)",
+        r"(?P<hash>##?)",  # only valid in macro right sides, see cpre2_parse_regex(raw=True)
+        r"(?P<other>.)"]), re.DOTALL)
+
+_cpre2_token_re = _cpre2_make_token_re()
+_cpre2_wide_literal_re = re.compile(r'"(?:[^"\\]|\\.)*"|' + r"'(?:[^'\\]|\\.)*'", re.DOTALL)
+_cpre2_ws_re = re.compile(r"[ \t\x0b\x0c\n]*")
+_cpre2_escape_re = re.compile(
+    r"\\(?:x([0-9a-fA-F]*)|u([0-9a-fA-F]{0,4})|U([0-9a-fA-F]{0,8})|([0-7]{1,3})|(.))", re.DOTALL)
+# Token kinds which might go on in the next input slice.
+_cpre2_continued_kinds = frozenset(["id", "num", "op", "open", "backslash", "hash"])
+
+
+def _cpre2_unescape_repl(m):
+    hexstr = m.group(1)
+    if hexstr is None: hexstr = m.group(2)
+    if hexstr is None: hexstr = m.group(3)
+    if hexstr is not None:
+        return chr(int(hexstr, 16)) if hexstr else "\x00"
+    if m.group(4) is not None:
+        return chr(int(m.group(4), 8))
+    return simple_escape_char(m.group(5))
+
+
+def _cpre2_unescape(s):
+    """Resolves the escapes in a str/char literal body, like cpre2_parse_chars."""
+    if "\\" not in s: return s
+    return _cpre2_escape_re.sub(_cpre2_unescape_repl, s)
+
+
+def cpre2_parse_regex(stateStruct, input, brackets=None, raw=False):
+    """
+    :param State stateStruct:
+    :param str|typing.Iterable[str]|_Pre2ParseStream input: see cpre2_parse()
+    :param list[str]|None brackets: opening brackets stack
+    :param bool raw: just split into tokens. No macro substitution, no bracket tracking,
+      and "#"/"##" are yielded as COp. Used by cpre2_parse_expand().
+    :returns token iterator. see cpre2_parse()
+    Gives the same tokens as cpre2_parse_chars() but matches whole tokens with
+    one master regex on the current input slice (see _Pre2ParseStream.fetch_input())
+    or macro expansion.
+    Differences: A token never spans the end of a macro expansion, i.e. the
+    expansion is not glued to a directly following identifier, and a macro
+    is not blacklisted anymore once its expansion is consumed.
+    With plain char input (per-char preprocessor), the input is read ahead up
+    to the line end, and the include-level position is set back to the start
+    of each token (see _Pre2ParseStream.update_pos()), so errors point to the
+    same column as with cpre2_parse_chars().
+    """
+    if brackets is None: brackets = []
+    if not isinstance(input, _Pre2ParseStream):
+        input = _Pre2ParseStream(input)
+    if not input.chunked:
+        input.pos_state = stateStruct
+    stack = input.buffer_stack
+    macros = stateStruct.macros if not raw else {}
+    token_re_match = _cpre2_token_re.match
+    while True:
+        frame = stack[-1]
+        buf = frame[1]
+        pos = frame[2]
+        if pos >= len(buf):
+            if len(stack) > 1:
+                input.pop_macro()
+                continue
+            if not input.fetch_input():
+                break
+            continue
+        m = token_re_match(buf, pos)
+        kind = m.lastgroup
+        end = m.end()
+        if kind == "ws":
+            frame[2] = end
+            continue
+        if len(stack) == 1:
+            if end == len(buf) and kind in _cpre2_continued_kinds:
+                # The token might go on in the next input slice.
+                if input.fetch_input(): continue
+            if kind == "open":
+                # Unfinished literal. Like cpre2_parse_chars, drop it at the end.
+                if input.fetch_input(): continue
+                break
+            if input.line_pos is not None:
+                input.update_pos(pos)
+        if kind == "id":
+            name = m.group()
+            if name == "L" and end < len(buf) and buf[end] in "\"'" and (
+                    name not in macros or name in input.macro_blacklist):
+                m = _cpre2_wide_literal_re.match(buf, end)
+                if not m:
+                    if len(stack) == 1 and input.fetch_input(): continue
+                    frame[2] = len(buf)  # unfinished literal
+                    continue
+                frame[2] = m.end()
+                s = _cpre2_unescape(m.group()[1:-1])
+                if m.group()[0] == '"':
+                    yield CWideStr(s)
+                else:
+                    yield CChar(s)
+                continue
+            frame[2] = end
+            if name in macros and name not in input.macro_blacklist:
+                macro = macros[name]
+                macroargs = []
+                if macro.args is not None:
+                    # A function-like macro is only expanded when followed by "(".
+                    while True:
+                        frame = stack[-1]
+                        pos = _cpre2_ws_re.match(frame[1], frame[2]).end()
+                        frame[2] = pos
+                        if pos < len(frame[1]): break
+                        if len(stack) > 1: input.pop_macro()
+                        elif not input.fetch_input(): return  # like cpre2_parse_chars
+                    if frame[1][pos] != "(":
+                        yield CIdentifier(name)
+                        continue
+                    frame[2] = pos + 1
+                    macroargs = _cpre2_parse_args(stateStruct, input, brackets=brackets + ["("])
+                try:
+                    resolved = macro.eval(stateStruct, macroargs)
+                except Exception as e:
+                    stateStruct.error("cpre2 parse unfold macro " + name + " error: " + repr(e))
+                    resolved = ""
+                input.push_macro(name, resolved)
+            elif raw:
+                yield CIdentifier(name)
+            elif name == "__FILE__":
+                yield CStr(stateStruct.curFile())
+            elif name == "__LINE__":
+                yield CNumber(stateStruct.curLine())
+            elif name == "__func__":
+                yield CFuncName("")
+            else:
+                yield CIdentifier(name)
+            continue
+        frame[2] = end
+        if kind == "op":
+            yield COp(m.group())
+        elif kind == "num":
+            s = m.group()
+            yield CNumber(cpre2_parse_number(stateStruct, s), s)
+        elif kind == "bracket":
+            c = m.group()
+            if raw:
+                yield COpeningBracket(c) if c in OpeningBrackets else CClosingBracket(c)
+            elif c in OpeningBrackets:
+                yield COpeningBracket(c, brackets=list(brackets))
+                brackets.append(c)
+            elif len(brackets) == 0 or ClosingBrackets[len(OpeningBrackets) - OpeningBrackets.index(brackets[-1]) - 1] != c:
+                stateStruct.error("cpre2 parse: got '" + c + "' but bracket level was " + str(brackets))
+            else:
+                brackets[:] = brackets[:-1]
+                yield CClosingBracket(c, brackets=list(brackets))
+        elif kind == "semicolon":
+            yield CSemicolon()
+        elif kind == "str":
+            yield CStr(_cpre2_unescape(buf[pos + 1:end - 1]))
+        elif kind == "chr":
+            s = _cpre2_unescape(buf[pos + 1:end - 1])
+            if len(s) > 1 and s[0] == '\0':  # hacky check for '\0abc'-like strings.
+                yield CChar(int(s[1:], 8))
+            else:
+                yield CChar(s)
+        elif kind == "backslash":  # escape without context
+            if end < len(buf):
+                if buf[end] != "\n":
+                    stateStruct.error("cpre2 parse: didn't expected char %r in state %i" % (buf[end], 1))
+                # Just ignore it in any case.
+                frame[2] = end + 1
+        elif kind == "open":
+            frame[2] = len(buf)  # unfinished literal at the end of the macro expansion
+        elif kind == "hash" and raw:
+            yield COp(m.group())
+        else:
+            for c in m.group():
+                stateStruct.error("cpre2 parse: didn't expected char %r in state %i" % (c, 0))
+
+
+def _hideset_add(hideset, name):
+    if hideset is None: return frozenset([name])
+    return hideset | frozenset([name])
+
+
+class _MacroExpander:
+    """
+    Macro substitution on token lists, see cpre2_parse_expand().
+    Every token is paired with its hide-set, i.e. the names of the macros which it
+    resulted from (None if empty). Those are not expanded again for this token,
+    like the C standard prescribes.
+    """
+
+    def __init__(self, stateStruct, source, pending=()):
+        """
+        :param State stateStruct:
+        :param typing.Iterator[_CBase] source: raw tokens, e.g. from cpre2_parse_regex(raw=True)
+        :param list[(_CBase,frozenset[str]|None)] pending: to be read before source
+        """
+        self.stateStruct = stateStruct
+        self.source = source
+        # Stack of (token, hideset). The top is the next token.
+        self.pending = list(reversed(pending))
+
+    def next_token(self):
+        """
+        :rtype: (_CBase|None, frozenset[str]|None)
+        """
+        if self.pending:
+            return self.pending.pop()
+        for token in self.source:
+            return token, None
+        return None, None
+
+    def __iter__(self):
+        """
+        :return: (token, hideset) iterator, with all macros substituted
+        """
+        macros = self.stateStruct.macros
+        pending = self.pending
+        source = self.source
+        while True:
+            if pending:
+                token, hideset = pending.pop()
+            else:
+                # Inlined next_token(), this is the common case.
+                token = next(source, None)
+                hideset = None
+                if token is None:
+                    return
+            if token.__class__ is CIdentifier:
+                name = token.content
+                if name in macros and (hideset is None or name not in hideset):
+                    if self.expand(name, macros[name], hideset):
+                        continue
+            yield token, hideset
+
+    def expand_list(self, tokens):
+        """
+        :param list[(_CBase,frozenset[str]|None)] tokens:
+        :return: tokens with all macros substituted. Like for macro args, the substitution
+          stops at the end of the list.
+        :rtype: list[(_CBase,frozenset[str]|None)]
+        """
+        macros = self.stateStruct.macros
+        for (t, _) in tokens:
+            if t.__class__ is CIdentifier and t.content in macros:
+                break
+        else:
+            return tokens  # nothing to substitute, e.g. already expanded
+        return list(_MacroExpander(self.stateStruct, iter(()), tokens))
+
+    def read_args(self):
+        """
+        Reads the args of a function-like macro, after the opening "(".
+        :return: (list of args, each a list of (token, hideset), hideset of the closing ")"),
+          or (None, None) if there was no closing ")".
+        """
+        args = [[]]
+        depth = 0
+        while True:
+            token, hideset = self.next_token()
+            if token is None:
+                self.stateStruct.error("cpre2 parse args: runaway")
+                return None, None
+            cls = token.__class__
+            if cls is COpeningBracket:
+                depth += 1
+            elif cls is CClosingBracket:
+                if depth == 0:
+                    if token.content != ")":
+                        self.stateStruct.error("cpre2 parse: got '" + token.content + "' but expected ')' after macro args")
+                    return args, hideset
+                depth -= 1
+            elif depth == 0 and cls is COp and token.content == ",":
+                args.append([])
+                continue
+            args[-1].append((token, hideset))
+
+    def expand(self, name, macro, hideset):
+        """
+        Substitutes the macro and pushes the result to the pending tokens.
+        :param str name:
+        :param Macro macro:
+        :param frozenset[str]|None hideset: of the macro name token
+        :return: whether the macro was substituted. A function-like macro is only
+          substituted if followed by "(".
+        :rtype: bool
+        """
+        stateStruct = self.stateStruct
+        args = []
+        if macro.args is not None:
+            token = self.next_token()
+            if token[0].__class__ is not COpeningBracket or token[0].content != "(":
+                if token[0] is not None:
+                    self.pending.append(token)
+                return False
+            args, rparen_hideset = self.read_args()
+            if args is None:
+                return True
+            # C standard: the hide-set of the expansion is HS(name) & HS(")") + {name}.
+            if hideset is not None and rparen_hideset is not None:
+                hideset = hideset & rparen_hideset
+            else:
+                hideset = None
+            if len(macro.args) == 0 and args == [[]]:
+                args = []
+        hideset = _hideset_add(hideset, name)
+        if type(macro).eval is not Macro.eval:
+            # Custom eval(), e.g. _AttributeMacro. Works on the C code of the args.
+            args = [" ".join([t.asCCode() for (t, _) in self.expand_list(arg)]) for arg in args]
+            try:
+                resolved = macro.eval(stateStruct, args)
+            except Exception as e:
+                stateStruct.error("cpre2 parse unfold macro " + name + " error: " + repr(e))
+                resolved = ""
+            self.pending.extend(reversed([(t, hideset) for t in cpre2_parse_regex(stateStruct, resolved, raw=True)]))
+            return True
+        if len(args) != len(macro.args or ()):
+            stateStruct.error("cpre2 parse unfold macro " + name + " error: invalid number of args (%i) for %r" % (
+                len(args), macro))
+            return True
+        self.pending.extend(reversed(self.substitute(macro._getTokenTemplate(stateStruct), args, hideset)))
+        return True
+
+    def substitute(self, tpl, args, hideset):
+        """
+        :param list[(int,_CBase|int|None)] tpl: from Macro._getTokenTemplate()
+        :param list[list[(_CBase,frozenset[str]|None)]] args:
+        :param frozenset[str] hideset: for the resulting tokens
+        :rtype: list[(_CBase,frozenset[str]|None)]
+        """
+        out = []
+        expanded_args = {}
+        paste = False
+        for op, value in tpl:
+            if op == MacroTplLiteral:
+                items = [(value, hideset)]
+            elif op == MacroTplPaste:
+                paste = True
+                continue
+            elif op == MacroTplStringify:
+                items = [(CStr(" ".join([t.asCCode() for (t, _) in args[value]])), hideset)]
+            else:
+                if op == MacroTplArg:
+                    if value not in expanded_args:
+                        expanded_args[value] = self.expand_list(args[value])
+                    arg = expanded_args[value]
+                else:  # MacroTplArgUnexpanded
+                    arg = args[value]
+                items = [(t, hideset if hs is None else hs | hideset) for (t, hs) in arg]
+            if paste:
+                paste = False
+                if out and items:
+                    code = out.pop()[0].asCCode() + items[0][0].asCCode()
+                    pasted = [(t, hideset) for t in cpre2_parse_regex(self.stateStruct, code, raw=True)]
+                    items = pasted + items[1:]
+            out.extend(items)
+        return out
+
+
+def cpre2_parse_expand(stateStruct, input, brackets=None):
+    """
+    :param State stateStruct:
+    :param str|typing.Iterable[str]|_Pre2ParseStream input: see cpre2_parse()
+    :param list[str]|None brackets: opening brackets stack
+    :returns token iterator. see cpre2_parse()
+    The input is split into tokens once (cpre2_parse_regex(raw=True)), and macros are
+    substituted on token lists (see _MacroExpander): macro right sides are tokenized
+    once per Macro, args once per use, and recursion is prevented by hide-sets.
+    Nothing is re-tokenized, except the result of "##".
+    Unlike the string-based substitution, the "#" and "##" operands are not
+    macro-expanded, as in the C standard.
+    """
+    if brackets is None: brackets = []
+    tokens = _MacroExpander(stateStruct, cpre2_parse_regex(stateStruct, input, raw=True))
+    for token, _ in tokens:
+        cls = token.__class__
+        if cls is CIdentifier:
+            name = token.content
+            if name == "__FILE__":
+                token = CStr(stateStruct.curFile())
+            elif name == "__LINE__":
+                token = CNumber(stateStruct.curLine())
+            elif name == "__func__":
+                token = CFuncName("")
+        elif cls is COpeningBracket:
+            c = token.content
+            yield COpeningBracket(c, brackets=list(brackets))
+            brackets.append(c)
+            continue
+        elif cls is CClosingBracket:
+            c = token.content
+            if len(brackets) == 0 or ClosingBrackets[len(OpeningBrackets) - OpeningBrackets.index(brackets[-1]) - 1] != c:
+                stateStruct.error("cpre2 parse: got '" + c + "' but bracket level was " + str(brackets))
+            else:
+                brackets[:] = brackets[:-1]
+                yield CClosingBracket(c, brackets=list(brackets))
+            continue
+        elif cls is COp and token.content[0] == "#":
+            for c in token.content:
+                stateStruct.error("cpre2 parse: didn't expected char %r in state %i" % (c, 0))
+            continue
+        yield token
+
+
 def cpre2_tokenstream_asCCode(input):
     needspace = False
     wantnewline = False
@@ -3466,7 +4617,7 @@ def getObjInBody(body, name):
     # which TU is currently parsing).  Only applies when ``body`` is
     # the State itself -- nested function/struct bodies have their
     # own real lexical scope already.
-    if isinstance(body, State):
+    if not isinstance(body, CBody):  # State or caching.StateWrapper
         local = body._tu_local_lookup
         if local is not None:
             obj = local.get(name)
@@ -3488,7 +4639,7 @@ def getObjInBody(body, name):
 
 def findObjInNamespace(stateStruct, curCObj, name):
     for cobj in _obj_parent_chain(stateStruct, curCObj):
-        if isinstance(cobj.body, (CBody,State)):
+        if isinstance(cobj.body, (CBody,State)) or cobj.body is stateStruct:
             obj = getObjInBody(cobj.body, name)
             if obj is not None: return obj
         if isinstance(cobj, CFunc):
@@ -5790,10 +6941,27 @@ def cpre3_parse(stateStruct, input):
     cpre3_parse_body(stateStruct, parentObj, input_iter)
 
 
-def parse(filename, state=None):
+def _cpre2_parse_preprocessed(state, preprocessed_chunks):
+    """
+    :param State state:
+    :param typing.Iterable[str] preprocessed_chunks: via State.preprocess_chunks() or so
+    :returns token iterator, like cpre2_parse()
+    """
+    if state.ChunkedPreprocess:
+        return cpre2_parse(state, _Pre2ParseStream(preprocessed_chunks, chunked=True))
+    # Chunks are single chars in this case.
+    return cpre2_parse(state, preprocessed_chunks)
+
+
+def parse(filename, state=None, chunked=None, cache=False):
     """
     :param str filename:
     :param State|None state:
+    :param bool|None chunked: selects the preprocess -> tokenize pipeline.
+      If True, the preprocessor works on whole slices (see cpreprocess_parse_chunks())
+      and hands str chunks to the tokenizer instead of single chars.
+      None means State.ChunkedPreprocess.
+    :param bool cache: use the on-disk cache for included files. see caching.py
     :rtype: State
     """
     if state is None:
@@ -5803,35 +6971,50 @@ def parse(filename, state=None):
     prev_tracker = state._tu_changed_decls
     prev_orphans = state._tu_orphans
     prev_lookup = state._tu_local_lookup
+    prev_chunked = state.ChunkedPreprocess
+    if chunked is not None:
+        state.ChunkedPreprocess = chunked
     state._tu_changed_decls = []
     state._tu_orphans = []
     state._tu_local_lookup = {}
+    parse_state = state
+    if cache:
+        from . import caching
+        parse_state = caching.StateWrapper(state)
     try:
-        preprocessed = state.preprocess_file(filename, local=True)
-        tokens = cpre2_parse(state, preprocessed)
-        cpre3_parse(state, tokens)
+        preprocessed = parse_state.preprocess_file_chunks(filename, local=True)
+        tokens = _cpre2_parse_preprocessed(parse_state, preprocessed)
+        cpre3_parse(parse_state, tokens)
         _rename_tu_statics(state, filename, _scope_prefix_from_filename(filename))
     finally:
+        if cache:
+            parse_state.cache_flush()
         state._tu_changed_decls = prev_tracker
         state._tu_orphans = prev_orphans
         state._tu_local_lookup = prev_lookup
+        if chunked is not None:
+            state.ChunkedPreprocess = prev_chunked
 
     return state
 
 
-def parse_code(source_code, state=None):
+def parse_code(source_code, state=None, chunked=None):
     """
     :param str source_code:
     :param State|None state:
+    :param bool|None chunked: selects the pipeline. see parse()
     :rtype: State
     """
     if state is None:
         state = State()
         state.autoSetupSystemMacros()
 
+    prev_chunked = state.ChunkedPreprocess
+    if chunked is not None:
+        state.ChunkedPreprocess = chunked
     try:
-        preprocessed = state.preprocess_source_code(source_code)
-        tokens = cpre2_parse(state, preprocessed)
+        preprocessed = state.preprocess_source_code_chunks(source_code)
+        tokens = _cpre2_parse_preprocessed(state, preprocessed)
         cpre3_parse(state, tokens)
     except Exception as e:
         state.error("internal exception: %r" % e)
@@ -5839,6 +7022,9 @@ def parse_code(source_code, state=None):
         for s in state._errors:
             print(s)
         raise
+    finally:
+        if chunked is not None:
+            state.ChunkedPreprocess = prev_chunked
 
     return state
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the preprocess -> tokenize pipeline (cpre1 + cpre2),
+in the per-char mode, in the chunked mode (see cparser.parse(chunked=...)),
+and in the chunked mode with the regex tokenizer (State.RegexTokenizer)
+and with the token-based macro substitution (State.TokenMacroExpansion).
+Reports chars/sec of input source code.
+
+Usage: benchmark_parse.py [file.c ...] [--repeat N]
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+import argparse
+
+import cparser
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def tokenize(source_code, chunked, regex_tokenizer, token_macro_expansion):
+    """
+    :param str source_code:
+    :param bool chunked:
+    :param bool regex_tokenizer:
+    :param bool token_macro_expansion:
+    :return: number of tokens
+    :rtype: int
+    """
+    state = cparser.State()
+    state.autoSetupSystemMacros()
+    state.ChunkedPreprocess = chunked
+    state.RegexTokenizer = regex_tokenizer
+    state.TokenMacroExpansion = token_macro_expansion
+    preprocessed = state.preprocess_source_code_chunks(source_code)
+    n = 0
+    for _ in cparser.cparser._cpre2_parse_preprocessed(state, preprocessed):
+        n += 1
+    return n
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("files", nargs="*", default=[MyDir + "/../tests/ffmpeg-test.c"])
+    arg_parser.add_argument("--repeat", type=int, default=20)
+    args = arg_parser.parse_args()
+
+    source_code = "".join([open(fn).read() for fn in args.files]) * args.repeat
+    print("input: %i chars" % len(source_code))
+    modes = [(False, False, False), (True, False, False), (True, True, False), (True, True, True)]
+    for chunked, regex_tokenizer, token_macro_expansion in modes:
+        start = time.time()
+        num_tokens = tokenize(
+            source_code, chunked=chunked, regex_tokenizer=regex_tokenizer,
+            token_macro_expansion=token_macro_expansion)
+        duration = time.time() - start
+        print("chunked=%s, regex_tokenizer=%s, token_macro_expansion=%s: %i tokens, %.3f sec, %.0f chars/sec" % (
+            chunked, regex_tokenizer, token_macro_expansion, num_tokens, duration, len(source_code) / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -236,7 +236,7 @@ class _HandleGoto:
         reset_ast.value = ast.Name(id="None", ctx=ast.Load())
         test_ast = ast.Compare()
         test_ast.ops = [ast.Eq()]
-        test_ast.left = ast.Name(id=self.gotoVarName, ctx=ast.Store())
+        test_ast.left = ast.Name(id=self.gotoVarName, ctx=ast.Load())
         test_ast.comparators = [_ast_for_value(stmnt.label)]
         return [ast.If(test=test_ast, body=[reset_ast], orelse=[])]
 
@@ -273,7 +273,7 @@ class _HandleGoto:
                         sr += [s]
                 test_ast = ast.Compare()
                 test_ast.ops = [ast.Is()]
-                test_ast.left = ast.Name(id=self.gotoVarName, ctx=ast.Store())
+                test_ast.left = ast.Name(id=self.gotoVarName, ctx=ast.Load())
                 test_ast.comparators = [ast.Name(id="None", ctx=ast.Load())]
                 r += [ast.If(test=test_ast, body=sr, orelse=[])]
         return r
@@ -289,10 +289,236 @@ class _HandleGoto:
         return [var_ast, main_loop_ast]
 
 
+# The flattening above makes every statement of the function pay for the
+# goto dispatch. Most C gotos are however well-structured:
+# - forward jumps to a later label in the same or in an enclosing block,
+#   e.g. the common `goto error;` / `goto cleanup;` idiom,
+# - backward jumps to an earlier label, forming a loop.
+# We try to lower those first into plain loop constructs:
+# - For a label with forward jumps, everything before the label
+#   (in its block) goes into a `while True: ...; break` block,
+#   and the goto becomes a `break` out of it.
+# - For a label with backward jumps, everything from the label up to
+#   the last statement containing such a jump goes into a
+#   `while True: ...; break` block, and the goto becomes a `continue`.
+# If the goto is inside some other loop within such a block, we set the
+# goto var to a token, break out, and after each loop we check the goto var
+# to either finish the jump or to propagate it further outwards.
+# The same is done for a `break`/`continue` of some C loop which now
+# has one of our blocks in between.
+# Only if some goto jumps into a block (i.e. the label is not in an
+# enclosing block of the goto), we fall back to the flattening.
+
+class _IrreducibleGoto(Exception):
+    pass
+
+
+class _LabelBlock:
+    """
+    The code before the label `label`, where a goto to the label is a `break`.
+    """
+    action = "break"
+
+    def __init__(self, label, body):
+        self.label = label
+        self.body = body
+
+
+class _LabelLoop:
+    """
+    The code after the label `label`, where a goto to the label is a `continue`.
+    """
+    action = "continue"
+
+    def __init__(self, label, body):
+        self.label = label
+        self.body = body
+
+
+def _contains_goto(s, label):
+    if isinstance(s, GotoStatement):
+        return s.label == label
+    if isinstance(s, (_LabelBlock, _LabelLoop, GotoLabel)):
+        return any([_contains_goto(s_, label) for s_ in getattr(s, "body", [])])
+    if isinstance(s, ast.AST):
+        for field in ("body", "orelse"):
+            if any([_contains_goto(s_, label) for s_ in getattr(s, field, None) or []]):
+                return True
+    return False
+
+
+def _structure(body):
+    """
+    :param list[ast.AST|GotoLabel|GotoStatement] body:
+    :return: body with all goto labels replaced by _LabelBlock/_LabelLoop
+    :rtype: list
+    """
+    labels = [i for (i, s) in enumerate(body) if isinstance(s, GotoLabel)]
+    if not labels:
+        return [_structure_stmnt(s) for s in body]
+    j = labels[-1]
+    label = body[j].label
+    pre, post = body[:j], body[j + 1:]
+    r = _structure(pre)
+    if any([_contains_goto(s, label) for s in pre]):
+        r = [_LabelBlock(label, r)]
+    back = [k for (k, s) in enumerate(post) if _contains_goto(s, label)]
+    if back:
+        k = back[-1]
+        r += [_LabelLoop(label, _structure(post[:k + 1]))]
+        post = post[k + 1:]
+    return r + _structure(post)
+
+
+def _structure_stmnt(s):
+    if isinstance(s, (ast.If, ast.While, ast.For)):
+        s_ = ast.copy_location(s.__class__(**dict(ast.iter_fields(s))), s)
+        s_.body = _structure(s.body)
+        s_.orelse = _structure(s.orelse)
+        return s_
+    if isinstance(s, (ast.TryExcept, ast.TryFinally) if PY2 else ast.Try):
+        raise _IrreducibleGoto("try-statement")
+    return s
+
+
+class _EmitStructured:
+    """
+    Translates the output of :func:`_structure` into plain Python AST.
+    """
+
+    def __init__(self, gotoVarName):
+        self.gotoVarName = gotoVarName
+        self.tokens = {}  # (id(loop), action) -> goto var value
+        self.usedVar = False
+
+    def _token(self, target):
+        self.usedVar = True
+        return self.tokens.setdefault((id(target[0]), target[1]), len(self.tokens) + 1)
+
+    def _var(self, ctx):
+        return ast.Name(id=self.gotoVarName, ctx=ctx())
+
+    def _set_var(self, value):
+        return ast.Assign(targets=[self._var(ast.Store)], value=value)
+
+    def _jump(self, target, loops):
+        """
+        :param (object,str) target: (loop, "break"|"continue")
+        :param list loops: enclosing loops, innermost last
+        :return: statements, escaping targets
+        """
+        if not loops:
+            raise _IrreducibleGoto("jump outside of any loop")
+        loop, action = target
+        if loops[-1] is loop:
+            return [ast.Break() if action == "break" else ast.Continue()], []
+        return [self._set_var(_ast_for_value(self._token(target))), ast.Break()], [target]
+
+    def _after_loop(self, escapes, loops):
+        """
+        :param list escapes: targets which broke out of the loop we have just left
+        :param list loops: loops enclosing that loop, innermost last
+        :return: statements, escaping targets
+        """
+        if not escapes:
+            return [], []
+        if not loops:
+            raise _IrreducibleGoto("jump outside of any loop")
+        here = [t for t in escapes if t[0] is loops[-1]]
+        outer = [t for t in escapes if t[0] is not loops[-1]]
+        reset_ast = self._set_var(ast.Name(id="None", ctx=ast.Load()))
+        body = []
+        if len(here) == 1 and not outer:
+            body = [reset_ast, ast.Break() if here[0][1] == "break" else ast.Continue()]
+        else:
+            for t in here:
+                test_ast = ast.Compare(
+                    left=self._var(ast.Load), ops=[ast.Eq()], comparators=[_ast_for_value(self._token(t))])
+                body += [ast.If(test=test_ast, orelse=[], body=[
+                    reset_ast, ast.Break() if t[1] == "break" else ast.Continue()])]
+            if outer:
+                body += [ast.Break()]
+        test_ast = ast.Compare(
+            left=self._var(ast.Load), ops=[ast.IsNot()], comparators=[ast.Name(id="None", ctx=ast.Load())])
+        return [ast.If(test=test_ast, body=body, orelse=[])], outer
+
+    def _c_loop(self, loops):
+        for loop in reversed(loops):
+            if not isinstance(loop, (_LabelBlock, _LabelLoop)):
+                return loop
+        raise _IrreducibleGoto("break/continue outside of any loop")
+
+    def emit(self, body, loops):
+        """
+        :param list body: output of :func:`_structure`
+        :param list loops: enclosing loops, innermost last
+        :return: statements, escaping targets
+        :rtype: (list[ast.AST], list)
+        """
+        r = []
+        escapes = []
+        def add_escapes(ts):
+            for t in ts:
+                if not [t_ for t_ in escapes if t_[0] is t[0] and t_[1] == t[1]]:
+                    escapes.append(t)
+        for s in body:
+            if isinstance(s, GotoStatement):
+                for loop in reversed(loops):
+                    if isinstance(loop, (_LabelBlock, _LabelLoop)) and loop.label == s.label:
+                        break
+                else:
+                    raise _IrreducibleGoto("goto %r into some block" % s.label)
+                stmnts, ts = self._jump((loop, loop.action), loops)
+            elif isinstance(s, ast.Break):
+                stmnts, ts = self._jump((self._c_loop(loops), "break"), loops)
+            elif isinstance(s, ast.Continue):
+                stmnts, ts = self._jump((self._c_loop(loops), "continue"), loops)
+            elif isinstance(s, (_LabelBlock, _LabelLoop)):
+                loop_body, inner = self.emit(s.body, loops + [s])
+                loop_ast = ast.While(test=ast.Name(id="True", ctx=ast.Load()), orelse=[],
+                                     body=loop_body + [ast.Break()])
+                stmnts, ts = self._after_loop(inner, loops)
+                stmnts = [loop_ast] + stmnts
+            elif isinstance(s, (ast.While, ast.For)):
+                if s.orelse: raise _IrreducibleGoto("loop with else")
+                loop_body, inner = self.emit(s.body, loops + [s])
+                loop_ast = ast.copy_location(s.__class__(**dict(ast.iter_fields(s))), s)
+                loop_ast.body = loop_body
+                stmnts, ts = self._after_loop(inner, loops)
+                stmnts = [loop_ast] + stmnts
+            elif isinstance(s, ast.If):
+                if_body, ts = self.emit(s.body, loops)
+                if_orelse, ts_ = self.emit(s.orelse, loops)
+                stmnts = [ast.copy_location(ast.If(test=s.test, body=if_body or [ast.Pass()], orelse=if_orelse), s)]
+                ts = ts + ts_
+            else:
+                stmnts, ts = [s], []
+            r += stmnts
+            add_escapes(ts)
+        return r, escapes
+
+
+def _transform_goto_structured(body, gotoVarName):
+    """
+    :param list body: function body with GotoLabel/GotoStatement markers
+    :return: new function body. raises _IrreducibleGoto if not possible.
+    :rtype: list[ast.AST]
+    """
+    emitter = _EmitStructured(gotoVarName)
+    new_body, escapes = emitter.emit(_structure(body), [])
+    assert not escapes
+    if emitter.usedVar:
+        new_body = [emitter._set_var(ast.Name(id="None", ctx=ast.Load()))] + new_body
+    return new_body
+
+
 def transform_goto(f, gotoVarName):
     assert isinstance(f, ast.FunctionDef)
-    flat_body = _Flatten().flatten(f.body)
-    new_body = _HandleGoto(gotoVarName).wrap_func_body(flat_body)
+    try:
+        new_body = _transform_goto_structured(f.body, gotoVarName)
+    except _IrreducibleGoto:
+        flat_body = _Flatten().flatten(f.body)
+        new_body = _HandleGoto(gotoVarName).wrap_func_body(flat_body)
     new_func_ast = ast.FunctionDef(
         name=f.name,
         args=f.args,
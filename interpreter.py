@@ -239,14 +239,7 @@ class GlobalScope:
 
 def evalValueAst(funcEnv, valueAst, srccode_name=None):
     if srccode_name is None: srccode_name = "<PyCParser_dynamic_eval>"
-    if False:  # directly via AST
-        valueExprAst = ast.Expression(valueAst)
-        ast.fix_missing_locations(valueExprAst)
-        valueCode = compile(valueExprAst, srccode_name, "eval")
-    else:
-        src = _unparse(valueAst)
-        _set_linecache(srccode_name, src)
-        valueCode = compile(src, srccode_name, "eval")
+    valueCode, _ = _compile_ast(valueAst, srccode_name, "eval", directly=funcEnv.interpreter.compile_ast_directly)
     v = eval(valueCode, funcEnv.interpreter.globalsDict)
     return v
 
@@ -319,10 +312,15 @@ class FuncEnv:
         self.interpreter = globalScope.interpreter
         self.vars = {} # name -> varDecl
         self.varNames = {} # id(varDecl) -> name
+        self.rawVars = {} # id(varDecl) -> kind, see Interpreter.raw_local_vars
         self.localTypes = {} # type -> var-name
         self.localTypeNames = {} # (type-class, name) -> var-name
         self.scopeStack = []  # type: typing.List[FuncCodeblockScope]
         self.needGotoHandling = False
+        self.funcPtrCallSiteCount = 0
+        self.inlineStack = []  # CFunc, see _getAstNode_inlineCall
+        self.funcScan = None  # _CVarWritesScan of the whole function, see _cForLoopVar
+        self.rawArgs = False  # whether the params are passed as plain values, see _directCallRawArgs
         self.astNode = ast.FunctionDef(
             args=ast.arguments(args=[], vararg=None, kwarg=None, defaults=[]),
             body=[], decorator_list=[])
@@ -397,6 +395,10 @@ class FuncEnv:
             # local var
             name = self.varNames[id(varDecl)]
             assert name is not None
+            if id(varDecl) in self.rawVars:
+                nameAst = ast.Name(id=name, ctx=ast.Load())
+                nameAst.c_is_int = self.rawVars[id(varDecl)] not in (float, FatPtr)
+                return _makeRawVarObj(self, varDecl, nameAst)
             return ast.Name(id=name, ctx=ast.Load())
         # we expect this is a global
         name = self.globalScope.findName(varDecl)
@@ -600,6 +602,9 @@ def makeCastToVoidP_value(v):
 
 
 def getAstNode_valueFromObj(stateStruct, objAst, objType, isPartOfCOp=False):
+    rawValueAst = getattr(objAst, "c_raw_value", None)
+    if rawValueAst is not None:
+        return rawValueAst
     if isPartOfCOp:  # usually ==, != or so.
         # Some types need special handling. We cast them to integer.
         if isinstance(objType, CFuncPointerDecl):
@@ -1102,6 +1107,11 @@ class FuncCodeblockScope:
         a.targets = [ast.Name(id=varName, ctx=ast.Store())]
         if varDecl is None:
             a.value = ast.Name(id="None", ctx=ast.Load())
+        elif id(varDecl) in self.funcEnv.rawVars:
+            a.value = self._rawVarInitValue(varName, varDecl)
+        elif isinstance(varDecl, CFuncArgDecl) and self.funcEnv.rawArgs:
+            # The plain value, already of the param type.
+            a.value = getAstNode_newTypeInstance(self.funcEnv, varDecl.type, ast.Name(id=varName, ctx=ast.Load()))
         elif isinstance(varDecl, CFuncArgDecl):
             # Note: We just assume that the parameter has the correct/same type.
             a.value = getAstNode_newTypeInstance(self.funcEnv, varDecl.type, ast.Name(id=varName, ctx=ast.Load()), varDecl.type)
@@ -1125,6 +1135,26 @@ class FuncCodeblockScope:
             a.value = makeAstNodeCall(getAstNodeAttrib("helpers", "logAssign"), ast.Str(varName), a.value)
         self.body.append(a)
         return varName
+    def _rawVarInitValue(self, varName, varDecl):
+        kind = self.funcEnv.rawVars[id(varDecl)]
+        stateStruct = self.funcEnv.globalScope.stateStruct
+        if kind is FatPtr:
+            if isinstance(varDecl, CFuncArgDecl):
+                valueAst, t = ast.Name(id=varName, ctx=ast.Load()), varDecl.type
+            elif varDecl.body is not None and getConstValue(stateStruct, varDecl.body) != 0:
+                valueAst, t = astAndTypeForStatement(self.funcEnv, varDecl.body)
+            else:
+                valueAst, t = ast.Num(n=0), None
+            return _getAstNode_fatValue(self.funcEnv, valueAst, t, varDecl.type)
+        if isinstance(varDecl, CFuncArgDecl):
+            if self.funcEnv.rawArgs:
+                return _getAstNode_rawValue(kind, ast.Name(id=varName, ctx=ast.Load()), valueKind=kind)
+            return _getAstNode_rawValue(kind, getAstNodeAttrib(ast.Name(id=varName, ctx=ast.Load()), "value"))
+        if varDecl.body is not None and getConstValue(stateStruct, varDecl.body) != 0:
+            bodyAst, t = astAndTypeForStatement(self.funcEnv, varDecl.body)
+            valueAst = getAstNode_valueFromObj(stateStruct, bodyAst, t)
+            return _getAstNode_rawValue(kind, valueAst, valueKind=_rawVarKind(stateStruct, t))
+        return ast.Num(n=0.0 if kind is float else 0)
     def _astForDeleteVar(self, varName):
         assert varName is not None
         return ast.Delete(targets=[ast.Name(id=varName, ctx=ast.Del())])
@@ -1179,6 +1209,7 @@ class Helpers:
     def __init__(self, interpreter):
         self.interpreter = interpreter
         self._fam_specialization_cache = {}
+        self.funcPtrCallSites = {}  # call site id -> func ptr addr -> target, see cachedFuncPtrCall
 
     def _checkAborted(self):
         if self.interpreter.aborted:
@@ -1432,6 +1463,149 @@ class Helpers:
         assert op in ("+","-")
         return self.augAssignPtr(self.copy(a), op + "=", bValue)
 
+    def fatPtr(self, b, t):
+        """
+        :param FatPtr|ctypes._Pointer|ctypes.Array|int b: pointer value
+        :param type t: element ctype
+        :rtype: FatPtr
+        """
+        if isinstance(b, FatPtr):
+            if b.type is not t:
+                b = FatPtr(b.base, b.offset, t)
+            return b
+        if isinstance(b, ctypes.Array):
+            return FatPtr(b, 0, t)
+        if isinstance(b, (ctypes._Pointer, ctypes._CFuncPtr, ctypes.c_void_p, ctypes.c_char_p)):
+            if not _ctype_ptr_get_value(b):
+                return FatPtr(None, 0, t)
+            # The contents keep `b` alive, and thus all the objects `b` references.
+            return FatPtr(ctypes.cast(b, ctypes.POINTER(t)).contents, 0, t)
+        if isinstance(b, ctypes._SimpleCData):
+            b = b.value
+        return FatPtr(None, b or 0, t)
+
+    def fatPtrToCtypes(self, p, ptrType):
+        """
+        The pointer escapes, e.g. to a function call or to memory, thus we need a real ctypes pointer,
+        registered via Interpreter._storePtr.
+        :param FatPtr p:
+        :param type ptrType: ctypes pointer type
+        """
+        if p.base is None:
+            return ctypes.cast(p.offset, ptrType)
+        ptr = ctypes.cast(ctypes.pointer(p.base), ptrType)
+        if p.offset:
+            _ctype_ptr_set_value(ptr, p.addr())
+        return self.interpreter._storePtr(ptr, offset=p.offset)
+
+    def _bulkAddr(self, obj, start, count, elemSize):
+        """
+        See Interpreter.loop_idioms.
+        :param ctypes.Array|ctypes._Pointer|FatPtr obj:
+        :param int start: index of the first element
+        :param int count: number of elements
+        :param int elemSize:
+        :return: address of the element `start`, or None if it is NULL or out of the bounds of the array
+        :rtype: int|None
+        """
+        if isinstance(obj, FatPtr):
+            addr = obj.addr()
+        elif isinstance(obj, ctypes.Array):
+            if start < 0 or (start + count) * elemSize > ctypes.sizeof(obj):
+                return None
+            addr = ctypes.addressof(obj)
+        else:
+            addr = _ctype_ptr_get_value(obj)
+        if not addr:
+            return None
+        return addr + start * elemSize
+
+    def bulkCopy(self, dst, dstOffset, src, srcOffset, r, elemSize):
+        """
+        The loop ``for (i in r) dst[i + dstOffset] = src[i + srcOffset];``, see Interpreter.loop_idioms.
+        :param ctypes.Array|ctypes._Pointer|FatPtr dst:
+        :param int dstOffset:
+        :param ctypes.Array|ctypes._Pointer|FatPtr src:
+        :param int srcOffset:
+        :param range r: with step 1
+        :param int elemSize:
+        :return: the value of `i` after the loop, or None if the loop needs to run element-wise
+        :rtype: int|None
+        """
+        if not r:
+            return r.start
+        dstAddr = self._bulkAddr(dst, r.start + dstOffset, len(r), elemSize)
+        srcAddr = self._bulkAddr(src, r.start + srcOffset, len(r), elemSize)
+        if dstAddr is None or srcAddr is None:
+            return None
+        size = len(r) * elemSize
+        if srcAddr < dstAddr < srcAddr + size:
+            return None  # the element-wise copy would repeat the overlapping part
+        ctypes.memmove(dstAddr, srcAddr, size)
+        return r.stop
+
+    def bulkFill(self, dst, dstOffset, r, elemSize, value):
+        """
+        The loop ``for (i in r) dst[i + dstOffset] = value;``, see Interpreter.loop_idioms.
+        :param ctypes.Array|ctypes._Pointer|FatPtr dst:
+        :param int dstOffset:
+        :param range r: with step 1
+        :param int elemSize:
+        :param int|float value:
+        :return: the value of `i` after the loop, or None if the loop needs to run element-wise
+        :rtype: int|None
+        """
+        if not r:
+            return r.start
+        if value != 0 and elemSize != 1:
+            return None
+        dstAddr = self._bulkAddr(dst, r.start + dstOffset, len(r), elemSize)
+        if dstAddr is None:
+            return None
+        ctypes.memset(dstAddr, int(value) & 0xff, len(r) * elemSize)
+        return r.stop
+
+    def bulkCompare(self, a, aOffset, b, bOffset, r, elemSize):
+        """
+        The loop ``for (i in r) if (a[i + aOffset] != b[i + bOffset]) break;``, see Interpreter.loop_idioms.
+        :param ctypes.Array|ctypes._Pointer|FatPtr a:
+        :param int aOffset:
+        :param ctypes.Array|ctypes._Pointer|FatPtr b:
+        :param int bOffset:
+        :param range r: with step 1
+        :param int elemSize:
+        :return: the value of `i` after the loop, or None if the loop needs to run element-wise
+        :rtype: int|None
+        """
+        if not r:
+            return r.start
+        aAddr = self._bulkAddr(a, r.start + aOffset, len(r), elemSize)
+        bAddr = self._bulkAddr(b, r.start + bOffset, len(r), elemSize)
+        if aAddr is None or bAddr is None:
+            return None
+        size = len(r) * elemSize
+        x = ctypes.string_at(aAddr, size)
+        y = ctypes.string_at(bAddr, size)
+        if x == y:
+            return r.stop
+        for idx, (c1, c2) in enumerate(zip(x, y)):
+            if c1 != c2:
+                return r.start + idx // elemSize
+
+    def bulkStrlen(self, s, offset, start):
+        """
+        The loop ``for (i = start; s[i + offset]; i++);`` over bytes, see Interpreter.loop_idioms.
+        :param ctypes.Array|ctypes._Pointer|FatPtr s:
+        :param int offset:
+        :param int start:
+        :return: the value of `i` after the loop
+        :rtype: int
+        """
+        addr = self._bulkAddr(s, start + offset, 0, 1)
+        if addr is None:
+            raise ValueError("NULL pointer access")  # like ctypes
+        return start + len(ctypes.string_at(addr))
+
     def fixReturnType(self, t):
         # Note: This behavior must match CFuncPointerDecl.getCType()
         # so that we stay compatible.
@@ -1494,35 +1668,78 @@ class Helpers:
         #  - It avoids the ctypes arg-marshalling round-trip.
         # If the pointer is anything else (real libc, an unregistered
         # address, etc.), fall back to the normal ctypes call.
-        obj = self.interpreter.pointerStorage.get(addr)
-        if isinstance(obj, PointerStorage):
-            py_func = obj.valueRef()
-            if py_func is not None and inspect.isfunction(py_func):
-                # Truncate `args` to the Python function's actual declared
-                # argument count.  Real C ignores extra args via the
-                # calling convention (e.g. METH_NOARGS calls a 1-arg
-                # `dictitems_new(PyObject*)` as `meth(self, NULL)`), and
-                # we must do the same -- otherwise the Python function
-                # raises ``TypeError: takes N positional arguments but M
-                # were given``.
-                py_argtypes = getattr(py_func, "C_argTypes", None)
-                if py_argtypes is not None and len(args) > len(py_argtypes):
-                    args = args[:len(py_argtypes)]
-                result = py_func(*args)
-                # The ctypes callback path would have wrapped the Python
-                # return value in the CFUNCTYPE's `restype`, so callers
-                # uniformly read `.value` on the result.  Match that
-                # behaviour for the direct call: wrap a raw Python
-                # int/float in `restype` if it isn't already a ctype.
-                restype = getattr(type(f), "_restype_", None)
-                if restype is not None and not isinstance(result, restype):
-                    if result is None:
-                        result = restype()
-                    else:
-                        result = restype(result)
-                return result
+        target = self._funcPtrCallTarget(f, addr)
+        if target is not None:
+            return self._callFuncPtrTarget(target, args)
         return f(*args)
 
+    def _funcPtrCallTarget(self, f, addr):
+        """
+        :param ctypes._CFuncPtr f:
+        :param int addr: address of `f`
+        :return: (Python function, max number of args or None, return type or None),
+          or None if `f` does not point to one of our own Python functions
+        :rtype: (function,int|None,type|None)|None
+        """
+        obj = self.interpreter.pointerStorage.get(addr)
+        if not isinstance(obj, PointerStorage):
+            return None
+        py_func = obj.valueRef()
+        if py_func is None or not inspect.isfunction(py_func):
+            return None
+        # Truncate `args` to the Python function's actual declared
+        # argument count.  Real C ignores extra args via the
+        # calling convention (e.g. METH_NOARGS calls a 1-arg
+        # `dictitems_new(PyObject*)` as `meth(self, NULL)`), and
+        # we must do the same -- otherwise the Python function
+        # raises ``TypeError: takes N positional arguments but M
+        # were given``.
+        py_argtypes = getattr(py_func, "C_argTypes", None)
+        # The ctypes callback path would have wrapped the Python
+        # return value in the CFUNCTYPE's `restype`, so callers
+        # uniformly read `.value` on the result.  Match that
+        # behaviour for the direct call: wrap a raw Python
+        # int/float in `restype` if it isn't already a ctype.
+        restype = getattr(type(f), "_restype_", None)
+        return py_func, len(py_argtypes) if py_argtypes is not None else None, restype
+
+    def _callFuncPtrTarget(self, target, args):
+        py_func, numArgs, restype = target
+        if numArgs is not None and len(args) > numArgs:
+            args = args[:numArgs]
+        result = py_func(*args)
+        if restype is not None and not isinstance(result, restype):
+            if result is None:
+                result = restype()
+            else:
+                result = restype(result)
+        return result
+
+    def cachedFuncPtrCall(self, site, f, *args):
+        """
+        Like :func:`checkedFuncPtrCall`, with an inline cache for the call site `site`,
+        see Interpreter.func_ptr_inline_cache.
+        Per func ptr address, the cache remembers the result of :func:`_funcPtrCallTarget`.
+        On a hit, we directly call the Python function.
+
+        :param str site: call site id
+        :param ctypes._CFuncPtr f:
+        """
+        entries = self.funcPtrCallSites.get(site)
+        if entries is None:
+            entries = self.funcPtrCallSites[site] = {}
+        addr = ctypes.c_void_p.from_buffer(f).value
+        target = entries.get(addr)
+        if target is None:
+            if not addr:
+                raise Exception("checkedFuncPtrCall: tried to call NULL ptr")
+            target = self._funcPtrCallTarget(f, addr)
+            if target is None:
+                # Not our own function. We don't cache this.
+                return self.checkedFuncPtrCall(f, *args)
+            entries[addr] = target
+        return self._callFuncPtrTarget(target, args)
+
     class VarArgs:
         """
         Explicit wrapping of variadic args. (tuple of args)
@@ -1730,9 +1947,18 @@ def astAndTypeForStatement(funcEnv, stmnt):
     elif isinstance(stmnt, CFuncCall):
         if isinstance(stmnt.base, CFunc):
             assert stmnt.base.name is not None
-            a = ast.Call(keywords=[], starargs=None, kwargs=None)
-            a.func = getAstNodeAttrib("g", stmnt.base.name)
-            a.args = autoCastArgs(funcEnv, [f_arg.type for f_arg in stmnt.base.args], stmnt.args)
+            argsAst = autoCastArgs(funcEnv, [f_arg.type for f_arg in stmnt.base.args], stmnt.args)
+            a = _getAstNode_inlineCall(funcEnv, stmnt.base, argsAst)
+            if a is None:
+                a = ast.Call(keywords=[], starargs=None, kwargs=None)
+                a.func = getAstNodeAttrib("g", stmnt.base.name)
+                a.func.c_direct_call = True  # see _DirectCallLinker
+                a.args = argsAst
+                if _directCallRawArgs(funcEnv.interpreter, stmnt.base):
+                    stateStruct = funcEnv.globalScope.stateStruct
+                    a.func.c_direct_call = "raw"
+                    a.args = [getAstNode_valueFromObj(stateStruct, argAst, f_arg.type)
+                              for (argAst, f_arg) in zip(argsAst, stmnt.base.args)]
             if stmnt.base.type in (CBuiltinType(("void",)), CVoidType()):
                 b = a  # Will (should) be ignored anyway. Should be None.
             else:
@@ -1868,10 +2094,18 @@ def astAndTypeForStatement(funcEnv, stmnt):
                 return getAstNode_newTypeInstance(funcEnv, rettype, a), rettype
             if not isinstance(pType, CFuncPointerDecl):
                 raise Exception("Func ptr call: base %r is not a func ptr, got %r" % (stmnt.base, pType))
-            a = makeAstNodeCall(
-                Helpers.checkedFuncPtrCall,
-                pAst,
-                *autoCastArgs(funcEnv, pType.args, stmnt.args))
+            if funcEnv.interpreter.func_ptr_inline_cache:
+                siteAst = ast.Str(s="%s:%i" % (funcEnv.get_name(), funcEnv.funcPtrCallSiteCount))
+                funcEnv.funcPtrCallSiteCount += 1
+                a = makeAstNodeCall(
+                    Helpers.cachedFuncPtrCall,
+                    siteAst, pAst,
+                    *autoCastArgs(funcEnv, pType.args, stmnt.args))
+            else:
+                a = makeAstNodeCall(
+                    Helpers.checkedFuncPtrCall,
+                    pAst,
+                    *autoCastArgs(funcEnv, pType.args, stmnt.args))
             # See Helpers.fixReturnType. In some cases, we convert the return type to c_void_p.
             if isPointerType(pType.type, alsoArray=False) and not isVoidPtrType(pType.type):
                 fixedReturnType = ctypes.c_void_p
@@ -1918,9 +2152,16 @@ def astAndTypeForStatement(funcEnv, stmnt):
         assert False, "cannot handle " + str(stmnt)
 
 def getAstNode_assign(stateStruct, aAst, aType, bAst, bType):
+    if getattr(aAst, "c_fat_ptr", None) is not None and getattr(aAst, "c_raw_var", None):
+        funcEnv, varDecl = aAst.c_raw_var
+        return _getAstNode_rawVarAssign(aAst, _getAstNode_fatValue(funcEnv, bAst, bType, varDecl.type))
     if isPointerType(bType):
         bAst = makeAstNodeCall(getAstNodeAttrib("intp", "_storePtr"), bAst)
     bValueAst = getAstNode_valueFromObj(stateStruct, bAst, bType, isPartOfCOp=True)
+    if getattr(aAst, "c_raw_var", None):
+        funcEnv, varDecl = aAst.c_raw_var
+        kind = funcEnv.rawVars[id(varDecl)]
+        return _getAstNode_rawVarAssign(aAst, _getAstNode_rawValue(kind, bValueAst, valueKind=_rawVarKind(stateStruct, bType)))
     if isinstance(aType, CBitfieldType):
         # Bitfields must go through a helper because ctypes does not
         # support taking a pointer to a bitfield (which helpers.assign
@@ -1943,6 +2184,8 @@ def getAstNode_augAssign(stateStruct, aAst, aType, opStr, bAst, bType):
     if isPointerType(bType):
         bAst = makeAstNodeCall(getAstNodeAttrib("intp", "_storePtr"), bAst)
     bValueAst = getAstNode_valueFromObj(stateStruct, bAst, bType)
+    if getattr(aAst, "c_raw_var", None):
+        return _getAstNode_rawVarAugAssign(stateStruct, aAst, opStr, bValueAst, bType)
     if isinstance(aType, CBitfieldType):
         assert isinstance(aAst, ast.Attribute)
         return makeAstNodeCall(getAstNodeAttrib("helpers", "augAssignBitfield"), aAst.value, ast.Str(s=aAst.attr), opAst, bValueAst)
@@ -1951,6 +2194,8 @@ def getAstNode_augAssign(stateStruct, aAst, aType, opStr, bAst, bType):
     return makeAstNodeCall(Helpers.augAssign, aAst, opAst, bValueAst)
 
 def getAstNode_prefixInc(aAst, aType):
+    if getattr(aAst, "c_raw_var", None):
+        return _getAstNode_rawVarIncDec(aAst, ast.Add(), postfix=False)
     if isinstance(aType, CBitfieldType):
         assert isinstance(aAst, ast.Attribute)
         return makeAstNodeCall(getAstNodeAttrib("helpers", "prefixIncBitfield"), aAst.value, ast.Str(s=aAst.attr))
@@ -1959,6 +2204,8 @@ def getAstNode_prefixInc(aAst, aType):
     return makeAstNodeCall(Helpers.prefixInc, aAst)
 
 def getAstNode_prefixDec(aAst, aType):
+    if getattr(aAst, "c_raw_var", None):
+        return _getAstNode_rawVarIncDec(aAst, ast.Sub(), postfix=False)
     if isinstance(aType, CBitfieldType):
         assert isinstance(aAst, ast.Attribute)
         return makeAstNodeCall(getAstNodeAttrib("helpers", "prefixDecBitfield"), aAst.value, ast.Str(s=aAst.attr))
@@ -1967,6 +2214,8 @@ def getAstNode_prefixDec(aAst, aType):
     return makeAstNodeCall(Helpers.prefixDec, aAst)
 
 def getAstNode_postfixInc(aAst, aType):
+    if getattr(aAst, "c_raw_var", None):
+        return _getAstNode_rawVarIncDec(aAst, ast.Add(), postfix=True)
     if isinstance(aType, CBitfieldType):
         # Tricky in AST, but usually s->a++ is rare.
         # We'll use a lambda wrapper if needed, but for now let's just support it via a helper
@@ -1979,6 +2228,8 @@ def getAstNode_postfixInc(aAst, aType):
     return makeAstNodeCall(Helpers.postfixInc, aAst)
 
 def getAstNode_postfixDec(aAst, aType):
+    if getattr(aAst, "c_raw_var", None):
+        return _getAstNode_rawVarIncDec(aAst, ast.Sub(), postfix=True)
     if isinstance(aType, CBitfieldType):
         assert isinstance(aAst, ast.Attribute)
         return makeAstNodeCall(getAstNodeAttrib("helpers", "postfixDecBitfield"), aAst.value, ast.Str(s=aAst.attr))
@@ -1986,6 +2237,386 @@ def getAstNode_postfixDec(aAst, aType):
         return makeAstNodeCall(Helpers.postfixDecPtr, aAst)
     return makeAstNodeCall(Helpers.postfixDec, aAst)
 
+def getAstNode_intWrap(valueRange, valueAst):
+    """
+    Wraps the int `valueAst` around into `valueRange`, like assigning it to a ctypes int does.
+    :param tuple[int,int] valueRange: (min, max), see _CTYPES_INT_RANGES
+    :param ast.AST valueAst:
+    """
+    minValue, maxValue = valueRange
+    if minValue == 0:
+        valueAst = ast.BinOp(left=valueAst, op=ast.BitAnd(), right=ast.Num(n=maxValue))
+    else:
+        # ((v + offset) & mask) - offset
+        valueAst = ast.BinOp(left=valueAst, op=ast.Add(), right=ast.Num(n=-minValue))
+        valueAst = ast.BinOp(left=valueAst, op=ast.BitAnd(), right=ast.Num(n=maxValue - minValue))
+        valueAst = ast.BinOp(left=valueAst, op=ast.Sub(), right=ast.Num(n=-minValue))
+    valueAst.c_is_int = True
+    return valueAst
+
+def _rawVarKind(stateStruct, t):
+    """
+    :return: (min, max) for an int type, float for a double type, otherwise None.
+      See Interpreter.raw_local_vars.
+    """
+    from inspect import isclass
+    t = resolveTypedef(t)
+    if isinstance(t, CStdIntType) and t.name == "wchar_t":
+        return None
+    if isinstance(t, (CBuiltinType, CStdIntType)):
+        if not isIntType(t) and t.builtinType != ("double",):
+            return None
+        t = getCType(t, stateStruct)
+    if not isclass(t):
+        return None
+    for name, valueRange in sorted(_CTYPES_INT_RANGES.items()):
+        if issubclass(t, getattr(ctypes, name)):
+            return valueRange
+    if issubclass(t, ctypes.c_double):
+        return float
+    return None
+
+def _fatPtrKind(stateStruct, t):
+    """
+    :return: FatPtr if a local var of type `t` can be a FatPtr, otherwise None.
+      See Interpreter.fat_pointers.
+    """
+    from inspect import isclass
+    t = resolveTypedef(t)
+    if not isinstance(t, CPointerType) or usePyRefForType(t.pointerOf):
+        return None
+    t = getCType(t, stateStruct)
+    if not isclass(t) or not issubclass(t, ctypes._Pointer) or not ctypes.sizeof(t._type_):
+        return None
+    return FatPtr
+
+def _makeFatPtrObj(funcEnv, ptrType, fatAst):
+    """
+    :param FuncEnv funcEnv:
+    :param ptrType: C pointer type
+    :param ast.AST fatAst: FatPtr value
+    :return: ctypes pointer object. getAstNode_valueFromObj() uses the address of `fatAst` directly,
+      and deref and pointer arithmetic use `fatAst` (c_fat_ptr).
+    """
+    objAst = makeAstNodeCall(
+        getAstNodeAttrib("helpers", "fatPtrToCtypes"), fatAst, getAstNodeForVarType(funcEnv, ptrType))
+    objAst.c_fat_ptr = fatAst
+    objAst.c_raw_value = makeAstNodeCall(getAstNodeAttrib(fatAst, "addr"))
+    return objAst
+
+def _getAstNode_fatValue(funcEnv, valueAst, valueType, ptrType):
+    """
+    :param ast.AST valueAst: obj of type `valueType`, or 0 if valueType is None
+    :param ptrType: C pointer type of the result
+    :return: FatPtr value
+    """
+    stateStruct = funcEnv.globalScope.stateStruct
+    fatAst = getattr(valueAst, "c_fat_ptr", None)
+    if fatAst is not None and getCType(valueType, stateStruct) is getCType(ptrType, stateStruct):
+        return fatAst
+    elemTypeAst = getAstNodeAttrib(getAstNodeForVarType(funcEnv, ptrType), "_type_")
+    return makeAstNodeCall(getAstNodeAttrib("helpers", "fatPtr"), valueAst, elemTypeAst)
+
+def _findRawLocalVars(funcEnv, func):
+    """
+    Escape analysis for Interpreter.raw_local_vars and Interpreter.fat_pointers.
+    A local var or param can be kept as a plain Python value (or FatPtr) if its address is never taken
+    and it is not passed to a custom Python function, which could modify the object.
+    :param FuncEnv funcEnv:
+    :param CFunc func:
+    :return: id(varDecl) -> kind, see _rawVarKind and _fatPtrKind
+    :rtype: dict[int,tuple[int,int]|type]
+    """
+    stateStruct = funcEnv.globalScope.stateStruct
+    interpreter = funcEnv.globalScope.interpreter
+    candidates = {}
+    escaped = set()
+    visited = set()
+
+    def isLocal(decl):
+        while decl is not None:
+            if decl is func: return True
+            decl = decl.parent
+        return False
+
+    def addressTaken(obj):
+        if isinstance(obj, (CVarDecl, CFuncArgDecl)):
+            escaped.add(id(obj))
+        elif isinstance(obj, CStatement) and obj._op is None:
+            addressTaken(obj._leftexpr)
+        elif isinstance(obj, (CArrayIndexRef, CAttribAccessRef)):
+            addressTaken(obj.base)
+            visit(obj.args)
+        else:
+            # Not an lvalue we know about. Be conservative.
+            visit(obj, escaping=True)
+
+    def visit(obj, escaping=False):
+        if isinstance(obj, (list, tuple)):
+            for sub in obj:
+                visit(sub, escaping)
+        elif isinstance(obj, CBody):
+            visit(obj.contentlist, escaping)
+        elif isinstance(obj, (CVarDecl, CFuncArgDecl)):
+            if not isLocal(obj):
+                return
+            if escaping:
+                escaped.add(id(obj))
+            if id(obj) in visited:
+                return
+            visited.add(id(obj))
+            kind = None
+            if not set(obj.attribs) & set(["static", "extern"]) and not isinstance(obj.body, CCurlyArrayArgs):
+                if interpreter.raw_local_vars:
+                    kind = _rawVarKind(stateStruct, obj.type)
+                if kind is None and interpreter.fat_pointers:
+                    kind = _fatPtrKind(stateStruct, obj.type)
+            if kind is None:
+                escaped.add(id(obj))
+            else:
+                candidates[id(obj)] = kind
+            visit(obj.body)
+        elif isinstance(obj, CFunc):
+            return
+        elif isinstance(obj, CStatement):
+            if obj._leftexpr is None and obj._op is not None and obj._op.content == "&":
+                addressTaken(obj._rightexpr)
+            else:
+                visit(obj._rightexpr, escaping)
+            visit(obj._leftexpr, escaping)
+            visit(obj._middleexpr, escaping)
+        elif isinstance(obj, (CFuncCall, CArrayIndexRef, CAttribAccessRef, CPtrAccessRef)):
+            if isinstance(obj.base, CWrapValue) and not isinstance(obj.base.value, ctypes._CFuncPtr):
+                # A custom Python function gets the objects themselves, see astAndTypeForStatement.
+                for arg in obj.args:
+                    while isinstance(arg, CStatement) and arg._op is None:
+                        arg = arg._leftexpr
+                    if isinstance(arg, (CVarDecl, CFuncArgDecl)):
+                        escaped.add(id(arg))
+            visit(obj.base, escaping)
+            visit(obj.args, escaping)
+        elif isinstance(obj, cparser._CBaseWithOptBody):
+            visit(obj.args, escaping)
+            visit(obj.body, escaping)
+            visit(getattr(obj, "elsePart", None), escaping)
+            visit(getattr(obj, "whilePart", None), escaping)
+
+    visit(func.args)
+    visit(func.body)
+    return dict([(key, kind) for (key, kind) in candidates.items() if key not in escaped])
+
+def _cExprSize(obj, cfunc):
+    """
+    :param obj: C expression
+    :param CFunc cfunc: the function which `obj` belongs to
+    :return: number of nodes in `obj`, or None if `obj` calls `cfunc` (recursion)
+    :rtype: int|None
+    """
+    if obj is None:
+        return 0
+    if isinstance(obj, (list, tuple)):
+        subs = obj
+    elif isinstance(obj, CStatement):
+        subs = (obj._leftexpr, obj._middleexpr, obj._rightexpr)
+    elif isinstance(obj, (CFuncCall, CArrayIndexRef, CAttribAccessRef, CPtrAccessRef)):
+        subs = (obj.base, obj.args)
+    elif obj is cfunc:
+        return None
+    else:
+        return 1
+    size = 0 if isinstance(obj, (list, tuple)) else 1
+    for sub in subs:
+        subSize = _cExprSize(sub, cfunc)
+        if subSize is None:
+            return None
+        size += subSize
+    return size
+
+def _directCallRawArgs(interpreter, cfunc):
+    """
+    See Interpreter.direct_calls.
+    Direct calls of a translated function whose params are all ints or doubles
+    pass the plain Python values, not ctypes objects, to its raw entry
+    (see _DirectCallLinker), which saves the ctypes object per arg.
+    :param Interpreter interpreter:
+    :param CFunc cfunc: definition or predeclaration
+    :return: whether direct calls of `cfunc` use the raw entry
+    :rtype: bool
+    """
+    if not interpreter.direct_calls or sys.version_info < (3, 7):
+        return False
+    if cfunc.body is None:
+        # Maybe only the predeclaration.
+        cfunc = interpreter._cStateWrapper.funcs.get(cfunc.name, cfunc)
+    if cfunc.body is None or not cfunc.args:
+        return False
+    for arg in cfunc.args:
+        if isinstance(arg.type, CVariadicArgsType):
+            return False
+        if _rawVarKind(interpreter.globalScope.stateStruct, arg.type) is None:
+            return False
+    return True
+
+def _inlineCandidateExpr(interpreter, cfunc):
+    """
+    See Interpreter.inline_small_funcs.
+    A candidate is a static function without varargs whose body is a single
+    return statement (or a single expression statement for void functions),
+    within the size budget, and which does not call itself.
+    :param Interpreter interpreter:
+    :param CFunc cfunc: definition or predeclaration
+    :return: the definition and the C expression of its body, or None if `cfunc` is not a candidate
+    :rtype: (CFunc,CStatement)|None
+    """
+    if not interpreter.inline_small_funcs or not hasattr(ast, "NamedExpr") or interpreter.debug_log_assign:
+        return None
+    if cfunc.body is None:
+        # Maybe only the predeclaration.
+        cfunc = interpreter._cStateWrapper.funcs.get(cfunc.name, cfunc)
+    if "static" not in cfunc.attribs or cfunc.body is None or len(cfunc.body.contentlist) != 1:
+        return None
+    if any([isinstance(arg.type, CVariadicArgsType) for arg in cfunc.args]):
+        return None
+    stmnt = cfunc.body.contentlist[0]
+    if isinstance(stmnt, CReturnStatement):
+        expr = stmnt.body
+    elif isinstance(stmnt, CStatement) and isSameType(interpreter._cStateWrapper, cfunc.type, CVoidType()):
+        expr = stmnt
+    else:
+        return None
+    if not isinstance(expr, CStatement):
+        return None
+    size = _cExprSize(expr, cfunc)
+    if size is None or size > interpreter.inline_max_size:
+        return None
+    return cfunc, expr
+
+def _getAstNode_inlineCall(funcEnv, cfunc, argsAst):
+    """
+    Inlines a call of a small function, see Interpreter.inline_small_funcs.
+    Like the function itself would do on entry, each arg is evaluated once, in order,
+    and bound to a new local var, and only then the body expression is evaluated.
+    :param FuncEnv funcEnv:
+    :param CFunc cfunc:
+    :param list[ast.AST] argsAst: via autoCastArgs
+    :return: expression with the same value as the call of the function, or None if we don't inline
+    :rtype: ast.AST|None
+    """
+    candidate = _inlineCandidateExpr(funcEnv.interpreter, cfunc)
+    if candidate is None:
+        return None
+    cfunc, expr = candidate
+    if cfunc is funcEnv.func or cfunc in funcEnv.inlineStack:
+        return None
+    stateStruct = funcEnv.globalScope.stateStruct
+    elts = []
+    names = []
+    for i, argAst in enumerate(argsAst):
+        if i >= len(cfunc.args):
+            elts.append(argAst)  # still needs to be evaluated
+            continue
+        param = cfunc.args[i]
+        name = funcEnv._registerNewVar(param.name or "arg", param)
+        names.append(name)
+        valueAst = getAstNode_newTypeInstance(funcEnv, param.type, argAst, param.type)
+        elts.append(ast.NamedExpr(target=ast.Name(id=name, ctx=ast.Store()), value=valueAst))
+    funcEnv.inlineStack.append(cfunc)
+    try:
+        valueAst, valueType = astAndTypeForCStatement(funcEnv, expr)
+    finally:
+        funcEnv.inlineStack.pop()
+        for param, name in zip(cfunc.args, names):
+            del funcEnv.varNames[id(param)]
+            funcEnv.vars[name] = None  # keep the name reserved
+    if not isinstance(valueAst, ast.expr):
+        return None
+    if not isSameType(stateStruct, cfunc.type, CVoidType()):
+        # Like astForCReturn.
+        if isPointerType(valueType):
+            valueAst = makeAstNodeCall(getAstNodeAttrib("intp", "_storePtr"), valueAst)
+        valueAst = getAstNode_valueFromObj(stateStruct, valueAst, valueType)
+    if not elts:
+        return valueAst
+    return ast.Subscript(value=ast.Tuple(elts=elts + [valueAst], ctx=ast.Load()), slice=ast.Num(n=-1), ctx=ast.Load())
+
+def _makeRawVarObj(funcEnv, varDecl, valueAst, assignAst=None):
+    """
+    A temporary object for a raw local var (see Interpreter.raw_local_vars).
+    getAstNode_valueFromObj() directly uses `valueAst` instead,
+    and the assign/inc/dec functions assign to the var itself.
+    :param FuncEnv funcEnv:
+    :param CVarDecl|CFuncArgDecl varDecl:
+    :param ast.AST valueAst: raw value
+    :param ast.NamedExpr|None assignAst: the assignment done by `valueAst`, if there is any
+    """
+    if funcEnv.rawVars[id(varDecl)] is FatPtr:
+        objAst = _makeFatPtrObj(funcEnv, varDecl.type, valueAst)
+    else:
+        objAst = getAstNode_newTypeInstance(funcEnv, varDecl.type, valueAst)
+        objAst.c_raw_value = valueAst
+    objAst.c_raw_var = (funcEnv, varDecl)
+    objAst.c_raw_assign = assignAst
+    return objAst
+
+def _getAstNode_rawValue(kind, valueAst, valueKind=None):
+    """
+    Converts a value to the given raw var kind, i.e. wraps it around like the ctypes type does.
+    :param tuple[int,int]|type kind: see _rawVarKind
+    :param ast.AST valueAst:
+    :param tuple[int,int]|type|None valueKind: kind of `valueAst`, or int if it's any int
+    """
+    if valueKind == kind:
+        return valueAst
+    if kind is float:
+        return makeAstNodeCall(ast.Name(id="float", ctx=ast.Load()), valueAst)
+    if valueKind is not int and not isinstance(valueKind, tuple):
+        valueAst = makeAstNodeCall(ast.Name(id="int", ctx=ast.Load()), valueAst)
+    return getAstNode_intWrap(kind, valueAst)
+
+def _getAstNode_rawVarAssign(aAst, valueAst):
+    funcEnv, varDecl = aAst.c_raw_var
+    name = funcEnv.varNames[id(varDecl)]
+    assignAst = ast.NamedExpr(target=ast.Name(id=name, ctx=ast.Store()), value=valueAst)
+    return _makeRawVarObj(funcEnv, varDecl, assignAst, assignAst=assignAst)
+
+def _getAstNode_rawVarIncDec(aAst, op, postfix):
+    funcEnv, varDecl = aAst.c_raw_var
+    kind = funcEnv.rawVars[id(varDecl)]
+    if kind is FatPtr:
+        valueAst = makeAstNodeCall(getAstNodeAttrib(aAst.c_fat_ptr, "add"), ast.Num(n=1 if isinstance(op, ast.Add) else -1))
+        objAst = _getAstNode_rawVarAssign(aAst, valueAst)
+    else:
+        valueAst = ast.BinOp(left=aAst.c_raw_value, op=op, right=ast.Num(n=1))
+        objAst = _getAstNode_rawVarAssign(aAst, _getAstNode_rawValue(kind, valueAst, valueKind=int if kind is not float else float))
+    if postfix:
+        # (x, (x := x + 1))[0]
+        if kind is FatPtr:
+            tupleAst = ast.Tuple(elts=[aAst.c_fat_ptr, objAst.c_fat_ptr], ctx=ast.Load())
+        else:
+            tupleAst = ast.Tuple(elts=[aAst.c_raw_value, objAst.c_raw_value], ctx=ast.Load())
+        objAst = _makeRawVarObj(funcEnv, varDecl, getAstNodeArrayIndex(tupleAst, 0), assignAst=objAst.c_raw_assign)
+    return objAst
+
+def _getAstNode_rawVarAugAssign(stateStruct, aAst, opStr, bValueAst, bType):
+    funcEnv, varDecl = aAst.c_raw_var
+    kind = funcEnv.rawVars[id(varDecl)]
+    op = opStr[:-1]
+    if kind is FatPtr:
+        assert op in ("+", "-")
+        if op == "-":
+            bValueAst = ast.UnaryOp(op=ast.USub(), operand=bValueAst)
+        return _getAstNode_rawVarAssign(aAst, makeAstNodeCall(getAstNodeAttrib(aAst.c_fat_ptr, "add"), bValueAst))
+    # Like OpBinFuncs, which Helpers.augAssign uses.
+    opAst = ast.FloorDiv() if op == "/" else OpBin[op]()
+    valueAst = ast.BinOp(left=aAst.c_raw_value, op=opAst, right=bValueAst)
+    if kind is float:
+        valueKind = float
+    elif isinstance(_rawVarKind(stateStruct, bType), tuple):
+        valueKind = int
+    else:
+        valueKind = None
+    return _getAstNode_rawVarAssign(aAst, _getAstNode_rawValue(kind, valueAst, valueKind=valueKind))
+
 def getAstNode_ptrBinOpExpr(stateStruct, aAst, aType, opStr, bAst, bType):
     assert isPointerType(aType)
     opAst = ast.Str(opStr)
@@ -2120,6 +2751,11 @@ def astAndTypeForCStatement(funcEnv, stmnt):
             if isinstance(rightType, CPointerType):
                 if usePyRefForType(rightType.pointerOf):
                     return getAstNodeAttrib(rightAstNode, "ref"), rightType.pointerOf
+                fatAst = getattr(rightAstNode, "c_fat_ptr", None)
+                if fatAst is not None:
+                    a = makeAstNodeCall(getAstNodeAttrib(fatAst, "deref"))
+                    a.c_fat_deref_of = fatAst
+                    return a, rightType.pointerOf
                 return getAstNodeAttrib(rightAstNode, "contents"), rightType.pointerOf
             elif isinstance(rightType, CArrayType):
                 return getAstNodeArrayIndex(rightAstNode, 0), rightType.arrayOf
@@ -2140,6 +2776,10 @@ def astAndTypeForCStatement(funcEnv, stmnt):
             if offset is not None:
                 t = CStdIntType("intptr_t")
                 return getAstNode_newTypeInstance(funcEnv, t, ast.Num(n=offset)), t
+            fatAst = getattr(rightAstNode, "c_fat_deref_of", None)
+            if fatAst is not None:
+                # &*p, or &p[i]
+                return _makeFatPtrObj(funcEnv, CPointerType(rightType), fatAst), CPointerType(rightType)
             ptrAst = makeAstNodeCall(getAstNodeAttrib("ctypes", "pointer"), rightAstNode)
             return makeAstNodeCall(getAstNodeAttrib("intp", "_storePtr"), ptrAst), CPointerType(rightType)
         elif stmnt._op.content in OpUnary:
@@ -2151,7 +2791,7 @@ def astAndTypeForCStatement(funcEnv, stmnt):
                 rightType = ctypes.c_int
             elif isPointerType(rightType, alsoFuncPtr=True):
                 assert stmnt._op.content == "!", "the only supported unary op for ptr types is '!'"
-                a.operand = makeCastToVoidP_value(rightAstNode)
+                a.operand = getattr(rightAstNode, "c_raw_value", None) or makeCastToVoidP_value(rightAstNode)
                 rightType = ctypes.c_int
             else:
                 a.operand = getAstNode_valueFromObj(funcEnv.globalScope.stateStruct, rightAstNode, rightType)
@@ -2225,6 +2865,12 @@ def astAndTypeForCStatement(funcEnv, stmnt):
                 funcEnv.globalScope.stateStruct,
                 leftAstNode, leftType,
                 rightAstNode, rightType), CStdIntType("ptrdiff_t")
+        fatAst = getattr(leftAstNode, "c_fat_ptr", None)
+        if fatAst is not None:
+            nAst = getAstNode_valueFromObj(funcEnv.globalScope.stateStruct, rightAstNode, rightType, isPartOfCOp=True)
+            if stmnt._op.content == "-":
+                nAst = ast.UnaryOp(op=ast.USub(), operand=nAst)
+            return _makeFatPtrObj(funcEnv, leftType, makeAstNodeCall(getAstNodeAttrib(fatAst, "add"), nAst)), leftType
         return getAstNode_ptrBinOpExpr(
             funcEnv.globalScope.stateStruct,
             leftAstNode, leftType,
@@ -2261,11 +2907,448 @@ def astForCWhile(funcEnv, stmnt):
 
     return whileAst
 
+def _unwrapCStatement(obj):
+    while isinstance(obj, CStatement) and obj._op is None and obj._rightexpr is None and obj._middleexpr is None:
+        obj = obj._leftexpr
+    return obj
+
+class _CVarWritesScan:
+    """
+    Scans C code for the local vars which are written to, or whose address is taken.
+    """
+
+    def __init__(self, func):
+        """
+        :param CFunc func: the function which the code belongs to
+        """
+        self.func = func
+        self.written = set()  # id(varDecl)
+        self.addressTaken = set()  # id(varDecl)
+        self.hasGoto = False
+        self.visited = set()
+
+    def isLocal(self, decl):
+        while decl is not None:
+            if decl is self.func: return True
+            decl = decl.parent
+        return False
+
+    def visit(self, obj):
+        if isinstance(obj, (list, tuple)):
+            for sub in obj:
+                self.visit(sub)
+        elif isinstance(obj, CBody):
+            self.visit(obj.contentlist)
+        elif isinstance(obj, (CVarDecl, CFuncArgDecl)):
+            if id(obj) in self.visited or not self.isLocal(obj):
+                return
+            self.visited.add(id(obj))
+            self.visit(obj.body)
+        elif isinstance(obj, CFunc):
+            return
+        elif isinstance(obj, (CGotoStatement, CGotoLabel)):
+            self.hasGoto = True
+        elif isinstance(obj, CStatement):
+            op = obj._op.content if obj._op is not None else None
+            if (op == "=" or op in OpAugAssign) and obj._leftexpr is not None:
+                self.written.add(id(_unwrapCStatement(obj._leftexpr)))
+            elif op in ("++", "--"):
+                self.written.add(id(_unwrapCStatement(
+                    obj._leftexpr if obj._leftexpr is not None else obj._rightexpr)))
+            elif op == "&" and obj._leftexpr is None:
+                self.addressTaken.add(id(_unwrapCStatement(obj._rightexpr)))
+            self.visit(obj._leftexpr)
+            self.visit(obj._middleexpr)
+            self.visit(obj._rightexpr)
+        elif isinstance(obj, (CFuncCall, CArrayIndexRef, CAttribAccessRef, CPtrAccessRef)):
+            if isinstance(obj, CFuncCall) and isinstance(obj.base, CWrapValue) \
+                    and not isinstance(obj.base.value, ctypes._CFuncPtr):
+                # A custom Python function gets the objects themselves, see astAndTypeForStatement.
+                for arg in obj.args:
+                    self.written.add(id(_unwrapCStatement(arg)))
+            self.visit(obj.base)
+            self.visit(obj.args)
+        elif isinstance(obj, cparser._CBaseWithOptBody):
+            self.visit(obj.args)
+            self.visit(obj.body)
+            self.visit(getattr(obj, "elsePart", None))
+            self.visit(getattr(obj, "whilePart", None))
+
+def _isLoopInvariantCExpr(funcEnv, obj, written):
+    """
+    :param FuncEnv funcEnv:
+    :param obj: C expression
+    :param set[int] written: id(varDecl) of the vars which are written in the loop
+    :return: whether `obj` is free of side effects and only depends on constants and local vars not in `written`
+    """
+    obj = _unwrapCStatement(obj)
+    if isinstance(obj, (CNumber, CChar, CEnumConst)):
+        return True
+    if isinstance(obj, (CVarDecl, CFuncArgDecl)):
+        return id(obj) in funcEnv.varNames and id(obj) not in written
+    if isinstance(obj, CStatement):
+        op = obj._op.content if obj._op is not None else None
+        if op is None or op in ("=", "++", "--") or op in OpAugAssign:
+            return False
+        if op in ("&", "*") and obj._leftexpr is None:
+            return False  # address-of, deref
+        return all([_isLoopInvariantCExpr(funcEnv, sub, written)
+                    for sub in (obj._leftexpr, obj._middleexpr, obj._rightexpr) if sub is not None])
+    return False
+
+def _cForLoopVar(funcEnv, stmnt):
+    """
+    For a loop ``for (i = a; ...; i++) body`` (also with ``--i``, ``i += c`` etc.),
+    where `i` is a local int var whose address is never taken and which is not written in the body.
+    :param FuncEnv funcEnv:
+    :param CForStatement stmnt:
+    :return: `i`, its kind (see _rawVarKind), the step, and id(varDecl) of the vars written in the body,
+      or None if the loop is not of that form
+    :rtype: (CVarDecl|CFuncArgDecl,(int,int),int,set[int])|None
+    """
+    func = getattr(funcEnv, "func", None)
+    init, cond, incr = stmnt.args
+    if func is None or not init or not cond or not incr:
+        return None
+    stateStruct = funcEnv.globalScope.stateStruct
+    # Init: `i = a` or `T i = a`.
+    init = _unwrapCStatement(init)
+    if isinstance(init, CVarDecl) and init.body is not None:
+        var = init
+    elif isinstance(init, CStatement) and init._op is not None and init._op.content == "=":
+        var = _unwrapCStatement(init._leftexpr)
+    else:
+        return None
+    if not isinstance(var, (CVarDecl, CFuncArgDecl)) or "static" in var.attribs:
+        return None
+    kind = _rawVarKind(stateStruct, var.type)
+    if not isinstance(kind, tuple) or kind[1] < _CTYPES_INT_RANGES["c_int"][1]:
+        return None  # smaller types could wrap around
+    # Step: `i++`, `++i`, `i += c`, `i--`, `--i`, `i -= c`.
+    incr = _unwrapCStatement(incr)
+    if not isinstance(incr, CStatement) or incr._op is None:
+        return None
+    op = incr._op.content
+    if op in ("++", "--"):
+        if _unwrapCStatement(incr._leftexpr if incr._leftexpr is not None else incr._rightexpr) is not var:
+            return None
+        step = 1 if op == "++" else -1
+    elif op in ("+=", "-="):
+        step = getConstValue(stateStruct, incr._rightexpr)
+        if _unwrapCStatement(incr._leftexpr) is not var or not isinstance(step, (int, long)) or step <= 0:
+            return None
+        if op == "-=":
+            step = -step
+    else:
+        return None
+    # `i` must only be changed by the loop itself.
+    if funcEnv.funcScan is None:
+        funcEnv.funcScan = _CVarWritesScan(func)
+        funcEnv.funcScan.visit(func.body)
+    if funcEnv.funcScan.hasGoto or id(var) in funcEnv.funcScan.addressTaken:
+        return None
+    if id(var) not in funcEnv.varNames and not isinstance(init, CVarDecl):
+        return None
+    bodyScan = _CVarWritesScan(func)
+    bodyScan.visit(stmnt.body)
+    if id(var) in bodyScan.written:
+        return None
+    return var, kind, step, bodyScan.written
+
+def _loopIdiomElement(funcEnv, obj, var):
+    """
+    :param FuncEnv funcEnv:
+    :param obj: C expression
+    :param CVarDecl|CFuncArgDecl var: the loop var `i`
+    :return: for ``a[i + c]`` with an array or pointer var `a` to int or double elements, and a constant `c`:
+      `a`, `c`, the element kind (see _rawVarKind) and the element size. Otherwise None.
+    :rtype: (CVarDecl|CFuncArgDecl,int,(int,int)|type,int)|None
+    """
+    stateStruct = funcEnv.globalScope.stateStruct
+    obj = _unwrapCStatement(obj)
+    if not isinstance(obj, CArrayIndexRef) or len(obj.args) != 1:
+        return None
+    base = _unwrapCStatement(obj.base)
+    if not isinstance(base, (CVarDecl, CFuncArgDecl)):
+        return None
+    baseType = resolveTypedef(base.type)
+    if isinstance(baseType, CArrayType):
+        elemType = baseType.arrayOf
+    elif isinstance(baseType, CPointerType):
+        elemType = baseType.pointerOf
+    else:
+        return None
+    kind = _rawVarKind(stateStruct, elemType)
+    if kind is None:
+        return None
+    index = _unwrapCStatement(obj.args[0])
+    if index is var:
+        offset = 0
+    elif isinstance(index, CStatement) and index._op is not None and index._op.content in ("+", "-") \
+            and index._leftexpr is not None and index._rightexpr is not None:
+        if _unwrapCStatement(index._leftexpr) is var:
+            offset = getConstValue(stateStruct, index._rightexpr)
+            if index._op.content == "-" and offset is not None:
+                offset = -offset
+        elif _unwrapCStatement(index._rightexpr) is var and index._op.content == "+":
+            offset = getConstValue(stateStruct, index._leftexpr)
+        else:
+            return None
+        if not isinstance(offset, (int, long)):
+            return None
+    else:
+        return None
+    return base, offset, kind, ctypes.sizeof(getCType(elemType, stateStruct))
+
+def _getAstNode_loopIdiomBase(funcEnv, base):
+    baseAst, _ = astAndTypeForStatement(funcEnv, base)
+    # A FatPtr directly, see Interpreter.fat_pointers.
+    return getattr(baseAst, "c_fat_ptr", None) or baseAst
+
+def _matchLoopIdiom(funcEnv, body, var):
+    """
+    See Interpreter.loop_idioms.
+    For a counted loop over `i` with step 1, recognizes the bodies::
+
+        a[i + c1] = b[i + c2];  // copy
+        a[i + c] = value;  // fill
+        if (a[i + c1] != b[i + c2]) break;  // compare
+
+    :param FuncEnv funcEnv:
+    :param body: C loop body
+    :param CVarDecl|CFuncArgDecl var: the loop var `i`
+    :return: (Helpers.bulkCopy, a, b), (Helpers.bulkFill, a, value) or (Helpers.bulkCompare, a, b),
+      where `a` and `b` are via _loopIdiomElement, or None if `body` is not one of these
+    """
+    if isinstance(body, CBody):
+        if len(body.contentlist) != 1:
+            return None
+        body = body.contentlist[0]
+    if isinstance(body, CIfStatement):
+        if body.elsePart is not None or len(body.args) != 1:
+            return None
+        breakStmnt = body.body
+        if isinstance(breakStmnt, CBody) and len(breakStmnt.contentlist) == 1:
+            breakStmnt = breakStmnt.contentlist[0]
+        cond = _unwrapCStatement(body.args[0])
+        if not isinstance(breakStmnt, CBreakStatement) or not isinstance(cond, CStatement) \
+                or cond._op is None or cond._op.content != "!=":
+            return None
+        a = _loopIdiomElement(funcEnv, cond._leftexpr, var)
+        b = _loopIdiomElement(funcEnv, cond._rightexpr, var)
+        # Equal ints have equal bytes, and vice versa.
+        if a is None or b is None or a[2:] != b[2:] or not isinstance(a[2], tuple):
+            return None
+        return Helpers.bulkCompare, a, b
+    if not isinstance(body, CStatement) or body._op is None or body._op.content != "=":
+        return None
+    dst = _loopIdiomElement(funcEnv, body._leftexpr, var)
+    if dst is None:
+        return None
+    src = _loopIdiomElement(funcEnv, body._rightexpr, var)
+    if src is not None:
+        if src[2:] != dst[2:]:
+            return None
+        return Helpers.bulkCopy, dst, src
+    if not _isLoopInvariantCExpr(funcEnv, body._rightexpr, funcEnv.funcScan.addressTaken | set([id(var)])):
+        return None
+    return Helpers.bulkFill, dst, body._rightexpr
+
+def _getAstNode_loopIdiom(funcEnv, idiom, rangeAst):
+    """
+    :param FuncEnv funcEnv:
+    :param tuple idiom: via _matchLoopIdiom
+    :param ast.AST rangeAst: the range of the loop var `i`
+    :return: the call of the helper, which returns the value of `i` after the loop,
+      or None at runtime if the loop must run element-wise
+    :rtype: ast.Call
+    """
+    helper, a, b = idiom
+    aAst = _getAstNode_loopIdiomBase(funcEnv, a[0])
+    if helper is Helpers.bulkFill:
+        valueAst = getAstNode_valueFromObj(
+            funcEnv.globalScope.stateStruct, *astAndTypeForStatement(funcEnv, b))
+        return makeAstNodeCall(helper, aAst, ast.Num(n=a[1]), rangeAst, ast.Num(n=a[3]), valueAst)
+    bAst = _getAstNode_loopIdiomBase(funcEnv, b[0])
+    return makeAstNodeCall(helper, aAst, ast.Num(n=a[1]), bAst, ast.Num(n=b[1]), rangeAst, ast.Num(n=a[3]))
+
+def _astForCForRange(funcEnv, stmnt):
+    """
+    See Interpreter.range_for_loops.
+    Translates a counted loop ``for (i = a; i < b; i++) body`` (also with ``<=``, ``>``, ``>=``,
+    ``--i``, ``i += c`` etc.), see _cForLoopVar, where `b` is loop invariant, into::
+
+        i = a
+        loop_range = range(i, b, 1)
+        for loop_value in loop_range:
+            i = loop_value
+            body
+        else:
+            if loop_range: i = loop_range[-1] + 1
+
+    The else branch sets the value which `i` has after the C loop.
+    With Interpreter.loop_idioms, see _getAstNode_loopIdiom, this becomes::
+
+        loop_final = helpers.bulkCopy(..., loop_range, ...)
+        if loop_final is None:
+            for loop_value in loop_range: ...
+        else:
+            i = loop_final
+
+    :param FuncEnv funcEnv:
+    :param CForStatement stmnt:
+    :return: the AST, or None if the loop is not of that form
+    :rtype: ast.If|None
+    """
+    interpreter = funcEnv.interpreter
+    if not interpreter.range_for_loops and not interpreter.loop_idioms:
+        return None
+    loopVar = _cForLoopVar(funcEnv, stmnt)
+    if loopVar is None:
+        return None
+    var, kind, step, bodyWritten = loopVar
+    init, cond, _ = stmnt.args
+    stateStruct = funcEnv.globalScope.stateStruct
+    # Condition: `i < b`, `i <= b`, or `i > b`, `i >= b` for signed `i` when counting down.
+    if not isinstance(cond, CStatement) or cond._op is None or _unwrapCStatement(cond._leftexpr) is not var:
+        return None
+    condOp = cond._op.content
+    if condOp not in ((">", ">=") if step < 0 else ("<", "<=")):
+        return None
+    if step < 0 and kind[0] >= 0:
+        return None  # e.g. `i >= 0` is always true for unsigned `i`
+    written = bodyWritten | funcEnv.funcScan.addressTaken | set([id(var)])
+    if not _isLoopInvariantCExpr(funcEnv, cond._rightexpr, written):
+        return None
+    idiom = None
+    if interpreter.loop_idioms and step == 1:
+        idiom = _matchLoopIdiom(funcEnv, stmnt.body, var)
+    if idiom is None and not interpreter.range_for_loops:
+        return None
+    boundValue = getConstValue(stateStruct, cond._rightexpr)
+    if boundValue is not None:
+        if not kind[0] <= boundValue <= kind[1]:
+            return None
+    else:
+        boundKind = _rawVarKind(stateStruct, astAndTypeForStatement(funcEnv, cond._rightexpr)[1])
+        if not isinstance(boundKind, tuple) or (boundKind[0] < 0) != (kind[0] < 0):
+            return None  # the comparison might not be on the plain values
+
+    ifAst = ast.If(body=[], orelse=[], test=ast.Name(id="True", ctx=ast.Load()))
+    funcEnv.pushScope(ifAst.body)
+    cStatementToPyAst(funcEnv, _unwrapCStatement(init))
+    varName = funcEnv.varNames[id(var)]
+    isRaw = id(var) in funcEnv.rawVars
+
+    def assignVar(valueAst):
+        if isRaw:
+            target = ast.Name(id=varName, ctx=ast.Store())
+        else:
+            target = ast.Attribute(value=ast.Name(id=varName, ctx=ast.Load()), attr="value", ctx=ast.Store())
+        return ast.Assign(targets=[target], value=valueAst)
+
+    startAst = getAstNode_valueFromObj(stateStruct, *astAndTypeForStatement(funcEnv, var))
+    endAst = getAstNode_valueFromObj(stateStruct, *astAndTypeForStatement(funcEnv, cond._rightexpr))
+    if condOp == "<=":
+        endAst = ast.BinOp(left=endAst, op=ast.Add(), right=ast.Num(n=1))
+    elif condOp == ">=":
+        endAst = ast.BinOp(left=endAst, op=ast.Sub(), right=ast.Num(n=1))
+    rangeName = funcEnv.registerNewUnscopedVarName("loop_range", initNone=False)
+    ifAst.body.append(ast.Assign(
+        targets=[ast.Name(id=rangeName, ctx=ast.Store())],
+        value=makeAstNodeCall(ast.Name(id="range", ctx=ast.Load()), startAst, endAst, ast.Num(n=step))))
+    forAst = ast.For(body=[], orelse=[], iter=ast.Name(id=rangeName, ctx=ast.Load()))
+    if isRaw:
+        forAst.target = ast.Name(id=varName, ctx=ast.Store())
+    else:
+        valueName = funcEnv.registerNewUnscopedVarName("loop_value", initNone=False)
+        forAst.target = ast.Name(id=valueName, ctx=ast.Store())
+        forAst.body.append(assignVar(ast.Name(id=valueName, ctx=ast.Load())))
+    lastValueAst = ast.Subscript(
+        value=ast.Name(id=rangeName, ctx=ast.Load()), slice=ast.Num(n=-1), ctx=ast.Load())
+    forAst.orelse.append(ast.If(
+        test=ast.Name(id=rangeName, ctx=ast.Load()), orelse=[],
+        body=[assignVar(ast.BinOp(left=lastValueAst, op=ast.Add(), right=ast.Num(n=step)))]))
+    if idiom is not None:
+        idiomAst = _getAstNode_loopIdiom(funcEnv, idiom, ast.Name(id=rangeName, ctx=ast.Load()))
+        finalName = funcEnv.registerNewUnscopedVarName("loop_final", initNone=False)
+        ifAst.body.append(ast.Assign(targets=[ast.Name(id=finalName, ctx=ast.Store())], value=idiomAst))
+        ifAst.body.append(ast.If(
+            test=ast.Compare(left=ast.Name(id=finalName, ctx=ast.Load()), ops=[ast.Is()],
+                             comparators=[ast.Name(id="None", ctx=ast.Load())]),
+            body=[forAst], orelse=[assignVar(ast.Name(id=finalName, ctx=ast.Load()))]))
+    else:
+        ifAst.body.append(forAst)
+
+    funcEnv.pushScope(forAst.body)
+    _pushLoopContext(funcEnv, ("loop",))
+    if stmnt.body is not None:
+        cCodeToPyAstList(funcEnv, stmnt.body)
+    _popLoopContext(funcEnv)
+    if not forAst.body:
+        forAst.body.append(ast.Pass())
+    funcEnv.popScope() # forAst
+    funcEnv.popScope() # ifAst
+    return ifAst
+
+def _astForCForStrlen(funcEnv, stmnt):
+    """
+    See Interpreter.loop_idioms.
+    Translates ``for (i = a; s[i + c]; i++);`` (or with ``s[i + c] != 0``) over bytes,
+    see _cForLoopVar and _loopIdiomElement, into::
+
+        i = a
+        i = helpers.bulkStrlen(s, c, i)
+
+    :param FuncEnv funcEnv:
+    :param CForStatement stmnt:
+    :return: the AST, or None if the loop is not of that form
+    :rtype: ast.If|None
+    """
+    if not funcEnv.interpreter.loop_idioms:
+        return None
+    if stmnt.body is not None and not (isinstance(stmnt.body, CBody) and not stmnt.body.contentlist):
+        return None
+    loopVar = _cForLoopVar(funcEnv, stmnt)
+    if loopVar is None or loopVar[2] != 1:
+        return None
+    var = loopVar[0]
+    init, cond, _ = stmnt.args
+    stateStruct = funcEnv.globalScope.stateStruct
+    cond = _unwrapCStatement(cond)
+    if isinstance(cond, CStatement) and cond._op is not None and cond._op.content == "!=" \
+            and getConstValue(stateStruct, cond._rightexpr) == 0:
+        cond = cond._leftexpr
+    elem = _loopIdiomElement(funcEnv, cond, var)
+    if elem is None or elem[3] != 1 or not isinstance(elem[2], tuple):
+        return None
+    ifAst = ast.If(body=[], orelse=[], test=ast.Name(id="True", ctx=ast.Load()))
+    funcEnv.pushScope(ifAst.body)
+    cStatementToPyAst(funcEnv, _unwrapCStatement(init))
+    varName = funcEnv.varNames[id(var)]
+    startAst = getAstNode_valueFromObj(stateStruct, *astAndTypeForStatement(funcEnv, var))
+    valueAst = makeAstNodeCall(
+        Helpers.bulkStrlen, _getAstNode_loopIdiomBase(funcEnv, elem[0]), ast.Num(n=elem[1]), startAst)
+    if id(var) in funcEnv.rawVars:
+        target = ast.Name(id=varName, ctx=ast.Store())
+    else:
+        target = ast.Attribute(value=ast.Name(id=varName, ctx=ast.Load()), attr="value", ctx=ast.Store())
+    ifAst.body.append(ast.Assign(targets=[target], value=valueAst))
+    funcEnv.popScope() # ifAst
+    return ifAst
+
 def astForCFor(funcEnv, stmnt):
     assert isinstance(stmnt, CForStatement)
     assert len(stmnt.args) == 3
     assert isinstance(stmnt.args[1], CStatement) # second arg is the check; we must be able to evaluate that
 
+    rangeAst = _astForCForRange(funcEnv, stmnt)
+    if rangeAst is not None:
+        return rangeAst
+    strlenAst = _astForCForStrlen(funcEnv, stmnt)
+    if strlenAst is not None:
+        return strlenAst
+
     # introduce dummy 'if' AST so that we have a scope for the for-loop (esp. the first statement)
     ifAst = ast.If(body=[], orelse=[], test=ast.Name(id="True", ctx=ast.Load()))
     funcEnv.pushScope(ifAst.body)
@@ -2502,12 +3585,18 @@ def astForCSwitch(funcEnv, stmnt):
     a.value = getAstNode_valueFromObj(funcEnv.globalScope.stateStruct, switchValueAst, switchValueType, isPartOfCOp=True)
     funcEnv.getBody().append(a)
 
-    fallthroughVarName = funcEnv.registerNewVar("_switchfallthrough")
-    a = ast.Assign()
-    a.targets = [ast.Name(id=fallthroughVarName, ctx=ast.Store())]
-    a.value = ast.Name(id="False", ctx=ast.Load())
-    fallthroughVarAst = ast.Name(id=fallthroughVarName, ctx=ast.Load())
-    funcEnv.getBody().append(a)
+    caseValues = _switchCaseConstValues(funcEnv, stmnt)
+    if caseValues is not None:
+        # Jump table: _switchcase is the index of the first case block to execute.
+        caseVarName = funcEnv.registerNewVar("_switchcase")
+        funcEnv.getBody().extend(_astForSwitchLookup(switchVarName, caseVarName, caseValues))
+    else:
+        fallthroughVarName = funcEnv.registerNewVar("_switchfallthrough")
+        a = ast.Assign()
+        a.targets = [ast.Name(id=fallthroughVarName, ctx=ast.Store())]
+        a.value = ast.Name(id="False", ctx=ast.Load())
+        fallthroughVarAst = ast.Name(id=fallthroughVarName, ctx=ast.Load())
+        funcEnv.getBody().append(a)
 
     # Marker for "C ``continue`` inside this switch body wants to skip
     # to the next iteration of the *outer* loop", not re-iterate the
@@ -2528,38 +3617,51 @@ def astForCSwitch(funcEnv, stmnt):
     funcEnv.pushScope(whileAst.body)
     _pushLoopContext(funcEnv, ("switch", continueMarkerName))
 
-    curCase = None
-    for c in stmnt.body.contentlist:
-        if isinstance(c, CCaseStatement):
-            if curCase is not None: funcEnv.popScope()
-            assert len(c.args) == 1
-            curCase = ast.If(body=[], orelse=[])
-            curCase.test = ast.BoolOp(op=ast.Or(), values=[
-                fallthroughVarAst,
-                ast.Compare(
-                    left=ast.Name(id=switchVarName, ctx=ast.Load()),
-                    ops=[ast.Eq()],
-                    comparators=[getAstNode_valueFromObj(funcEnv.globalScope.stateStruct, *astAndTypeForCStatement(funcEnv, c.args[0]), isPartOfCOp=True)]
-                )
-            ])
-            funcEnv.getBody().append(curCase)
-            funcEnv.pushScope(curCase.body)
-            a = ast.Assign()
-            a.targets = [ast.Name(id=fallthroughVarName, ctx=ast.Store())]
-            a.value = ast.Name(id="True", ctx=ast.Load())
-            funcEnv.getBody().append(a)
-
-        elif isinstance(c, CCaseDefaultStatement):
-            if curCase is not None: funcEnv.popScope()
-            curCase = ast.If(body=[], orelse=[])
-            curCase.test = ast.UnaryOp(op=ast.Not(), operand=fallthroughVarAst)
-            funcEnv.getBody().append(curCase)
-            funcEnv.pushScope(curCase.body)
+    if caseValues is not None:
+        blocks = []
+        for c in stmnt.body.contentlist:
+            if isinstance(c, (CCaseStatement, CCaseDefaultStatement)):
+                if blocks: funcEnv.popScope()
+                blocks.append([])
+                funcEnv.pushScope(blocks[-1])
+            else:
+                assert blocks
+                cStatementToPyAst(funcEnv, c)
+        if blocks: funcEnv.popScope()
+        funcEnv.getBody().extend(_astForSwitchBlocks(caseVarName, blocks, 0, len(blocks)))
+    else:
+        curCase = None
+        for c in stmnt.body.contentlist:
+            if isinstance(c, CCaseStatement):
+                if curCase is not None: funcEnv.popScope()
+                assert len(c.args) == 1
+                curCase = ast.If(body=[], orelse=[])
+                curCase.test = ast.BoolOp(op=ast.Or(), values=[
+                    fallthroughVarAst,
+                    ast.Compare(
+                        left=ast.Name(id=switchVarName, ctx=ast.Load()),
+                        ops=[ast.Eq()],
+                        comparators=[getAstNode_valueFromObj(funcEnv.globalScope.stateStruct, *astAndTypeForCStatement(funcEnv, c.args[0]), isPartOfCOp=True)]
+                    )
+                ])
+                funcEnv.getBody().append(curCase)
+                funcEnv.pushScope(curCase.body)
+                a = ast.Assign()
+                a.targets = [ast.Name(id=fallthroughVarName, ctx=ast.Store())]
+                a.value = ast.Name(id="True", ctx=ast.Load())
+                funcEnv.getBody().append(a)
+
+            elif isinstance(c, CCaseDefaultStatement):
+                if curCase is not None: funcEnv.popScope()
+                curCase = ast.If(body=[], orelse=[])
+                curCase.test = ast.UnaryOp(op=ast.Not(), operand=fallthroughVarAst)
+                funcEnv.getBody().append(curCase)
+                funcEnv.pushScope(curCase.body)
 
-        else:
-            assert curCase is not None
-            cStatementToPyAst(funcEnv, c)
-    if curCase is not None: funcEnv.popScope()
+            else:
+                assert curCase is not None
+                cStatementToPyAst(funcEnv, c)
+        if curCase is not None: funcEnv.popScope()
 
     # finish 'while'
     funcEnv.getBody().append(ast.Break())
@@ -2582,6 +3684,96 @@ def astForCSwitch(funcEnv, stmnt):
     funcEnv.popScope()
     return ifAst
 
+def _switchCaseConstValues(funcEnv, stmnt):
+    """
+    :param CSwitchStatement stmnt:
+    :return: for each case block in order, the int case value, or None for the default,
+      or None if not all case values are distinct int constants
+    :rtype: list[int|None]|None
+    """
+    values = []
+    for c in stmnt.body.contentlist:
+        if isinstance(c, CCaseStatement):
+            if len(c.args) != 1: return None
+            v = getConstValue(funcEnv.globalScope.stateStruct, c.args[0])
+            if not isinstance(v, (int, long)) or isinstance(v, bool) or v in values: return None
+            values.append(v)
+        elif isinstance(c, CCaseDefaultStatement):
+            if None in values: return None
+            values.append(None)
+    return values
+
+def _astForSwitchLookup(switchVarName, caseVarName, caseValues):
+    """
+    :param str switchVarName: var with the switch value
+    :param str caseVarName: var to assign the index of the first matching case block to
+    :param list[int|None] caseValues: see _switchCaseConstValues
+    :return: statements which do the assignment. When nothing matches and there is no default,
+      the index is len(caseValues), i.e. no block is executed.
+    :rtype: list[ast.stmt]
+    """
+    default = caseValues.index(None) if None in caseValues else len(caseValues)
+    items = sorted([(v, idx) for (idx, v) in enumerate(caseValues) if v is not None])
+
+    def assign(valueAst):
+        return ast.Assign(targets=[ast.Name(id=caseVarName, ctx=ast.Store())], value=valueAst)
+    def switchValue():
+        return ast.Name(id=switchVarName, ctx=ast.Load())
+
+    if not items:
+        return [assign(ast.Num(n=default))]
+    minValue, maxValue = items[0][0], items[-1][0]
+    if maxValue - minValue < 4 * len(items) + 16:
+        # Dense: lookup in a constant tuple.
+        table = [default] * (maxValue - minValue + 1)
+        for v, idx in items:
+            table[v - minValue] = idx
+        tableAst = ast.Tuple(elts=[ast.Num(n=idx) for idx in table], ctx=ast.Load())
+        offsetAst = ast.BinOp(left=switchValue(), op=ast.Sub(), right=ast.Num(n=minValue))
+        return [ast.If(
+            test=ast.Compare(left=ast.Num(n=minValue), ops=[ast.LtE(), ast.LtE()],
+                             comparators=[switchValue(), ast.Num(n=maxValue)]),
+            body=[assign(getAstNodeArrayIndex(tableAst, offsetAst))],
+            orelse=[assign(ast.Num(n=default))])]
+
+    # Sparse: binary search.
+    def lookup(lo, hi):
+        if hi - lo <= 2:
+            stmnts = [assign(ast.Num(n=default))]
+            for v, idx in reversed(items[lo:hi]):
+                stmnts = [ast.If(
+                    test=ast.Compare(left=switchValue(), ops=[ast.Eq()], comparators=[ast.Num(n=v)]),
+                    body=[assign(ast.Num(n=idx))], orelse=stmnts)]
+            return stmnts
+        mid = (lo + hi) // 2
+        return [ast.If(
+            test=ast.Compare(left=switchValue(), ops=[ast.Lt()], comparators=[ast.Num(n=items[mid][0])]),
+            body=lookup(lo, mid), orelse=lookup(mid, hi))]
+    return lookup(0, len(items))
+
+def _astForSwitchBlocks(caseVarName, blocks, lo, hi):
+    """
+    Executes the case blocks [lo, hi) starting with block number `caseVarName`,
+    i.e. with C fallthrough semantics. This needs O(log n) comparisons.
+    When we come here via fallthrough, `caseVarName` < lo, and all blocks are executed.
+    :param str caseVarName:
+    :param list[list[ast.stmt]] blocks:
+    :param int lo:
+    :param int hi:
+    :rtype: list[ast.stmt]
+    """
+    if hi - lo == 0:
+        return []
+    if hi - lo == 1:
+        return [ast.If(
+            test=ast.Compare(left=ast.Name(id=caseVarName, ctx=ast.Load()), ops=[ast.LtE()], comparators=[ast.Num(n=lo)]),
+            body=blocks[lo] or [ast.Pass()], orelse=[])]
+    mid = (lo + hi) // 2
+    return [ast.If(
+        test=ast.Compare(left=ast.Name(id=caseVarName, ctx=ast.Load()), ops=[ast.Lt()], comparators=[ast.Num(n=mid)]),
+        body=_astForSwitchBlocks(caseVarName, blocks, lo, mid), orelse=[])] + \
+        _astForSwitchBlocks(caseVarName, blocks, mid, hi)
+
 def astForCReturn(funcEnv, stmnt):
     if stmnt is not None:
         assert isinstance(stmnt, CReturnStatement)
@@ -2644,7 +3836,11 @@ def cStatementToPyAst(funcEnv, c):
             funcEnv.registerNewVar(c.name, c)
     elif isinstance(c, CStatement):
         a, t = astAndTypeForCStatement(funcEnv, c)
-        if isinstance(a, ast.expr):
+        rawAssignAst = getattr(a, "c_raw_assign", None)
+        if rawAssignAst is not None:
+            # Raw local var assignment. The value of the expression is not needed.
+            a = ast.Assign(targets=[rawAssignAst.target], value=rawAssignAst.value)
+        elif isinstance(a, ast.expr):
             a = ast.Expr(value=a)
         body.append(a)
     elif isinstance(c, CWhileStatement):
@@ -2698,9 +3894,12 @@ class WrappedValues:
     def __init__(self):
         self.callbacks_register_new = []
         self.list = set()
+        self.recorded = None  # list of requested CWrapValue, see Interpreter._translateFuncToPyCached
 
     def get_value(self, wrapValue):
         assert isinstance(wrapValue, CWrapValue)
+        if self.recorded is not None:
+            self.recorded.append(wrapValue)
         orig_name = wrapValue.name or "anonymous_value"
         for name in iterIdWithPostfixes(orig_name):
             if not isValidVarName(name): continue
@@ -2723,9 +3922,13 @@ def _unparse(pyAst):
     output.write("\n")
     return output.getvalue()
 
-def _set_linecache(filename, source):
+def _set_linecache(filename, lines):
+    """
+    :param str filename:
+    :param list[str]|_SourceLines lines:
+    """
     import linecache
-    linecache.cache[filename] = None, None, [line+'\n' for line in source.splitlines()], filename
+    linecache.cache[filename] = None, None, lines, filename
 
 def _ctype_ptr_get_value(ptr):
     """
@@ -2877,6 +4080,38 @@ class PointerStorage:
         self.valueRef = ref(value)
 
 
+class FatPtr(object):
+    """
+    A C pointer as (base buffer, byte offset, element type), see Interpreter.fat_pointers.
+    `base` is the ctypes object whose memory the pointer points into, and which keeps it alive.
+    If `base` is None, `offset` is the absolute address, e.g. 0 for NULL.
+    """
+    __slots__ = ("base", "offset", "type")
+
+    def __init__(self, base, offset, type):
+        self.base = base
+        self.offset = offset
+        self.type = type
+
+    def addr(self):
+        if self.base is None:
+            return self.offset
+        return ctypes.addressof(self.base) + self.offset
+
+    def add(self, n):
+        return FatPtr(self.base, self.offset + n * ctypes.sizeof(self.type), self.type)
+
+    def deref(self):
+        if self.base is None:
+            if not self.offset:
+                raise ValueError("NULL pointer access")  # like ctypes
+            return self.type.from_address(self.offset)
+        return self.type.from_address(ctypes.addressof(self.base) + self.offset)
+
+    def __repr__(self):
+        return "<FatPtr %s 0x%x>" % (self.type.__name__, self.addr())
+
+
 def _build_ctypes_int_ranges():
     names = (
         "c_byte", "c_ubyte", "c_short", "c_ushort", "c_int", "c_uint",
@@ -3033,6 +4268,59 @@ class _PeepholeOptimizer(ast.NodeTransformer):
 _peephole_optimizer = _PeepholeOptimizer()
 
 
+_INT_BIN_OPS = (ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod, ast.LShift, ast.RShift,
+                ast.BitOr, ast.BitXor, ast.BitAnd)
+
+
+def _is_int_ast(node):
+    """Whether ``node`` surely evaluates to an int (or bool)."""
+    if getattr(node, "c_is_int", False) or _is_int_literal_num(node):
+        return True
+    if isinstance(node, ast.Compare):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, ast.Not) or _is_int_ast(node.operand)
+    if isinstance(node, ast.BinOp):
+        return isinstance(node.op, _INT_BIN_OPS) and _is_int_ast(node.left) and _is_int_ast(node.right)
+    return _is_int_call(node) is not None
+
+
+class _MaskedIntArithmetic(ast.NodeTransformer):
+    """Replace ``ctypes_wrapped.c_<int>(<x>).value`` by the pure arithmetic
+    wraparound from ``getAstNode_intWrap``, see Interpreter.masked_int_arithmetic.
+    The generated code always passes an int (or bool) to the int ctypes,
+    so this gives the same value without creating the ctypes object.
+    """
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        if node.attr != "value":
+            return node
+        call = node.value
+        if (isinstance(call, ast.Call) and not call.args and not call.keywords
+                and isinstance(call.func, ast.Attribute)
+                and isinstance(call.func.value, ast.Name)
+                and call.func.value.id == "ctypes_wrapped"
+                and call.func.attr in _CTYPES_INT_TYPE_NAMES):
+            return ast.Num(n=0)
+        matched = _is_ctypes_int_wrap_call(call)
+        if matched is None:
+            return node
+        type_name, arg = matched
+        valueRange = _CTYPES_INT_RANGES[type_name]
+        if (isinstance(arg, ast.Compare) or (isinstance(arg, ast.UnaryOp) and isinstance(arg.op, ast.Not))) \
+                and valueRange[1] >= 1:
+            # Always True or False, and bool is an int.
+            return arg
+        int_call_arg = _is_int_call(arg)
+        if int_call_arg is not None and _is_int_ast(int_call_arg):
+            arg = int_call_arg
+        return getAstNode_intWrap(valueRange, arg)
+
+
+_masked_int_arithmetic = _MaskedIntArithmetic()
+
+
 class _CtypesWrappedHoister(ast.NodeTransformer):
     """For each ``ast.FunctionDef`` body, replace repeated
     ``ctypes_wrapped.<name>`` attribute loads with a single up-front
@@ -3088,7 +4376,572 @@ class _CtypesWrappedHoister(ast.NodeTransformer):
 _ctypes_wrapped_hoister = _CtypesWrappedHoister()
 
 
+class _DirectCallLinker(ast.NodeTransformer):
+    """Replace direct C function calls ``g.<name>(...)`` by calls of the
+    closure variable ``__cf_<name>``, and wrap the ``ast.FunctionDef`` as::
+
+        def __link_<func>():
+            __cf_<name> = None
+            def <func>(...): ...
+            return <func>, None
+
+    If the function takes its params as plain values (see _directCallRawArgs),
+    the translated function becomes the raw entry, and the normal entry unwraps the args::
+
+        def __link_<func>():
+            __cfr_<name> = None
+            def __raw_<func>(a, b): ...
+            def <func>(a, b):
+                return __raw_<func>(a.value, b.value)
+            return <func>, __raw_<func>
+
+    Calls with plain value args go to ``__cfr_<name>``, the raw entry of the callee.
+    :func:`Interpreter._linkDirectCalls` fills the closure cells
+    after the function was created, see Interpreter.direct_calls.
+    """
+
+    CellPrefix = "__cf_"
+    RawCellPrefix = "__cfr_"
+    LinkerPrefix = "__link_"
+    RawPrefix = "__raw_"
+
+    def __init__(self):
+        self.names = None
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if (getattr(func, "c_direct_call", False)
+                and isinstance(func, ast.Attribute)
+                and isinstance(func.value, ast.Name)
+                and func.value.id == "g"):
+            if func.c_direct_call == "raw":
+                local = self.RawCellPrefix + func.attr
+            else:
+                local = self.CellPrefix + func.attr
+            self.names.setdefault(local, local)
+            node.func = ast.Name(id=local, ctx=ast.Load())
+        return node
+
+    def link(self, funcDef):
+        """
+        :param ast.FunctionDef funcDef: will be modified inplace
+        :return: the wrapping linker function, or `funcDef` if there are no direct calls and no raw entry
+        :rtype: ast.FunctionDef
+        """
+        self.names = {}  # ordered: local -> local
+        try:
+            funcDef.body = [self.visit(s) for s in funcDef.body]
+            names = self.names
+        finally:
+            self.names = None
+        rawArgs = getattr(funcDef, "c_raw_args", False)
+        if not names and not rawArgs:
+            return funcDef
+        name = funcDef.name
+        outer = ast.FunctionDef(
+            name=self.LinkerPrefix + name,
+            args=ast.arguments(args=[], vararg=None, kwarg=None, defaults=[]),
+            body=[], decorator_list=[])
+        for local in names:
+            outer.body.append(ast.Assign(
+                targets=[ast.Name(id=local, ctx=ast.Store())], value=ast.Name(id="None", ctx=ast.Load())))
+        if rawArgs:
+            funcDef.name = self.RawPrefix + name
+            argNames = [getattr(a, "arg", getattr(a, "id", a)) for a in funcDef.args.args]
+            entry = ast.FunctionDef(
+                name=name,
+                args=ast.arguments(
+                    args=[ast.Name(id=a, ctx=ast.Param()) for a in argNames],
+                    vararg=None, kwarg=None, defaults=[]),
+                body=[ast.Return(value=ast.Call(
+                    func=ast.Name(id=funcDef.name, ctx=ast.Load()),
+                    args=[ast.Attribute(value=ast.Name(id=a, ctx=ast.Load()), attr="value", ctx=ast.Load())
+                          for a in argNames],
+                    keywords=[], starargs=None, kwargs=None))],
+                decorator_list=[])
+            outer.body += [funcDef, entry]
+            result = [ast.Name(id=name, ctx=ast.Load()), ast.Name(id=funcDef.name, ctx=ast.Load())]
+        else:
+            # In the function body, its own name must still refer to the global (e.g. `g`),
+            # not to the closure variable which the def statement in the linker introduces.
+            if not self._isLocalName(funcDef, name):
+                funcDef.body.insert(0, ast.Global(names=[name]))
+            outer.body.append(funcDef)
+            result = [ast.Name(id=name, ctx=ast.Load()), ast.Name(id="None", ctx=ast.Load())]
+        outer.body.append(ast.Return(value=ast.Tuple(elts=result, ctx=ast.Load())))
+        return outer
+
+    @staticmethod
+    def _isLocalName(funcDef, name):
+        args = funcDef.args
+        argNames = [getattr(a, "arg", getattr(a, "id", a)) for a in args.args + [args.vararg, args.kwarg]]
+        if name in argNames:
+            return True
+        for sub in ast.walk(funcDef):
+            if isinstance(sub, ast.Name) and sub.id == name and not isinstance(sub.ctx, ast.Load):
+                return True
+        return False
+
+
+_direct_call_linker = _DirectCallLinker()
+
+
+class _LazyFuncLink(object):
+    """
+    Initial content of a direct call closure cell (see :class:`_DirectCallLinker`)
+    when the callee is not translated yet, e.g. for recursive calls or forward references.
+    On the first call, it resolves the function (or its raw entry) and puts it into the cell.
+    """
+
+    __slots__ = ("globalsWrapper", "name", "cell", "raw")
+
+    def __init__(self, globalsWrapper, name, cell, raw=False):
+        self.globalsWrapper = globalsWrapper
+        self.name = name
+        self.cell = cell
+        self.raw = raw
+
+    def __call__(self, *args):
+        func = getattr(self.globalsWrapper, self.name)
+        if self.raw:
+            func = _getRawEntry(func)
+        self.cell.cell_contents = func
+        return func(*args)
+
+
+def _getRawEntry(func):
+    """
+    :param function func: translated function, or any other callable with C_argTypes, e.g. a replaced one
+    :return: callable which takes the plain values of the args, see _directCallRawArgs
+    """
+    rawFunc = getattr(func, "C_rawEntry", None)
+    if rawFunc is None:
+        argTypes = func.C_argTypes
+        def rawFunc(*args):
+            return func(*[t(a) for (t, a) in zip(argTypes, args)])
+    return rawFunc
+
+
+def _fix_ast_arguments(node):
+    node.args = [ast.arg(arg=a.id, annotation=None) if isinstance(a, ast.Name) else a
+                 for a in getattr(node, "args", [])]
+    for field in ("vararg", "kwarg"):
+        if isinstance(getattr(node, field, None), str):
+            setattr(node, field, ast.arg(arg=getattr(node, field), annotation=None))
+    return node
+
+def _fix_ast_call(node):
+    starargs = node.__dict__.pop("starargs", None)
+    kwargs = node.__dict__.pop("kwargs", None)
+    if starargs is not None:
+        node.args = list(node.args) + [ast.Starred(value=starargs, ctx=ast.Load())]
+    if kwargs is not None:
+        node.keywords = list(node.keywords) + [ast.keyword(arg=None, value=kwargs)]
+    return node
+
+def _fix_ast_raise(node):
+    if "type" in node.__dict__:
+        node.exc = node.__dict__.pop("type")
+        node.cause = None
+        node.__dict__.pop("inst", None)
+        node.__dict__.pop("tback", None)
+    return node
+
+_ast_name_constants = {"None": None, "True": True, "False": False}
+
+def _fix_ast_name(node):
+    if node.id in _ast_name_constants:
+        return ast.Constant(value=_ast_name_constants[node.id])
+    return node
+
+# The translator builds some nodes in the Python 2 form, which only works via the unparse + parse path.
+_ast_compile_fixes = {} if PY2 else {
+    ast.arguments: _fix_ast_arguments, ast.Call: _fix_ast_call, ast.Raise: _fix_ast_raise, ast.Name: _fix_ast_name}
+
+_ast_list_fields = frozenset([
+    "args", "posonlyargs", "kwonlyargs", "kw_defaults", "defaults", "keywords", "body", "orelse", "finalbody",
+    "handlers", "decorator_list", "targets", "elts", "keys", "values", "ops", "comparators", "names",
+    "generators", "ifs", "type_ignores"])
+
+
+def _prepare_ast_for_compile(pyAst):
+    """
+    Prepares the generated AST for a direct compile(), see Interpreter.compile_ast_directly.
+    This converts the Python 2 forms (see `_ast_compile_fixes`), sets unset optional fields,
+    and sets the locations such that each statement has its own line, numbered in pre-order,
+    for code which is compiled without source, see :class:`_SourceLines`.
+
+    :param ast.AST pyAst: e.g. ast.Interactive. Must not need a fix itself.
+    :return: the statements, in the order of their line numbers
+    :rtype: list[ast.stmt]
+    """
+    stmts = []
+    stmt_type = ast.stmt
+    AST = ast.AST
+    fixes = _ast_compile_fixes
+    list_fields = _ast_list_fields
+    set_end = not PY2
+
+    def visit(node, lineno):
+        fix = fixes.get(node.__class__)
+        if fix is not None:
+            node = fix(node)
+        if isinstance(node, stmt_type):
+            stmts.append(node)
+            lineno = len(stmts)
+        has_loc = bool(node._attributes)
+        if has_loc:
+            node.lineno = lineno
+            node.col_offset = 0
+        d = node.__dict__
+        for field in node._fields:
+            if field not in d:
+                value = getattr(node, field, None)  # might be a class default
+                if value is None:
+                    setattr(node, field, [] if field in list_fields else None)
+                    continue
+            else:
+                value = d[field]
+            if isinstance(value, AST):
+                new = visit(value, lineno)
+                if new is not value:
+                    setattr(node, field, new)
+            elif isinstance(value, (list, tuple)):
+                if isinstance(value, tuple):
+                    value = list(value)
+                    setattr(node, field, value)
+                for i, item in enumerate(value):
+                    if isinstance(item, AST):
+                        new = visit(item, lineno)
+                        if new is not item:
+                            value[i] = new
+        if has_loc and set_end:
+            node.end_lineno = len(stmts) if isinstance(node, stmt_type) else lineno
+            node.end_col_offset = 0
+        return node
+
+    visit(pyAst, 1)
+    return stmts
+
+
+def _unparse_with_stmt_lines(pyAst):
+    """
+    :param ast.AST pyAst:
+    :return: source code, and id(stmt) -> line number in it
+    :rtype: (str, dict[int,int])
+    """
+    from six import StringIO
+    from .py_demo_unparse import Unparser
+
+    class StmtLinesUnparser(Unparser):
+        def __init__(self, *args, **kwargs):
+            self.stmt_lines = {}
+            self.num_newlines = 0
+            Unparser.__init__(self, *args, **kwargs)
+
+        def fill(self, text=""):
+            self.num_newlines += 1 + text.count("\n")
+            Unparser.fill(self, text)
+
+        def write(self, text):
+            self.num_newlines += text.count("\n")
+            Unparser.write(self, text)
+
+        def dispatch(self, tree):
+            if isinstance(tree, ast.stmt):
+                # Each statement starts with a fill(), i.e. on the line after the next newline.
+                self.stmt_lines[id(tree)] = self.num_newlines + 2
+            Unparser.dispatch(self, tree)
+
+    output = StringIO()
+    unparser = StmtLinesUnparser(pyAst, file=output)
+    output.write("\n")
+    return output.getvalue(), unparser.stmt_lines
+
+
+class _SourceLines:
+    """
+    The Python source of compiled code, and its lines for linecache.
+    If the code was compiled directly from the AST, the source is only generated
+    on first access, e.g. for a traceback. Then line i is the first source line
+    of statement i, see :func:`_prepare_ast_for_compile`.
+    """
+
+    def __init__(self, pyAst=None, stmts=None, source=None, lines=None):
+        self.pyAst = pyAst
+        self.stmts = stmts
+        self.source = source
+        if source is not None and lines is None:
+            lines = [line + "\n" for line in source.splitlines()]
+        self.lines = lines
+
+    def get_source(self):
+        """
+        :rtype: str
+        """
+        if self.source is None:
+            self._generate()
+        return self.source
+
+    def _generate(self):
+        self.source, stmt_lines = _unparse_with_stmt_lines(self.pyAst)
+        src_lines = self.source.splitlines()
+        if not self.stmts:  # expression
+            self.lines = [line + "\n" for line in src_lines]
+            return
+        self.lines = []
+        for stmt in self.stmts:
+            lineno = stmt_lines.get(id(stmt))  # e.g. an "elif" does not dispatch the inner if-statement
+            self.lines.append((src_lines[lineno - 1] if lineno else "") + "\n")
+
+    def _get_lines(self):
+        if self.lines is None:
+            self._generate()
+        return self.lines
+
+    def __len__(self): return len(self._get_lines())
+    def __getitem__(self, i): return self._get_lines()[i]
+    def __iter__(self): return iter(self._get_lines())
+
+
+def _compile_ast(pyAst, filename, mode, directly=False):
+    """
+    Compiles and registers the source in linecache.
+
+    :param ast.AST pyAst: statement, or expression for mode "eval"
+    :param str filename:
+    :param str mode: "single", "exec" or "eval", like for compile()
+    :param bool directly: compile the AST directly, without generating the source, see :class:`_SourceLines`.
+      Otherwise we unparse + parse again, which is slower but gives real line numbers.
+    :return: code object, source
+    :rtype: (types.CodeType, _SourceLines)
+    """
+    if directly:
+        if mode == "eval":
+            wrapped = ast.Expression(body=pyAst.value if isinstance(pyAst, ast.Expr) else pyAst)
+        elif mode == "exec":
+            wrapped = ast.Module(body=[pyAst])
+            wrapped.type_ignores = []
+        else:
+            wrapped = ast.Interactive(body=[pyAst])
+        source = _SourceLines(pyAst=pyAst, stmts=_prepare_ast_for_compile(wrapped))
+        code = compile(wrapped, filename, mode)
+    else:
+        source = _SourceLines(source=_unparse(pyAst))
+        code = compile(source.get_source(), filename, mode)
+    _set_linecache(filename, source)
+    return code, source
+
+
+_translator_digest = None
+
+def translator_digest():
+    """
+    :return: sha1 of the translator code and the Python version (see marshal). The translated code depends on it.
+    :rtype: str
+    """
+    global _translator_digest
+    if _translator_digest is None:
+        import hashlib
+        from . import cwrapper, interpreter_utils, py_demo_unparse
+        h = hashlib.sha1(sys.version.encode("utf-8"))
+        for mod in (cparser, sys.modules[__name__], cwrapper, interpreter_utils, goto, py_demo_unparse):
+            fn = mod.__file__
+            if fn.endswith(".pyc"): fn = fn[:-1]
+            with open(fn, "rb") as f:
+                h.update(f.read())
+        _translator_digest = h.hexdigest()
+    return _translator_digest
+
+
+class FuncNotCacheable(Exception): pass
+
+class FuncCacheDescription:
+    """
+    Canonical description of a C function for the persistent function cache,
+    see Interpreter.persistent_func_cache. It covers the function itself and the
+    declarations it refers to; of other functions, only the signature
+    (and the body if it gets inlined, see Interpreter.inline_small_funcs).
+    """
+
+    SkipAttribs = ("parent", "defPos", "_state", "_ctype", "_ctype_cached")
+    WrappedValueDicts = ("funcs", "vars", "typedefs")
+
+    def __init__(self, interpreter, cfunc):
+        """
+        :param Interpreter interpreter:
+        :param CFunc cfunc:
+        :raises FuncNotCacheable: e.g. if it refers to an anonymous wrapped value
+        """
+        self.interpreter = interpreter
+        self.cfunc = cfunc
+        self.visited = {}  # id(obj) -> idx
+        self.wrapValues = []  # CWrapValue, which the translation refers to via `values`
+        self.description = self._describe(cfunc)
+
+    def key(self):
+        """
+        :rtype: str
+        """
+        options = [(attr, getattr(self.interpreter, attr)) for attr in self.interpreter.FuncCacheKeyAttribs]
+        return "%s %s %r" % (translator_digest(), options, self.description)
+
+    def _describe(self, obj):
+        if obj is None or isinstance(obj, (bool, int, long, float, str, unicode)):
+            return obj
+        if isinstance(obj, (list, tuple)):
+            return (type(obj).__name__, [self._describe(v) for v in obj])
+        if isinstance(obj, dict):
+            return ("dict", [(k, self._describe(v)) for (k, v) in sorted(obj.items())])
+        if isinstance(obj, (State, CStateWrapper)):
+            return "state"
+        idx = self.visited.get(id(obj))
+        if idx is not None:
+            return ("ref", idx)
+        self.visited[id(obj)] = len(self.visited)
+        if isinstance(obj, CWrapValue):
+            return self._describeWrapValue(obj)
+        if getattr(obj.__class__, "__module__", None) != cparser.__name__:
+            raise FuncNotCacheable("cannot describe %r" % obj)
+        attribs = []
+        for k, v in sorted(vars(obj).items()):
+            if k in self.SkipAttribs: continue
+            if k == "body" and isinstance(obj, CFunc) and obj is not self.cfunc:
+                if self.interpreter.direct_calls:
+                    attribs.append(("rawArgs", _directCallRawArgs(self.interpreter, obj)))
+                v = _inlineCandidateExpr(self.interpreter, obj)
+                if v is None: continue
+                v = v[1]
+            attribs.append((k, self._describe(v)))
+        return (obj.__class__.__name__, attribs)
+
+    def _describeWrapValue(self, wrapValue):
+        stateStruct = self.interpreter._cStateWrapper
+        for dictName in self.WrappedValueDicts:
+            if wrapValue.name and getattr(stateStruct, dictName).get(wrapValue.name) is wrapValue:
+                self.wrapValues.append(wrapValue)
+                return ("wrap", dictName, wrapValue.name, self._describe(wrapValue.decl))
+        raise FuncNotCacheable("anonymous wrapped value %r" % wrapValue)
+
+
+class ArenaHeap:
+    """
+    Heap for :func:`Interpreter._malloc`, see ``Interpreter.arena_malloc``.
+    Allocations are carved out of big ctypes byte arrays (arenas),
+    and freed blocks go into a free list per size class.
+    The arenas live as long as the heap, so an address is resolved to its arena
+    by a dict lookup of its chunk (``addr >> ChunkShift``),
+    and nothing needs to be registered in ``Interpreter.pointerStorage``.
+    All memory which is not allocated is kept zeroed.
+    """
+
+    ArenaSize = 1 << 20
+    ChunkShift = 20
+    Align = 16
+    MaxSmallSize = 256
+
+    def __init__(self, byteType):
+        """
+        :param type byteType: ctypes byte type for the arenas
+        """
+        self.byteType = byteType
+        self.arenas = []  # ctypes arrays
+        self.chunks = {}  # addr >> ChunkShift -> list of (start, end, arena)
+        self.sizes = {}  # allocated block addr -> size class
+        self.freeLists = {}  # size class -> list of addrs
+        self.bumpStart = self.bumpPos = self.bumpEnd = 0
+
+    def _sizeClass(self, size):
+        if size <= self.MaxSmallSize:
+            return max((size + self.Align - 1) & ~(self.Align - 1), self.Align)
+        return 1 << (size - 1).bit_length()
+
+    def _newArena(self, size):
+        """
+        :return: (start, end) of the usable memory
+        :rtype: (int, int)
+        """
+        arena = (self.byteType * (size + self.Align))()
+        start = _ctype_get_ptr_addr(arena)
+        end = start + size + self.Align
+        self.arenas.append(arena)
+        for chunk in range(start >> self.ChunkShift, ((end - 1) >> self.ChunkShift) + 1):
+            self.chunks.setdefault(chunk, []).append((start, end, arena))
+        start = (start + self.Align - 1) & ~(self.Align - 1)
+        return start, start + size
+
+    def lookup(self, addr):
+        """
+        :param int addr:
+        :return: arena which contains addr (or one-past-the-end), or None
+        :rtype: ctypes.Array|None
+        """
+        for start, end, arena in self.chunks.get(addr >> self.ChunkShift, ()):
+            if start <= addr <= end:
+                return arena
+        return None
+
+    def malloc(self, size):
+        """
+        :param int size:
+        :return: addr of zeroed memory
+        :rtype: int
+        """
+        cls = self._sizeClass(size)
+        freeList = self.freeLists.get(cls)
+        if freeList:
+            addr = freeList.pop()
+        elif cls > self.ArenaSize // 4:
+            addr, _ = self._newArena(cls)
+        else:
+            if self.bumpPos + cls > self.bumpEnd:
+                self.bumpStart, self.bumpEnd = self._newArena(self.ArenaSize)
+                self.bumpPos = self.bumpStart
+            addr = self.bumpPos
+            self.bumpPos += cls
+        self.sizes[addr] = cls
+        return addr
+
+    def free(self, addr):
+        """
+        :param int addr: must have been allocated by us
+        """
+        cls = self.sizes.pop(addr)
+        ctypes.memset(addr, 0, cls)
+        if self.bumpStart <= addr and addr + cls == self.bumpPos:
+            self.bumpPos = addr
+        else:
+            self.freeLists.setdefault(cls, []).append(addr)
+
+    def realloc(self, addr, size):
+        """
+        :param int addr: must have been allocated by us
+        :param int size:
+        :return: new addr. grows in place if possible
+        :rtype: int
+        """
+        cls = self.sizes[addr]
+        if size <= cls:
+            return addr
+        newCls = self._sizeClass(size)
+        if self.bumpStart <= addr and addr + cls == self.bumpPos and addr + newCls <= self.bumpEnd:
+            self.bumpPos = addr + newCls
+            self.sizes[addr] = newCls
+            return addr
+        newAddr = self.malloc(size)
+        ctypes.memmove(newAddr, addr, cls)
+        self.free(addr)
+        return newAddr
+
+
 class Interpreter:
+    # Interpreter attributes which the translation depends on, see FuncCacheDescription.
+    FuncCacheKeyAttribs = (
+        "pointer_size", "debug_log_assign", "compile_ast_directly", "raw_local_vars", "masked_int_arithmetic",
+        "fat_pointers", "func_ptr_inline_cache", "direct_calls", "inline_small_funcs", "inline_max_size",
+        "range_for_loops", "loop_idioms")
+
     def __init__(self):
         self.stateStructs = []
         self._cStateWrapper = CStateWrapper(self)
@@ -3103,6 +4956,7 @@ class Interpreter:
         self.ctypes_wrapped = CTypesWrapper()
         self.helpers = Helpers(self)
         self.mallocs = {}  # ptr addr -> ctype obj
+        self._arenaHeap = None  # ArenaHeap, see arena_malloc
         # Note: The pointerStorage will only weakly ref the ctype objects.
         # When the real ctype objects go out of scope, we don't want to
         # keep them alive.
@@ -3136,6 +4990,39 @@ class Interpreter:
         self.debug_print_getFunc = False
         self.debug_print_getVar = False
         self.debug_log_assign = False
+        # Compile the generated AST directly. The Python source is then only generated when needed,
+        # e.g. for a traceback or C_unparse of the function, and the line numbers are statement numbers.
+        self.compile_ast_directly = False
+        # Keep int and double local vars and params whose address is never taken as plain Python values
+        # instead of ctypes objects. Needs Python 3.8 (assignment expressions).
+        self.raw_local_vars = False
+        # Compute the int wraparound of C arithmetic with masking instead of via temporary ctypes objects.
+        self.masked_int_arithmetic = False
+        # Store translated functions in caching.CACHING_DIR, so that repeated runs skip the translation.
+        self.persistent_func_cache = False
+        # Let _malloc carve the memory out of big arenas (see ArenaHeap), instead of a new ctypes buffer
+        # for every allocation which also needs to be registered in pointerStorage.
+        self.arena_malloc = False
+        # Keep local pointer vars and params whose address is never taken as FatPtr objects,
+        # so that pointer arithmetic and dereferencing don't need the pointerStorage registry.
+        # Needs Python 3.8 (assignment expressions).
+        self.fat_pointers = False
+        # Call function pointers via Helpers.cachedFuncPtrCall, which has an inline cache per call site.
+        self.func_ptr_inline_cache = False
+        # Bind direct calls of other C functions as closure variables instead of `g.<name>` lookups,
+        # and pass int and double args as plain values (see _directCallRawArgs).
+        # Pays off mostly together with raw_local_vars. Needs Python 3.7 (writable closure cells).
+        self.direct_calls = False
+        # Inline calls of small static functions, see _inlineCandidateExpr.
+        # inline_max_size is the max number of nodes of the C expression.
+        # Needs Python 3.8 (assignment expressions).
+        self.inline_small_funcs = False
+        self.inline_max_size = 20
+        # Translate counted C for-loops into Python for-loops over range(), see _astForCForRange.
+        self.range_for_loops = False
+        # Translate copy, fill, compare and strlen loops over arrays into bulk ctypes operations,
+        # see _getAstNode_loopIdiom and _astForCForStrlen.
+        self.loop_idioms = False
         self.aborted = False
 
     def _cStateWrapperError(self, s):
@@ -3239,6 +5126,10 @@ class Interpreter:
         """
         if size == 0:
             size = 1
+        if self.arena_malloc:
+            if self._arenaHeap is None:
+                self._arenaHeap = ArenaHeap(self.ctypes_wrapped.c_byte)
+            return wrapCTypeClass(ctypes.c_void_p)(self._arenaHeap.malloc(size))
         buf = (self.ctypes_wrapped.c_byte * size)()
         ptr_addr = _ctype_get_ptr_addr(buf)
         self.mallocs[ptr_addr] = buf
@@ -3254,6 +5145,8 @@ class Interpreter:
         """
         if not ptr_addr:
             return self._malloc(size)
+        if self._arenaHeap is not None and ptr_addr in self._arenaHeap.sizes:
+            return wrapCTypeClass(ctypes.c_void_p)(self._arenaHeap.realloc(ptr_addr, size))
         try:
             buf = self.mallocs.pop(ptr_addr)
         except KeyError:
@@ -3445,6 +5338,10 @@ class Interpreter:
         """
         if not ptr_addr:
             return  # free(NULL) is a no-op in C
+        if self._arenaHeap is not None and ptr_addr in self._arenaHeap.sizes:
+            # The arena stays alive, thus entries in pointerStorage stay valid.
+            self._arenaHeap.free(ptr_addr)
+            return
         if ptr_addr not in self.mallocs:
             raise Exception("_free: address 0x%x was not allocated by us" % ptr_addr)
         buf = self.mallocs.pop(ptr_addr)
@@ -3486,6 +5383,8 @@ class Interpreter:
             self.pointerStorage[ptr_addr] = value
             return ptr
         assert not isinstance(ptr, ctypes._CFuncPtr)  # should have been catched above
+        if self._arenaHeap is not None and self._arenaHeap.lookup(ptr_addr) is not None:
+            return ptr  # _getPtr finds it in the arena
         if ptr_addr - offset in self.pointerStorage:
             base_obj = self.pointerStorage[ptr_addr - offset]
             self.pointerStorage[ptr_addr] = base_obj
@@ -3601,14 +5500,18 @@ class Interpreter:
         if addr in self.pointerStorage:
             obj = self.pointerStorage[addr]
         else:
+            obj = None
+            if self._arenaHeap is not None:
+                obj = self._arenaHeap.lookup(addr)
             # Not found directly; try range-based lookup for interior pointers
             # (e.g. alignment-derived addresses like _Py_ALIGN_DOWN results).
             # See ``_storePtr`` range fallback comment: a single
             # predecessor lookup is enough given the non-overlap
             # invariant on ``pointerStorageRanges``.
-            obj = self._lookupPointerStorageRange(addr)
-            if obj is not None:
-                self.pointerStorage[addr] = obj  # cache for future lookups
+            if obj is None:
+                obj = self._lookupPointerStorageRange(addr)
+                if obj is not None:
+                    self.pointerStorage[addr] = obj  # cache for future lookups
             if obj is None:
                 # Diagnostic: dump the nearest registered ranges + storage
                 # entries so we can see WHY ``addr`` isn't covered.
@@ -3652,7 +5555,10 @@ class Interpreter:
         # consistently with ``getAstNodeForVarDecl`` and other access
         # sites.
         base.astNode.name = py_safe_identifier(func.name)
+        base.rawArgs = _directCallRawArgs(self, func)
         base.pushScope(base.astNode.body)
+        if (self.raw_local_vars or self.fat_pointers) and hasattr(ast, "NamedExpr") and not self.debug_log_assign:
+            base.rawVars = _findRawLocalVars(base, func)
         for arg in func.args:
             if isinstance(arg.type, CVariadicArgsType):
                 name = base.registerNewUnscopedVarName("varargs", initNone=False)
@@ -3683,10 +5589,17 @@ class Interpreter:
         if base.needGotoHandling:
             gotoVarName = base.registerNewUnscopedVarName("goto", initNone=False)
             base.astNode = goto.transform_goto(base.astNode, gotoVarName)
+        base.astNode.c_raw_args = base.rawArgs  # see _DirectCallLinker
         return base
 
     def _compile(self, pyAst, mode="single"):
-        # We unparse + parse again for now for better debugging (so we get some code in a backtrace).
+        return self._compileWithSource(pyAst, mode=mode)[0]
+
+    def _compileWithSource(self, pyAst, mode="single"):
+        """
+        :return: code object, source
+        :rtype: (types.CodeType, _SourceLines)
+        """
         SRC_FILENAME = "<PyCParser_%s>" % getattr(pyAst, "name", "unknown")
         # Apply peephole optimisations to the AST.  The generic
         # translator emits ``ctypes_wrapped.c_int(int(<x>)).value``
@@ -3695,35 +5608,119 @@ class Interpreter:
         # translation (smaller source) and execution (fewer
         # attribute lookups, allocations) measurably faster.
         _peephole_optimizer.visit(pyAst)
+        if self.masked_int_arithmetic:
+            _masked_int_arithmetic.visit(pyAst)
         _ctypes_wrapped_hoister.visit(pyAst)
-        ast.fix_missing_locations(pyAst)
-        def _unparseAndParse(pyAst):
-            src = _unparse(pyAst)
-            _set_linecache(SRC_FILENAME, src)
-            return compile(src, SRC_FILENAME, mode)
-        def _justCompile(pyAst):
-            exprAst = ast.Interactive(body=[pyAst])
-            ast.fix_missing_locations(exprAst)
-            return compile(exprAst, SRC_FILENAME, mode)
-        return _unparseAndParse(pyAst)
+        if self.direct_calls and isinstance(pyAst, ast.FunctionDef) and sys.version_info >= (3, 7):
+            pyAst = _direct_call_linker.link(pyAst)
+        if not self.compile_ast_directly:
+            ast.fix_missing_locations(pyAst)
+        return _compile_ast(pyAst, SRC_FILENAME, mode, directly=self.compile_ast_directly)
 
     def _translateFuncToPy(self, funcname):
         cfunc = self._cStateWrapper.funcs[funcname]
         if self.debug_print_getFunc: print("+ getFunc %s" % cfunc)
-        funcEnv = self._translateFuncToPyAst(cfunc)
-        pyAst = funcEnv.astNode
-        compiled = self._compile(pyAst)
+        if self.persistent_func_cache:
+            func = self._translateFuncToPyCached(cfunc)
+        else:
+            funcEnv = self._translateFuncToPyAst(cfunc)
+            pyAst = funcEnv.astNode
+            compiled, source = self._compileWithSource(pyAst)
+            func = self._makeFunc(cfunc, compiled, pyAst=pyAst, unparse=source.get_source)
+        return func
+
+    def _makeFunc(self, cfunc, compiled, pyAst, unparse):
         d = {}
         eval(compiled, self.globalsDict, d)
-        func = d[funcname]
+        linker = d.get(_DirectCallLinker.LinkerPrefix + py_safe_identifier(cfunc.name))
+        rawFunc = None
+        if linker is not None:
+            func, rawFunc = linker()
+            self._linkDirectCalls(rawFunc or func)
+        else:
+            func = d[cfunc.name]
+        func.C_rawEntry = rawFunc  # see _directCallRawArgs
         func.C_cFunc = cfunc
         func.C_pyAst = pyAst
         func.C_interpreter = self
         func.C_argTypes = [a.type for a in cfunc.args]
         func.C_resType = cfunc.type
-        func.C_unparse = lambda: _unparse(pyAst)
+        func.C_unparse = unparse
         return func
 
+    def _linkDirectCalls(self, func):
+        """
+        Fills the direct call closure cells of `func`, see :class:`_DirectCallLinker`.
+        Already translated callees are bound directly, all others lazily via :class:`_LazyFuncLink`.
+
+        :param function func:
+        """
+        for local, cell in zip(func.__code__.co_freevars, func.__closure__ or ()):
+            if local.startswith(_DirectCallLinker.RawCellPrefix):
+                name, raw = local[len(_DirectCallLinker.RawCellPrefix):], True
+            elif local.startswith(_DirectCallLinker.CellPrefix):
+                name, raw = local[len(_DirectCallLinker.CellPrefix):], False
+            else:
+                continue
+            callee = self.globalsWrapper.__dict__.get(name)
+            if callee is None:
+                callee = _LazyFuncLink(self.globalsWrapper, name, cell, raw=raw)
+            elif raw:
+                callee = _getRawEntry(callee)
+            cell.cell_contents = callee
+
+    def _translateFuncToPyCached(self, cfunc):
+        """
+        Like :func:`_translateFuncToPy` but via caching.FuncCache.
+        On a hit, C_pyAst of the function is None.
+        """
+        from . import caching
+        import marshal
+        caching.flush_at_exit()
+        try:
+            description = FuncCacheDescription(self, cfunc)
+        except FuncNotCacheable:
+            description = None
+        entry = None
+        if description is not None:
+            key = description.key()
+            try:
+                entry = caching.FuncCache.Load(key)
+            except caching.CacheMiss:
+                entry = None
+            if entry is not None:
+                names = [self.wrappedValues.get_value(v) for v in description.wrapValues]
+                if names != entry.valueNames:
+                    entry = None  # the names in the code differ
+        if entry is not None:
+            caching.stats.func_hits += 1
+            compiled = marshal.loads(entry.code)
+            source = _SourceLines(source=entry.source, lines=entry.lines)
+            _set_linecache(compiled.co_filename, source)
+            return self._makeFunc(cfunc, compiled, pyAst=None, unparse=source.get_source)
+        caching.stats.func_misses += 1
+        prevRecorded, self.wrappedValues.recorded = self.wrappedValues.recorded, []
+        try:
+            funcEnv = self._translateFuncToPyAst(cfunc)
+        finally:
+            recorded, self.wrappedValues.recorded = self.wrappedValues.recorded, prevRecorded
+        pyAst = funcEnv.astNode
+        compiled, source = self._compileWithSource(pyAst)
+        if description is not None and all([v in description.wrapValues for v in recorded]):
+            entry = caching.FuncCache()
+            entry.__dict__["_key"] = key
+            entry.code = marshal.dumps(compiled)
+            entry.source = source.get_source()
+            entry.lines = list(source)
+            entry.valueNames = [self.wrappedValues.get_value(v) for v in description.wrapValues]
+            try:
+                entry.save()
+            except Exception as e:
+                print("(Safe to ignore) Error while saving translated function %s: %s" % (cfunc.name, e))
+            else:
+                caching.stats.func_saves += 1
+        return self._makeFunc(cfunc, compiled, pyAst=pyAst, unparse=source.get_source)
+
     def getFunc(self, funcname):
         """
         :param str funcname:
@@ -193,6 +193,12 @@ class Unparser:
 
     def _Raise(self, t):
         self.fill('raise ')
+        if getattr(t, "exc", None):  # Python 3
+            self.dispatch(t.exc)
+            if t.cause:
+                self.write(" from ")
+                self.dispatch(t.cause)
+            return
         if t.type:
             self.dispatch(t.type)
         if t.inst:
@@ -455,6 +461,13 @@ class Unparser:
             interleave(lambda: self.write(", "), self.dispatch, t.elts)
         self.write(")")
 
+    def _NamedExpr(self, t):
+        self.write("(")
+        self.dispatch(t.target)
+        self.write(" := ")
+        self.dispatch(t.value)
+        self.write(")")
+
     unop = {"Invert":"~", "Not": "not", "UAdd":"+", "USub":"-"}
     def _UnaryOp(self, t):
         self.write("(")
@@ -584,13 +597,16 @@ class Unparser:
             if first:first = False
             else: self.write(", ")
             self.write("*")
-            self.write(t.vararg)
+            if isinstance(t.vararg, str): self.write(t.vararg)
+            else: self.dispatch(t.vararg)
 
         # kwargs
         if t.kwarg:
             if first:first = False
             else: self.write(", ")
-            self.write("**"+t.kwarg)
+            self.write("**")
+            if isinstance(t.kwarg, str): self.write(t.kwarg)
+            else: self.dispatch(t.kwarg)
 
     def _arg(self, t):
         """
@@ -601,8 +617,15 @@ class Unparser:
         self.write(t.arg)
 
     def _keyword(self, t):
-        self.write(t.arg)
-        self.write("=")
+        if t.arg is None:
+            self.write("**")
+        else:
+            self.write(t.arg)
+            self.write("=")
+        self.dispatch(t.value)
+
+    def _Starred(self, t):
+        self.write("*")
         self.dispatch(t.value)
 
     def _Lambda(self, t):
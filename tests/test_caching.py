@@ -0,0 +1,355 @@
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import helpers_test  # side effect: make cparser importable
+from cparser import caching
+from cparser.cparser import State, parse
+from cparser.interpreter import Interpreter
+from helpers_test import assert_equal
+
+
+HEADER_A = """
+#ifndef A_H
+#define A_H
+#define N 4
+typedef struct { int x[N]; } S;
+struct T { S s; int y; };
+enum E { E1, E2 = 5 };
+static int f(int a) { return a + N + E2; }
+#include "b.h"
+#endif
+"""
+
+HEADER_B = """
+typedef int myint;
+#define M(x) ((x) * 2)
+static myint h(myint v) { return M(v); }
+"""
+
+MAIN = """
+#include "a.h"
+int main() { return f(1) + h(2); }
+"""
+
+
+class _CacheDir:
+    def __enter__(self):
+        self.prev_dir = caching.CACHING_DIR
+        self.dir = tempfile.mkdtemp()
+        caching.CACHING_DIR = self.dir + "/cache/"
+        caching.stats.reset()
+        for fn, content in (("a.h", HEADER_A), ("b.h", HEADER_B), ("main.c", MAIN)):
+            self.write(fn, content)
+        return self
+
+    def __exit__(self, *exc):
+        caching.CACHING_DIR = self.prev_dir
+        shutil.rmtree(self.dir)
+
+    def write(self, fn, content):
+        with open(self.dir + "/" + fn, "w") as f:
+            f.write(content)
+
+    def cache_files(self):
+        files = []
+        for dirpath, _, filenames in os.walk(caching.CACHING_DIR):
+            files += [os.path.join(dirpath, fn) for fn in filenames]
+        return sorted(files)
+
+    def parse(self, state=None):
+        if state is None:
+            state = State()
+            state.autoSetupSystemMacros()
+        parse(self.dir + "/main.c", state, cache=True)
+        assert not state._errors, state._errors
+        return state
+
+
+def _summary(state):
+    return (sorted(state.funcs), sorted(state.typedefs), sorted(state.structs), sorted(state.enums),
+            sorted((k, str(v)) for (k, v) in state.macros.items()), len(state.contentlist))
+
+
+def _run_main(state):
+    interpreter = Interpreter()
+    interpreter.register(state)
+    return interpreter.runFunc("main").value
+
+
+def test_caching_hit():
+    with _CacheDir() as d:
+        state1 = d.parse()
+        files = d.cache_files()
+        assert files
+        assert not [fn for fn in files if os.path.basename(fn).startswith(".tmp")]
+        state2 = d.parse()
+        assert_equal(d.cache_files(), files)
+        assert_equal(_summary(state2), _summary(state1))
+        assert state2.funcs["f"] is not state1.funcs["f"]
+        assert_equal(_run_main(state2), 1 + 4 + 5 + 4)
+
+
+def test_caching_hit_does_not_parse():
+    with _CacheDir() as d:
+        d.parse()
+        # The entry is keyed by the content hash, so this must not be read again.
+        state = State()
+        state.autoSetupSystemMacros()
+        orig_readLocalInclude = state.readLocalInclude
+        read_files = []
+        def readLocalInclude(filename):
+            read_files.append(filename)
+            return orig_readLocalInclude(filename)
+        state.readLocalInclude = readLocalInclude
+        d.parse(state)
+        assert_equal(read_files, [d.dir + "/main.c", "a.h"])
+        assert "h" in state.funcs
+
+
+def test_caching_header_changed():
+    with _CacheDir() as d:
+        d.parse()
+        d.write("b.h", HEADER_B.replace("* 2", "* 3"))
+        state = d.parse()
+        assert_equal(state.macros["M"].rightside.strip(), "((x) * 3)")
+        assert_equal(_run_main(state), 1 + 4 + 5 + 6)
+
+
+def test_caching_macro_dependency():
+    with _CacheDir() as d:
+        d.parse()
+        state = State()
+        state.autoSetupSystemMacros()
+        list(state.preprocess_source_code("#define A_H\n"))
+        parse(d.dir + "/main.c", state, cache=True)
+        assert "f" not in state.funcs
+        assert "S" not in state.typedefs
+        state = d.parse()
+        assert "f" in state.funcs
+
+
+def test_caching_version_mismatch():
+    with _CacheDir() as d:
+        d.parse()
+        prev_version = caching.CacheVersion
+        caching.CacheVersion = prev_version + 1
+        try:
+            state = d.parse()
+        finally:
+            caching.CacheVersion = prev_version
+        assert_equal(_run_main(state), 1 + 4 + 5 + 4)
+
+
+def test_caching_stats():
+    with _CacheDir() as d:
+        d.parse()
+        assert_equal((caching.stats.hits, caching.stats.misses, caching.stats.saves), (0, 2, 2))
+        assert_equal(caching.stats.miss_reasons, {"no-entry": 2})
+        d.parse()
+        assert_equal((caching.stats.hits, caching.stats.misses), (1, 2))
+        assert "1 hits, 2 misses" in str(caching.stats)
+
+
+def test_caching_touched_file_is_rehashed():
+    with _CacheDir() as d:
+        d.parse()
+        hashed_files = caching.stats.hashed_files
+        d.parse()
+        assert_equal(caching.stats.hashed_files, hashed_files)  # size+mtime unchanged
+        st = os.stat(d.dir + "/b.h")
+        os.utime(d.dir + "/b.h", (st.st_atime, st.st_mtime + 10))
+        d.parse()
+        assert_equal(caching.stats.hashed_files, hashed_files + 1)
+        assert_equal(caching.stats.hits, 2)
+        assert_equal(caching.stats.invalidations, {})
+
+
+def test_caching_touched_file_stat_is_saved():
+    with _CacheDir() as d:
+        d.parse()
+        for fn in ("a.h", "b.h"):
+            st = os.stat(d.dir + "/" + fn)
+            os.utime(d.dir + "/" + fn, (st.st_atime, st.st_mtime + 10))
+        # Each run with a fresh digest memo, like a new process.
+        for expected_hashed in (2, 0):
+            caching._file_digests.clear()
+            caching.stats.reset()
+            d.parse()
+            assert_equal(caching.stats.hashed_files, expected_hashed)
+            assert_equal(caching.stats.hits, 1)
+
+
+def test_caching_invalidation_reason():
+    with _CacheDir() as d:
+        d.parse()
+        st = os.stat(d.dir + "/b.h")
+        d.write("b.h", HEADER_B.replace("* 2", "* 3"))
+        os.utime(d.dir + "/b.h", (st.st_atime, st.st_mtime + 10))
+        d.parse()
+        assert_equal(caching.stats.hits, 0)
+        assert_equal(caching.stats.invalidations, {"dep-changed": 2})
+        assert_equal(caching.stats.miss_reasons, {"no-entry": 2, "dep-changed": 2})
+        os.remove(d.dir + "/b.h")
+        state = State()
+        parse(d.dir + "/main.c", state, cache=True)
+        assert_equal(caching.stats.invalidations, {"dep-changed": 2, "dep-removed": 1})
+
+
+def test_caching_index_lru_prune():
+    with _CacheDir() as d:
+        d.parse()
+        index = caching.get_index()
+        entries = index.load()["entries"]
+        assert_equal(sorted(entries), sorted([os.path.relpath(fn, caching.CACHING_DIR) for fn in d.cache_files()
+                                              if not fn.endswith(caching.CacheIndex.Filename)]))
+        oldest = min(entries, key=lambda rel: entries[rel][1])
+        total = sum([e[0] for e in entries.values()])
+        assert_equal(index.prune(total - 1), (1, entries[oldest][0]))
+        assert not os.path.exists(caching.CACHING_DIR + oldest)
+        assert_equal(sorted(index.load()["entries"]), sorted(set(entries) - set([oldest])))
+        state = d.parse()
+        assert_equal(_run_main(state), 1 + 4 + 5 + 4)
+
+
+def test_caching_max_bytes():
+    with _CacheDir() as d:
+        prev_max_bytes = caching.CACHING_MAX_BYTES
+        caching.CACHING_MAX_BYTES = 1
+        try:
+            d.parse()
+        finally:
+            caching.CACHING_MAX_BYTES = prev_max_bytes
+        assert_equal([os.path.basename(fn) for fn in d.cache_files()], [caching.CacheIndex.Filename])
+        assert_equal(caching.get_index().load()["entries"], {})
+
+
+def test_caching_max_bytes_unbounded():
+    assert_equal(caching.parse_max_bytes("1024"), 1024)
+    assert_equal(caching.parse_max_bytes("0"), None)
+    assert_equal(caching.parse_max_bytes("None"), None)
+    with _CacheDir() as d:
+        prev_max_bytes = caching.CACHING_MAX_BYTES
+        caching.CACHING_MAX_BYTES = None
+        try:
+            d.parse()
+        finally:
+            caching.CACHING_MAX_BYTES = prev_max_bytes
+        num_files = len(d.cache_files())
+        assert num_files > 1
+        caching.main(["--dir", caching.CACHING_DIR, "--max-bytes", "0", "prune"])
+        assert_equal(len(d.cache_files()), num_files)
+
+
+def test_caching_cli():
+    with _CacheDir() as d:
+        d.parse()
+        d.parse()
+        caching.main(["--dir", caching.CACHING_DIR, "stats"])
+        assert_equal(caching.get_index().load()["stats"]["hits"], 1)
+        caching.main(["--dir", caching.CACHING_DIR, "prune"])
+        assert len(d.cache_files()) > 1
+        caching.main(["--dir", caching.CACHING_DIR, "clear"])
+        assert_equal(d.cache_files(), [])
+
+
+def test_caching_serializer():
+    state = helpers_test.parse(
+        "typedef struct S { int a; struct S* next; } S;\n"
+        "static int f(S* s) { return s->next->a; }\n")
+    f = state.funcs["f"]
+    shared = [1, "x"]
+    obj = {"f": f, "shared": (shared, shared), "t": (1, "x", None), "e": []}
+    data = caching._Serializer(stateStruct=state, ownObjs=[f]).dumps(obj)
+    loaded = caching._Deserializer(stateStruct=state).loads(data)
+    assert_equal(sorted(loaded.keys()), sorted(obj.keys()))
+    assert_equal(loaded["t"], (1, "x", None))
+    assert_equal(loaded["shared"][0], shared)
+    assert loaded["shared"][0] is loaded["shared"][1]
+    g = loaded["f"]
+    assert g is not f and g.__class__ is f.__class__
+    assert_equal(g.name, "f")
+    assert_equal(sorted(g.__dict__.keys()), sorted(k for k in f.__dict__.keys() if k not in ("_ctype", "_ctype_cached")))
+    assert g.body.contentlist[0].parent is g
+    # Not part of the serialized objects, thus referenced by name.
+    assert g.args[0].type.pointerOf is state.typedefs["S"]
+    try:
+        caching._Deserializer(stateStruct=State()).loads(data)
+    except caching.CacheMiss as exc:
+        assert "'S' is unknown" in str(exc)
+    else:
+        assert False, "expected CacheMiss"
+    prev_version = caching.FormatVersion
+    caching.FormatVersion = prev_version + 1
+    try:
+        caching._Deserializer(stateStruct=state).loads(data)
+    except caching.CacheMiss as exc:
+        assert "format version" in str(exc)
+    else:
+        assert False, "expected CacheMiss"
+    finally:
+        caching.FormatVersion = prev_version
+
+
+def test_caching_hit_with_predefined_macro():
+    with _CacheDir() as d:
+        d.write("b.h", "#if __GNUC__ >= 2\n" + HEADER_B + "#endif\n")
+        d.parse()
+        d.parse()
+        assert_equal(caching.stats.hits, 1)
+        state = State()
+        state.autoSetupSystemMacros()
+        list(state.preprocess_source_code("#undef __GNUC__\n#define __GNUC__ 1\n"))
+        parse(d.dir + "/main.c", state, cache=True)
+        assert_equal(caching.stats.hits, 1)
+        assert "h" not in state.funcs
+
+
+FUNC_PROGRAM = """
+#include <stdio.h>
+typedef struct { int a; int b; } P;
+int g(P* p) { return p->a * p->b; }
+int main() { P p; p.a = 3; p.b = 4; printf("%i\\n", g(&p)); return g(&p) + 1; }
+"""
+
+
+def _run_func_cached(d, src):
+    d.write("prog.c", src)
+    state = State()
+    state.autoSetupSystemMacros()
+    state.autoSetupGlobalIncludeWrappers()
+    parse(d.dir + "/prog.c", state)
+    assert not state._errors, state._errors
+    interpreter = Interpreter()
+    interpreter.register(state)
+    interpreter.persistent_func_cache = True
+    return interpreter, interpreter.runFunc("main").value
+
+
+def test_caching_translated_funcs():
+    with _CacheDir() as d:
+        interpreter, res = _run_func_cached(d, FUNC_PROGRAM)
+        assert_equal(res, 13)
+        assert_equal((caching.stats.func_hits, caching.stats.func_misses, caching.stats.func_saves), (0, 2, 2))
+        interpreter, res = _run_func_cached(d, FUNC_PROGRAM)
+        assert_equal(res, 13)
+        assert_equal((caching.stats.func_hits, caching.stats.func_misses), (2, 2))
+        f = interpreter.getFunc("g")
+        assert f.C_pyAst is None
+        assert "def g(" in f.C_unparse()
+
+
+def test_caching_translated_funcs_changed():
+    with _CacheDir() as d:
+        _run_func_cached(d, FUNC_PROGRAM)
+        # Only main changes.
+        _, res = _run_func_cached(d, FUNC_PROGRAM.replace("+ 1;", "+ 2;"))
+        assert_equal(res, 14)
+        assert_equal((caching.stats.func_hits, caching.stats.func_misses), (1, 3))
+        # The struct layout changes, which both functions depend on.
+        _, res = _run_func_cached(d, FUNC_PROGRAM.replace("int a; int b;", "int b; char a;"))
+        assert_equal(res, 13)
+        assert_equal((caching.stats.func_hits, caching.stats.func_misses), (1, 5))
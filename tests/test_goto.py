@@ -98,3 +98,86 @@ def test_transform_goto():
     func = d["foo"]
     r = func()
     assert_equal(r, 5)
+
+
+def _transform_and_compile(s, labels):
+    """
+    :param dict[int,goto.GotoLabel|goto.GotoStatement] labels: replaces the `pass` at this line of the body
+    """
+    f = parse(fix_code(s)).body[0]
+    _set_goto_markers(f.body, labels)
+    f = goto.transform_goto(f, "goto")
+    ss = unparse(f)
+    print(ss)
+    d = {}
+    eval(compile(ss, "<src>", "exec"), d, d)
+    return ss, d[f.name]
+
+
+def _set_goto_markers(body, labels):
+    for i, s in enumerate(body):
+        if isinstance(s, ast.Pass) and s.lineno in labels:
+            body[i] = labels[s.lineno]
+        for field in ("body", "orelse"):
+            if isinstance(getattr(s, field, None), list):
+                _set_goto_markers(getattr(s, field), labels)
+
+
+def test_transform_goto_structured_cleanup():
+    s = """
+    def foo(n):
+        r = []
+        for i in range(n):
+            if i == 3:
+                pass
+            r.append(i)
+        r.append("end")
+        pass
+        r.append("cleanup")
+        return r
+    """
+    ss, func = _transform_and_compile(s, {5: goto.GotoStatement("out"), 8: goto.GotoLabel("out")})
+    assert "goto ==" not in ss  # no flattened dispatch
+    assert_equal(func(2), [0, 1, "end", "cleanup"])
+    assert_equal(func(5), [0, 1, 2, "cleanup"])
+
+
+def test_transform_goto_structured_backward():
+    s = """
+    def foo(n):
+        r = [n]
+        pass
+        n -= 1
+        r.append(n)
+        while n > 5:
+            n -= 1
+            if n == 7:
+                break
+            if n % 2:
+                pass
+        if n > 0:
+            pass
+        return r
+    """
+    ss, func = _transform_and_compile(s, {
+        3: goto.GotoLabel("again"), 11: goto.GotoStatement("again"), 13: goto.GotoStatement("again")})
+    assert "goto ==" not in ss
+    assert_equal(func(3), [3, 2, 1, 0])
+    assert_equal(func(10), [10, 9, 6, 4, 3, 2, 1, 0])
+
+
+def test_transform_goto_into_block_fallback():
+    s = """
+    def foo(n):
+        r = []
+        pass
+        while n > 0:
+            n -= 1
+            r.append(n)
+            pass
+            r.append("x")
+        return r
+    """
+    ss, func = _transform_and_compile(s, {3: goto.GotoStatement("here"), 7: goto.GotoLabel("here")})
+    assert "goto ==" in ss  # flattened
+    assert_equal(func(2), ["x", 1, "x", 0, "x"])
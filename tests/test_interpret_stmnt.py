@@ -463,6 +463,40 @@ def test_interpret_goto_with_if_else():
     assert r.value == 5
 
 
+def test_interpret_goto_structured():
+    state = parse("""
+    int f(int n) {
+        int i, j, r = 0;
+    again:
+        for (i = 0; i < n; i++) {
+            for (j = 0; j < n; j++) {
+                if (j == 3) continue;
+                r += j;
+                if (r > 1000) goto out;
+                if (r == 7) { r++; goto again; }
+            }
+            if (i == 5) goto err;
+        }
+        r += 1;
+    out:
+        return r;
+    err:
+        return -r;
+    }
+    """)
+    interpreter = Interpreter()
+    interpreter.register(state)
+
+    print("Func dump:")
+    interpreter.dumpFunc("f", output=sys.stdout)
+    assert "goto ==" in interpreter.getFunc("f").C_unparse()  # propagated through the for-loops
+    assert "if (goto is None)" not in interpreter.getFunc("f").C_unparse()  # not flattened
+    print("Run f:")
+    assert_equal(interpreter.runFunc("f", 4).value, 21)
+    assert_equal(interpreter.runFunc("f", 30).value, 1005)
+    assert_equal(interpreter.runFunc("f", 10).value, -260)
+
+
 def test_interpret_for_loop_empty():
     state = parse("""
     int f() {
@@ -5856,5 +5890,58 @@ def test_interpret_nested_ternary_mixed_int_unsigned():
     assert r_val == 0xff, "expected 0xff, got 0x%x" % r_val
 
 
+def test_interpret_switch_jump_table():
+    src = """
+    int dense(int x) {
+        int r = 0;
+        switch (x) {
+            case 1: r += 1;
+            case 2: r += 10; break;
+            default: r += 100;
+            case 5: r += 1000;
+            case 4: r += 10000; break;
+            case 3: { int y = x * 2; r += y; }
+        }
+        return r;
+    }
+    int sparse(int x) {
+        int i, r = 0;
+        for (i = 0; i < 3; i++) {
+            switch (x + i) {
+                case -1000000: r += 1; break;
+                case -7: r += 2; continue;
+                case 0: r += 3;
+                case 42: r += 4; break;
+                case 1 << 20: r += 5; break;
+                case 99999: r += 6; break;
+                case 100000: r += 7; break;
+            }
+            r *= 2;
+        }
+        return r;
+    }
+    """
+    state = parse(src)
+    interp = Interpreter()
+    interp.register(state)
+    assert "_switchfallthrough" not in interp.getFunc("dense").C_unparse()
+    expected_dense = {1: 11, 2: 10, 3: 6, 4: 10000, 5: 11000}
+    for x in range(-2, 8):
+        assert interp.runFunc("dense", x).value == expected_dense.get(x, 11100), x
+
+    def sparse(x):
+        r = 0
+        for i in range(3):
+            v = x + i
+            cases = {-1000000: [1], -7: [2], 0: [3, 4], 42: [4], 1 << 20: [5], 99999: [6], 100000: [7]}
+            r += sum(cases.get(v, []))
+            if v == -7:
+                continue
+            r *= 2
+        return r
+    for x in (-1000002, -1000000, -9, -8, -7, -2, -1, 0, 40, 41, 42, (1 << 20) - 1, 99998, 99999, 100000, 5):
+        assert interp.runFunc("sparse", x).value == sparse(x), x
+
+
 if __name__ == '__main__':
     helpers_test.main(globals())
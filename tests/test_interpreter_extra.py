@@ -4,6 +4,7 @@ from cparser.interpreter import Interpreter, GlobalsWrapper, getAstNodeForVarTyp
 from cparser.cparser import State, CArrayType, CBuiltinType, CStatement, CIdentifier, CVarDecl, CPointerType, CFuncCall, CSizeofSymbol, getConstValue
 import ctypes
 import ast
+import sys
 
 
 def test_globals_wrapper_getattr_attribute_error():
@@ -2409,6 +2410,473 @@ def test_file_and_function_scope_same_name_static_are_distinct_at_runtime():
     assert interp.runFunc("inc_func_scope").value == 30
 
 
+def test_compile_ast_directly_same_results():
+    state = parse("""
+    int f(int n) {
+        int i, r = 0;
+        for (i = 0; i < n; ++i) {
+            switch (i % 3) { case 0: r += i; break; case 1: continue; default: r -= 1; }
+            if (r > 10) goto out;
+        }
+    out:
+        return r;
+    }
+    """)
+    results = []
+    for directly in (False, True):
+        interp = Interpreter()
+        interp.register(state)
+        interp.compile_ast_directly = directly
+        results.append([interp.runFunc("f", n).value for n in range(20)])
+        assert "def f(" in interp.getFunc("f").C_unparse()
+    assert results[0] == results[1]
+
+
+def test_compile_ast_directly_lazy_source_in_traceback():
+    import linecache
+    import traceback
+    state = parse("""
+    extern int the_fn(int);
+    int run(int x) {
+        int y = x + 1;
+        return the_fn(y);
+    }
+    """)
+    interp = Interpreter()
+    interp.register(state)
+    interp.compile_ast_directly = True
+
+    def _raising(x):
+        raise ValueError("x=%r" % x)
+    _raising.C_argTypes = [ctypes.c_int]
+    _raising.C_resType = ctypes.c_int
+    interp._func_cache["the_fn"] = _raising
+    f = interp.getFunc("run")
+    lines = linecache.cache[f.__code__.co_filename][2]
+    assert lines.source is None  # not generated yet
+    try:
+        interp.runFunc("run", 1)
+    except ValueError:
+        frames = [fr for fr in traceback.extract_tb(sys.exc_info()[2]) if fr[0] == f.__code__.co_filename]
+    else:
+        assert False, "expected ValueError"
+    assert len(frames) == 1
+    assert "the_fn" in frames[0][3], frames
+    assert lines.source is not None
+
+
+def test_raw_local_vars_same_results():
+    state = parse("""
+    static int inc(int* p) { return ++*p; }
+    int f(int n) {
+        int i, j = 0, r = 0, taken = n;
+        unsigned char c = 250;
+        short s = 32760;
+        unsigned int u = 0;
+        double d = 0.5;
+        for (i = 0; i < n; i++) {
+            c++; s += 3; u -= i; d *= 1.5;
+            r += i-- * 2;
+            r = r + (j = i++) + ++j;
+            if (i % 4 == 0) inc(&taken);
+            switch (i & 3) { case 0: r ^= c; break; case 1: r -= s; break; default: r += (int) d; }
+            do { j--; } while (j > 0);
+        }
+        return r + c + s + (int) (u >> 16) + taken + j;
+    }
+    """)
+    results = []
+    for raw in (False, True):
+        interp = Interpreter()
+        interp.register(state)
+        interp.raw_local_vars = raw
+        results.append([interp.runFunc("f", n).value for n in range(0, 40, 7)])
+        assert (":=" in interp.getFunc("f").C_unparse()) == raw
+    assert results[0] == results[1]
+
+
+def test_raw_local_vars_escape_analysis():
+    state = parse("""
+    static void set(int* p) { *p = 42; }
+    int f(int a) {
+        int i = 0, k = 1;
+        int arr[2];
+        set(&k);
+        arr[0] = a;
+        for (i = 0; i < a; ++i) k += arr[0];
+        return k;
+    }
+    """)
+    interp = Interpreter()
+    interp.register(state)
+    interp.raw_local_vars = True
+    f = interp.getFunc("f")
+    src = f.C_unparse()
+    assert "i = 0" in src and "helpers.prefixInc(i)" not in src
+    assert "k = ctypes_wrapped.c_int(" in src or "k = __cw_c_int(" in src
+    assert f(ctypes.c_int(3)) == 42 + 3 * 3
+
+
+def test_masked_int_arithmetic_same_results():
+    types = [
+        "char", "unsigned char", "short", "unsigned short", "int", "unsigned int",
+        "long", "unsigned long", "long long", "unsigned long long",
+        "int8_t", "uint8_t", "int16_t", "uint16_t", "int32_t", "uint32_t", "int64_t", "uint64_t", "size_t"]
+    src = "#include <stdint.h>\n"
+    for i, t in enumerate(types):
+        src += """
+        long long f_%(i)i(%(t)s a, %(t)s b) {
+            long long s = 0;
+            %(t)s r = a;
+            r *= b; r -= 3;
+            s = s * 7 + (a + b) / 3;
+            s = s * 7 + (a - b) / 3;
+            s = s * 7 + (a * b) / 3;
+            s = s * 7 + ((a << (b & 7)) ^ (a >> (b & 7))) / 3;
+            s = s * 7 + ((a & b) | (a < b) | (a == b) | (a && b) | !a) / 3;
+            s = s * 7 + (~b - -a) / 3;
+            return s * 7 + r;
+        }
+        %(t)s g_%(i)i(%(t)s a, %(t)s b) { return a / b + a %% b; }
+        """ % {"t": t, "i": i}
+    state = parse(src, withGlobalIncludeWrappers=True)
+    values = [0, 1, 7, -1, -128, 255, -32768, 65535, 2 ** 31 - 1, -2 ** 31, 2 ** 32 - 1, 2 ** 63 - 1]
+    results = []
+    for masked in (False, True):
+        interp = Interpreter()
+        interp.register(state)
+        interp.masked_int_arithmetic = masked
+        res = []
+        for i in range(len(types)):
+            for a in values:
+                for b in values:
+                    res.append(interp.runFunc("f_%i" % i, a, b).value)
+                    try:
+                        res.append(interp.runFunc("g_%i" % i, a, b).value)
+                    except ZeroDivisionError:
+                        res.append(ZeroDivisionError)
+        results.append(res)
+        assert ("& 255)" in interp.getFunc("f_0").C_unparse()) == masked
+    assert results[0] == results[1]
+
+
+def test_arena_malloc_same_results():
+    state = parse("""
+    #include <stdlib.h>
+    #include <string.h>
+    typedef struct Node { int v; struct Node* next; } Node;
+    long f(int rounds) {
+        long total = 0;
+        int round, i;
+        for (round = 0; round < rounds; round++) {
+            Node* head = 0;
+            for (i = 0; i < 20; i++) {
+                Node* n = (Node*) malloc(sizeof(Node));
+                total += n->v;  /* zeroed, also when reused */
+                n->v = i * round;
+                n->next = head;
+                head = n;
+            }
+            while (head) {
+                Node* n = head;
+                total += n->v;
+                head = n->next;
+                free(n);
+            }
+            int* a = (int*) calloc(4, sizeof(int));
+            for (i = 0; i < 50; i++) {
+                a = (int*) realloc(a, (i + 5) * sizeof(int));
+                a[i + 4] = i;
+            }
+            for (i = 0; i < 54; i++) total += a[i];
+            free(a);
+            char* s = (char*) malloc(10);
+            strcpy(s, "hello");
+            total += strlen(s);
+            free(s);
+        }
+        return total;
+    }
+    """, withGlobalIncludeWrappers=True)
+    results = []
+    for arena in (False, True):
+        interp = Interpreter()
+        interp.register(state)
+        interp.arena_malloc = arena
+        results.append(interp.runFunc("f", 5).value)
+        assert (interp._arenaHeap is not None) == arena
+    assert interp._arenaHeap.arenas and not interp._arenaHeap.sizes
+    assert results[0] == results[1] == 10 * 190 + 5 * 1225 + 5 * 5
+
+
+def test_arena_heap():
+    from cparser.interpreter import ArenaHeap
+    heap = ArenaHeap(ctypes.c_byte)
+    a = heap.malloc(10)
+    b = heap.malloc(20)
+    assert b == a + 16
+    assert heap.lookup(a) is heap.lookup(b + 31) is heap.arenas[0]
+    assert heap.lookup(a - 10 ** 7) is None
+    # The last block grows in place.
+    assert heap.realloc(b, 100) == b
+    ctypes.memset(a, 1, 16)
+    heap.free(a)
+    assert heap.malloc(16) == a
+    assert (ctypes.c_byte * 16).from_address(a)[:] == [0] * 16
+    c = heap.malloc(1)
+    assert heap.realloc(a, 17) != a
+    heap.free(c)
+    assert heap.malloc(1) == c  # bump pointer went back
+    big = heap.malloc(heap.ArenaSize)
+    assert heap.lookup(big + heap.ArenaSize) is heap.arenas[-1]
+
+
+def test_fat_pointers_same_results():
+    state = parse("""
+    #include <string.h>
+    #include <stdlib.h>
+    typedef struct P { int x; int y; struct P* next; } P;
+    int sum(const int* a, int n) {
+        int s = 0;
+        const int* end = a + n;
+        while (a < end) s += *a++;
+        return s;
+    }
+    int slen(const char* s) { const char* p = s; while (*p) p++; return p - s; }
+    void fill(int* a, int n) { int i; for (i = 0; i < n; i++) a[i] = i * i; }
+    int walk(P* p) { int r = 0; while (p) { r += p->x * p->y; p = p->next; } return r; }
+    void rev(char* s) { char* e = s + strlen(s) - 1; while (s < e) { char t = *s; *s++ = *e; *e-- = t; } }
+    int f() {
+        int a[100]; int* q; int* r; int i, tot = 0;
+        P ps[5];
+        char buf[32];
+        fill(a, 100);
+        for (i = 0; i < 5; i++) { ps[i].x = i; ps[i].y = i + 1; ps[i].next = i < 4 ? &ps[i + 1] : 0; }
+        q = &a[10];
+        q += 5; q--;
+        r = &q[2];
+        tot += *q + q[-2] + (int)(q - a) + *r + !q + (r == &a[16]);
+        int* m = (int*) malloc(10 * sizeof(int));
+        fill(m, 10);
+        tot += sum(m, 10) + sum(a, 100) + walk(ps) + slen("hello world");
+        free(m);
+        strcpy(buf, "abcdef");
+        rev(buf);
+        return tot * 10 + (buf[0] == 'f') + (buf[5] == 'a');
+    }
+    int g() {
+        P* p = 0;
+        return p->x;
+    }
+    """, withGlobalIncludeWrappers=True)
+    results = []
+    for fat in (False, True):
+        interp = Interpreter()
+        interp.register(state)
+        interp.fat_pointers = fat
+        results.append(interp.runFunc("f").value)
+        assert ("helpers.fatPtr(" in interp.getFunc("sum").C_unparse()) == fat
+        try:
+            interp.runFunc("g")
+        except ValueError as exc:
+            assert "NULL pointer" in str(exc)
+        else:
+            assert False, "expected ValueError"
+    assert results[0] == results[1] == 3292972
+
+
+def test_func_ptr_inline_cache_same_results():
+    state = parse("""
+    #include <stdlib.h>
+    typedef int (*binop)(int, int);
+    typedef struct { binop op; int arg; } Step;
+    static int add(int a, int b) { return a + b; }
+    static int mul(int a, int b) { return a * b; }
+    static int sub(int a, int b) { return a - b; }
+    static int neg(int a) { return -a; }
+    int cmp(const void* a, const void* b) { return *(const int*) a - *(const int*) b; }
+    int f() {
+        binop ops[3] = {add, mul, sub};
+        Step steps[4] = {{add, 3}, {mul, 5}, {sub, 7}, {(binop) neg, 0}};
+        int arr[5] = {5, 3, 9, 1, 7};
+        int i, r = 1;
+        for (i = 0; i < 30; i++) r = ops[i % 3](r, i) % 1000;
+        for (i = 0; i < 4; i++) r = steps[i].op(r, steps[i].arg);
+        qsort(arr, 5, sizeof(int), cmp);
+        return r * 100 + arr[0] * 10 + arr[4];
+    }
+    """, withGlobalIncludeWrappers=True)
+    results = []
+    for cache in (False, True):
+        interp = Interpreter()
+        interp.register(state)
+        interp.func_ptr_inline_cache = cache
+        results.append(interp.runFunc("f").value)
+        assert ("helpers.cachedFuncPtrCall(" in interp.getFunc("f").C_unparse()) == cache
+    assert results[0] == results[1] == -50281, results
+    sites = interp.helpers.funcPtrCallSites
+    assert sorted(sites) == ["f:0", "f:1"]
+    assert len(sites["f:0"]) == 3 and len(sites["f:1"]) == 4
+
+
+def test_direct_calls_same_results():
+    state = parse("""
+    static int sq(int x) { return x * x; }
+    static int fib(int n) { return n < 2 ? n : fib(n - 1) + fib(n - 2); }
+    static int later(int x);
+    static int acc(int i) { return sq(i) % 7 + later(i); }
+    static int later(int x) { return x & 3; }
+    static double half(double d, char c) { return d / 2 + c; }
+    static void inc(int* p) { *p += 1; }
+    int g(int x) { int* p = &x; inc(p); return x + 1; }
+    int f() {
+        int i, r = 0;
+        for (i = 0; i < 100; i++) r += acc(i);
+        return r * 1000 + fib(10) + g(1) + (int) half(7, 'a');
+    }
+    """)
+    results = []
+    for direct in (False, True):
+        interp = Interpreter()
+        interp.register(state)
+        interp.direct_calls = direct
+        results.append(interp.runFunc("f").value)
+        func = interp.getFunc("f")
+        assert ("__cfr_" in func.C_unparse()) == direct
+        assert ("__raw_" in interp.getFunc("g").C_unparse()) == direct
+        if direct:
+            cells = dict(zip(func.__code__.co_freevars, [c.cell_contents for c in func.__closure__]))
+            # All callees were called, thus the lazy links have been replaced.
+            assert cells["__cfr_g"] is interp.getFunc("g").C_rawEntry
+            assert cells["__cfr_fib"] is interp.getFunc("fib").C_rawEntry
+            assert interp.getFunc("inc").C_rawEntry is None  # pointer param
+            g = interp.getFunc("g")
+            g_cells = dict(zip(g.C_rawEntry.__code__.co_freevars, [c.cell_contents for c in g.C_rawEntry.__closure__]))
+            assert g_cells["__cf_inc"] is interp.getFunc("inc")
+    # The normal entry still takes ctypes objects.
+    assert interp.getFunc("fib")(ctypes.c_int(10)) == 55
+    assert results[0] == results[1] == 347 * 1000 + 55 + 3 + 100, results
+    # A replaced callee without raw entry gets the args converted back.
+    interp = Interpreter()
+    interp.register(state)
+    interp.direct_calls = True
+    def _sq(x):
+        assert isinstance(x, ctypes.c_int)
+        return 0
+    _sq.C_argTypes = [ctypes.c_int]
+    _sq.C_resType = ctypes.c_int
+    interp._func_cache["sq"] = _sq
+    assert interp.runFunc("f").value == 150 * 1000 + 55 + 3 + 100
+
+
+def test_inline_small_funcs_same_results():
+    state = parse("""
+    typedef struct { int refcnt; int v; } Obj;
+    static inline int sq(int x) { return x * x; }
+    static inline int zero(int x) { return 0; }
+    static inline void incref(Obj* o) { o->refcnt++; }
+    static inline int getv(const Obj* o) { return o->v; }
+    static int later(int x);
+    static int fib(int n) { return n < 2 ? n : fib(n - 1) + fib(n - 2); }
+    static int big(int x) { return x + x + x + x + x + x + x + x + x + x + x + x + x + x; }
+    int notstatic(int x) { return x + 1; }
+    int f(int n) {
+        Obj o = {1, 7};
+        int i, j = 0, r = 0;
+        for (i = 0; i < n; i++) {
+            r += sq(j++) + zero(j++) + sq(sq(i)) % 13 + later(i) + getv(&o);
+            incref(&o);
+        }
+        return r * 1000 + o.refcnt + j + fib(10) + big(1) + notstatic(1);
+    }
+    static int later(int x) { return sq(x) & 3; }
+    """)
+    results = []
+    for inline in (False, True):
+        interp = Interpreter()
+        interp.register(state)
+        interp.inline_small_funcs = inline
+        results.append([interp.runFunc("f", n).value for n in (0, 1, 10)])
+        src = interp.getFunc("f").C_unparse()
+        for name in ("sq", "zero", "incref", "getv", "later"):
+            assert ("%s(" % name in src) != inline, (name, src)
+        for name in ("fib", "big", "notstatic"):
+            assert "%s(" % name in src, name
+    assert results[0] == results[1] == [72, 7075, 1260102], results
+
+
+def test_range_for_loops_same_results():
+    state = parse("""
+    int a[100];
+    int counted(int n) {
+        int i, j, s = 0;
+        for (i = 0; i < n; i++) { a[i] = i * 3; s += a[i] & 5; }
+        for (j = n - 1; j >= 0; j -= 3) s += a[j] & 1;
+        for (int k = 1; k <= n; k += 2) { if (k > 50) break; if (k & 4) continue; s += k; }
+        for (i = 5; i <= 2; i++) s += 1000;
+        return s * 1000000 + i * 1000 + j + 5;
+    }
+    int not_counted(int n) {
+        int i, s = 0;
+        int* p = &s;
+        for (i = 0; i < n; i++) { if (i == 3) i += 2; s++; }
+        for (i = 0; i < s; i++) (*p)--;
+        return s * 1000 + i;
+    }
+    """)
+    results = []
+    for rangeLoops in (False, True):
+        for raw in (False, True):
+            interp = Interpreter()
+            interp.register(state)
+            interp.range_for_loops = rangeLoops
+            interp.raw_local_vars = raw
+            results.append([interp.runFunc(f, n).value for f in ("counted", "not_counted") for n in (0, 1, 10, 100)])
+            assert interp.getFunc("counted").C_unparse().count("range(") == (4 if rangeLoops else 0)
+            assert "range(" not in interp.getFunc("not_counted").C_unparse()
+    assert results == [[5004, 1005002, 36005002, 576005002, 0, 1, 4004, 49049]] * 4, results
+
+
+def test_loop_idioms_same_results():
+    state = parse("""
+    int g[20];
+    static int count(const char* s) { int n; for (n = 0; s[n] != 0; n++); return n; }
+    static void copy(int* d, const int* s, int n) { int i; for (i = 0; i < n; i++) d[i] = s[i]; }
+    int f(int k) {
+        int a[20], i, r = 0;
+        char buf[16];
+        for (i = 0; i < 20; i++) a[i] = i * k;
+        copy(g, a, 20);
+        for (i = 1; i < 20; i++) a[i] = a[i - 1];  // overlapping, must propagate
+        r += a[19] + g[19];
+        for (i = 0; i < 19; i++) g[i] = g[i + 1];  // overlapping, like memmove
+        r += g[0] + g[18];
+        for (i = 0; i < 15; i++) buf[i] = 'a' + k;
+        buf[3 + k] = 0;
+        r += count(buf) * 100;
+        for (i = 0; i < 20; i++) if (g[i] != a[i]) break;
+        r += i * 1000;
+        copy(a, g, 20);
+        for (i = 0; i <= 19; i++) if (g[i] != a[i]) break;
+        r += i * 10000;
+        for (i = 2; i < 18; i++) a[i] = 0;
+        for (i = 0; i < 20; i++) r += a[i];
+        return r;
+    }
+    """)
+    results = []
+    for idioms in (False, True):
+        for fat in (False, True):
+            interp = Interpreter()
+            interp.register(state)
+            interp.loop_idioms = idioms
+            interp.fat_pointers = fat
+            results.append([interp.runFunc("f", k).value for k in (0, 1, 5)])
+            src = interp.getFunc("f").C_unparse() + interp.getFunc("count").C_unparse()
+            assert src.count("helpers.bulk") == (7 if idioms else 0), src
+    assert results == [[220300, 200480, 201200]] * 4, results
+
+
 if __name__ == "__main__":
     import helpers_test
     helpers_test.main(globals())
@@ -0,0 +1,279 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from cparser.cparser import _Pre2ParseStream, _cpre2_parse_preprocessed
+from helpers_test import assert_equal
+
+
+_PreprocessSamples = [
+    "int a;\n",
+    "int a; // comment\nint b;\n",
+    "int a; /* multi\nline\ncomment */ int b;\n",
+    "x = a / b; y = a/*c*/b;\n",
+    'char* s = "a // not a comment /* neither */";\n',
+    'char* s = "escaped \\" quote"; char c = \'\\\'\';\n',
+    "#define X 1\nint a = X;\n",
+    "#define F(a, b) ((a) + (b)) /* comment */\nint a = F(1, 2);\n",
+    "#define LONG 1 + \\\n  2\nint a = LONG;\n",
+    "#if 0\nint a;\n#else\nint b;\n#endif\n",
+    "#ifdef FOO\nint a;\n#elif 1\nint b;\n#endif\n",
+    "#  define   X  \"a b\"  // trailing\n#\n#pragma pack(2)\n",
+    '#error "unfinished\nint a;\n',
+    "#if 1 /* unfinished comment\n*/ int a;\n#endif\n",
+    "int a;\t/*\t*/\tint b;\n#define T\tx\n",
+    "int a; #define X 2\nint b = X;\n",
+    "int a = 1 /",
+    "#define X 1",
+]
+
+
+def _preprocess(src, chunked):
+    state = State()
+    state.ChunkedPreprocess = chunked
+    out = "".join(state.preprocess_source_code(src))
+    macros = sorted((k, str(v), v.defPos) for (k, v) in state.macros.items())
+    return out, state._errors, macros
+
+
+def test_chunked_preprocess_same_output():
+    for src in _PreprocessSamples:
+        print("src:", repr(src))
+        assert_equal(_preprocess(src, chunked=True), _preprocess(src, chunked=False))
+
+
+def test_chunked_preprocess_yields_chunks():
+    state = State()
+    state.incIncludeLineChar(fullfilename=None, inc="<input>")
+    chunks = list(cpreprocess_parse_chunks(state, "int a;\n#define X 1\nint b;\n"))
+    assert_equal(chunks, ["int a;\n", "int b;\n", "\n"])
+    assert_equal(state.macros["X"].defPos, "<input>:2:11")
+
+
+def test_chunked_preprocess_position():
+    state = State()
+    state.ChunkedPreprocess = True
+    out = "".join(state.preprocess_source_code("int a;\n\t/* x\n */ #define X 1\n"))
+    assert_equal(out, "int a;\n\t \n")
+    assert_equal(state.macros["X"].defPos, "<input>:3:15")
+
+
+def test_chunked_preprocess_parse_code():
+    state = State()
+    state.autoSetupSystemMacros()
+    state.ChunkedPreprocess = True
+    helpers_test.parse("""
+    #define N 3
+    #if N > 2
+    int a[N];
+    #else
+    int b;
+    #endif
+    """, state=state)
+    assert "a" in state.vars
+    assert "b" not in state.vars
+
+
+def _tokenize(src, chunked):
+    state = State()
+    state.autoSetupSystemMacros()
+    state.ChunkedPreprocess = chunked
+    preprocessed = state.preprocess_source_code_chunks(src)
+    tokens = list(_cpre2_parse_preprocessed(state, preprocessed))
+    return tokens, state._errors
+
+
+def test_chunked_token_stream_same_tokens():
+    src = """
+    #define F(a, b) a ## b
+    #define G(x) F(x, 1) + \\
+        F(x, 2)
+    #define H G(
+    int F(v, w) = G(a) * H b);
+    char* s = "a\\x41" "\\101" L"w";
+    #define E
+    E int x E = 'c' E;
+    """
+    tokens, errors = _tokenize(src, chunked=True)
+    assert not errors, errors
+    assert_equal((tokens, errors), _tokenize(src, chunked=False))
+    assert CIdentifier("vw") in tokens
+    assert CIdentifier("a2") in tokens
+
+
+def test_pre2_parse_stream_chunked():
+    chunks = ["in", "t a", "", "; i", "nt b;\n"]
+    stream = _Pre2ParseStream(iter(chunks), chunked=True)
+    state = State()
+    tokens = list(cpre2_parse(state, stream))
+    assert_equal(tokens, list(cpre2_parse(state, "".join(chunks))))
+    assert_equal(tokens, [CIdentifier("int"), CIdentifier("a"), CSemicolon(),
+                          CIdentifier("int"), CIdentifier("b"), CSemicolon()])
+
+
+def test_parse_code_chunked_pipeline():
+    src = """
+    #define N 4
+    typedef struct { int a[N]; } S;
+    static int f(S* s) { return s->a[N - 1]; }
+    """
+    state = State()
+    state.autoSetupSystemMacros()
+    parse_code(src, state, chunked=True)
+    assert not state._errors, state._errors
+    assert_equal(state.ChunkedPreprocess, False)
+    assert "f" in state.funcs
+    state2 = helpers_test.parse(src)
+    assert_equal(sorted(state.funcs.keys()), sorted(state2.funcs.keys()))
+    assert_equal(sorted(state.typedefs.keys()), sorted(state2.typedefs.keys()))
+
+
+def test_macro_template():
+    tpl = compile_macro_def_rightside(("a", "b"), "f(a) + #b a ## _x b ## b")
+    assert_equal(tpl, [
+        (MacroTplLiteral, "f("), (MacroTplArg, "a"), (MacroTplLiteral, ") + "),
+        (MacroTplStringify, "b"), (MacroTplLiteral, " "), (MacroTplArg, "a"), (MacroTplLiteral, " "),
+        (MacroTplRStrip, None), (MacroTplLiteral, "_x "), (MacroTplArg, "b"), (MacroTplLiteral, " "),
+        (MacroTplRStrip, None), (MacroTplArg, "b")])
+    assert_equal(eval_macro_template(None, tpl, ("a", "b"), ("1", "\"s\"")),
+                 'f(1) + "\\"s\\"" 1_x "s""s"')
+
+
+def test_macro_template_cached():
+    state = State()
+    m = Macro(state, "F", ("x",), "x ## 1 #y ")
+    assert_equal(m.eval(state, ["a"]), "a1  ")
+    assert_equal(len(state._errors), 1)
+    tpl = m._getTemplate()
+    assert m._getTemplate() is tpl
+    assert_equal(m.eval(state, ["b"]), "b1  ")
+    assert_equal(len(state._errors), 2)  # errors are reported on each expansion
+    m.rightside = "(x)"
+    assert m._getTemplate() is not tpl
+    assert_equal(m.eval(state, ["a"]), "(a)")
+
+
+def test_macro_redefinition_expansion():
+    state = State()
+    preprocessed = state.preprocess_source_code_chunks(
+        "#define F(x) x + 1\nF(a)\n#undef F\n#define F(x) x * 2\nF(a)\n")
+    tokens = list(_cpre2_parse_preprocessed(state, preprocessed))
+    assert_equal(tokens, [CIdentifier("a"), COp("+"), CNumber(1), CIdentifier("a"), COp("*"), CNumber(2)])
+
+
+def test_memoized_preprocess_conditions():
+    src = """
+    #define V(x) ((x) >> 8)
+    #define VER 0x0302
+    #define IS_NEW (defined(NEW) || V(VER) >= 3)
+    #if IS_NEW && VER > 0x0300
+    int a1;
+    #endif
+    #undef VER
+    #define VER 0x0201
+    #if IS_NEW && VER > 0x0300
+    int a2;
+    #endif
+    #define NEW
+    #if IS_NEW && VER > 0x0300
+    int a3;
+    #endif
+    #if IS_NEW
+    int a4;
+    #endif
+    #undef NEW
+    #if IS_NEW
+    int a5;
+    #endif
+    #if !IS_NEW && UNKNOWN(1)
+    #endif
+    #if !IS_NEW && UNKNOWN(1)
+    #endif
+    """
+    results = []
+    for memo in (False, True):
+        state = State()
+        state.MemoizePreprocessConditions = memo
+        out = "".join(state.preprocess_source_code(src))
+        results.append((out.split(), len(state._errors)))
+        assert_equal(bool(state._preprocessCondCache), memo)
+    assert_equal(results[0], (["int", "a1;", "int", "a4;"], 2))
+    assert_equal(results[1], results[0])
+
+
+def test_find_include_guard():
+    assert_equal(find_include_guard("// c\n#ifndef A_H\n#define A_H\n#if X\n#else\n#endif\n#endif /* A_H */\n\n"), "A_H")
+    assert_equal(find_include_guard("/* c\n#if 0 */\n# if !defined(B_H)\nint b;\n#  endif\n"), "B_H")
+    assert_equal(find_include_guard("#if !defined C_H\n#define S \"#endif\"\n#endif\n"), "C_H")
+    assert_equal(find_include_guard("#ifndef A_H\n#endif\nint a;\n"), None)
+    assert_equal(find_include_guard("int a;\n#ifndef A_H\n#endif\n"), None)
+    assert_equal(find_include_guard("#ifndef A_H\nint a;\n#else\nint b;\n#endif\n"), None)
+    assert_equal(find_include_guard("#ifndef A_H\n#if X\n#endif\n"), None)
+    assert_equal(find_include_guard("#ifndef A_H \\\n && B\n#endif\n"), None)
+
+
+def test_skip_guarded_includes():
+    import os, shutil, tempfile
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        files = {
+            "a.h": "#ifndef A_H\n#define A_H\nint a;\n#endif\n",
+            "b.h": "#pragma once\nint b;\n",
+            "c.h": "#ifndef C_H\n#define C_H\n#endif\nint c;\n",
+            "main.c": '#include "a.h"\n#include "b.h"\n#include "c.h"\n#include "a.h"\n#include "b.h"\n'
+                      '#include "c.h"\n#undef A_H\n#include "a.h"\n',
+        }
+        for fn, content in files.items():
+            with open(tmp_dir + "/" + fn, "w") as f:
+                f.write(content)
+        results = []
+        for skip in (False, True):
+            state = State()
+            state.SkipGuardedIncludes = skip
+            read_files = []
+            orig_readLocalInclude = state.readLocalInclude
+            def readLocalInclude(filename):
+                read_files.append(filename)
+                return orig_readLocalInclude(filename)
+            state.readLocalInclude = readLocalInclude
+            out = "".join(state.preprocess_file(tmp_dir + "/main.c", local=True))
+            results.append((out.split(), read_files))
+        assert_equal(results[0][1][1:], ["a.h", "b.h", "c.h", "a.h", "b.h", "c.h", "a.h"])
+        assert_equal(results[1][1][1:], ["a.h", "b.h", "c.h", "c.h", "a.h"])
+        assert_equal(results[1][0], ["int", "a;", "int", "b;", "int", "c;", "int", "c;", "int", "a;"])
+        # Without skipping, only the pragma once of b.h is not respected.
+        assert_equal(results[0][0], results[1][0][:6] + ["int", "b;"] + results[1][0][6:])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+_InactiveRegionSamples = [
+    "#if 0\nint a; /* #endif */ int b;\n// #endif\n#endif\nint c;\n",
+    "#if 0\n\tx = '#'; y = \"#endif\";\n  a/#x\n  #  endif\n\tint c;\n#if 0\n/* runaway\n#endif\n",
+    "#ifdef X\nchar* s = \"multi\nline #endif\";\n#else\nint e;\n#endif\n#elif\n",
+    "#if 0\nint a; #define Y 1\n#endif\nint b = Y;\n#if 0\n'unterminated\n#endif\n",
+    "#if 0\n#if 1\nint a;\n#else\n#error x\n#endif\n\t\tfoo/",
+    "#if 0\n\t a\t\tb\n  \t#bad\n#endif\n#endif\n",
+]
+
+
+def test_fast_skip_inactive_regions_same_output():
+    for src in _PreprocessSamples + _InactiveRegionSamples:
+        for chunked in (False, True):
+            print("src:", repr(src), "chunked:", chunked)
+            results = []
+            for fast in (False, True):
+                state = State()
+                state.ChunkedPreprocess = chunked
+                state.FastSkipInactiveRegions = fast
+                out = "".join(state.preprocess_source_code(src))
+                results.append((out, state._errors, sorted((k, str(v), v.defPos) for (k, v) in state.macros.items())))
+            assert_equal(results[1], results[0])
+
+
+def test_cpreprocess_skip_inactive():
+    s = "int a; /* # */ s = \"#\\\"#\"; c = '#'; // #\nx /# y; #endif\n"
+    assert_equal(cpreprocess_skip_inactive(s, 0), s.index("#endif"))
+    assert_equal(cpreprocess_skip_inactive("a /* #endif", 0), 11)
+    assert_equal(cpreprocess_skip_inactive("a \"#endif", 0), 9)
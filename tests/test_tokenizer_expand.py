@@ -0,0 +1,98 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from cparser.cparser import _cpre2_parse_preprocessed
+from helpers_test import assert_equal
+import test_tokenizer
+
+
+def _tokenize(src, token_macro_expansion=True):
+    state = State()
+    state.RegexTokenizer = True
+    state.TokenMacroExpansion = token_macro_expansion
+    tokens = list(_cpre2_parse_preprocessed(state, state.preprocess_source_code_chunks(src)))
+    return tokens, state._errors
+
+
+def _tokens_code(src):
+    tokens, errors = _tokenize(src)
+    assert not errors, errors
+    return " ".join([t.asCCode() for t in tokens])
+
+
+_MacroSamples = [
+    ("#define X 1\n", "int a = X;\n"),
+    ("#define F(a, b) ((a) + (b))\n", "int a = F(1, F(2, 3));\n"),
+    ("#define G(x) x ## 1\n#define H G(\n", "H a);\n"),
+    ("#define E\n", "E int E x E;\n"),
+    ("#define A foo\n", "A+A, A\n"),
+    ("#define F(a, b) a + b\n#define G(x) F(x, 1) + \\\n F(x, 2)\n", "int F(v, w) = G(a) * G(G(b));\n"),
+    ("#define S(x) #x ;\n", "S(1 + \"s\")\n"),
+]
+
+
+def test_expand_same_tokens():
+    for macros, src in _MacroSamples:
+        print("src:", repr(macros + src))
+        assert_equal(_tokenize(macros + src), _tokenize(macros + src, token_macro_expansion=False))
+
+
+def test_expand_self_reference():
+    assert_equal(_tokens_code("#define foo foo + 1\nfoo;\n"), "foo + 1 ;")
+    assert_equal(_tokens_code("#define a b\n#define b a\na b;\n"), "a b ;")
+    assert_equal(_tokens_code("#define f(x) x + f(x)\nf(f(1));\n"), "1 + f ( 1 ) + f ( 1 + f ( 1 ) ) ;")
+
+
+def test_expand_hideset_rescan():
+    # Example from the C standard (6.10.3.4): g(9) is formed by rescanning with
+    # the rest of the input, and its expansion contains f again.
+    assert_equal(_tokens_code("#define f(a) a*g\n#define g(a) f(a)\nf(2)(9);\n"), "2 * 9 * g ;")
+    assert_equal(_tokens_code("#define f(x) x f\nf(1)(2);\n"), "1 f ( 2 ) ;")
+    assert_equal(_tokens_code("#define H G(\n#define G(x) [x]\nH a);\n"), "[ a ] ;")
+
+
+def test_expand_stringify_paste_unexpanded():
+    src = "#define N 2\n#define S(x) #x\n#define XS(x) S(x)\n#define P(a, b) a ## b\nS(N) XS(N) P(N, 1) P(x, N);\n"
+    assert_equal(_tokens_code(src), '"N" "2" N1 xN ;')
+
+
+def test_expand_empty_args():
+    assert_equal(_tokens_code("#define F(x) [x]\n#define G() g\nF() G();\n"), "[ ] g ;")
+    tokens, errors = _tokenize("#define F(x, y) x\nF(1);\n")
+    assert_equal(len(errors), 1)
+
+
+def test_expand_function_like_without_args():
+    assert_equal(_tokens_code("#define F(x) x\nint F; F\n"), "int F ; F")
+
+
+def test_expand_stringify_at_end():
+    # The string-based substitution drops a "#x" at the very end of the right side.
+    assert_equal(_tokens_code("#define S(x) #x\nS(a b)\n"), '"a b"')
+
+
+def test_expand_macro_redefined_in_between():
+    assert_equal(_tokens_code("#define X 1\nX\n#undef X\n#define X 2\nX\n"), "1 2")
+
+
+def test_expand_custom_eval_macro():
+    state = State()
+    state.autoSetupSystemMacros()
+    state.TokenMacroExpansion = True
+    helpers_test.parse("struct __attribute__((packed)) S { char a; int b; };\n", state=state)
+    assert not state._errors, state._errors
+    assert_equal(state.structs["S"].getCType(state)._pack_, 1)
+
+
+def test_tokenizer_tests_with_token_macro_expansion():
+    prev = State.TokenMacroExpansion
+    State.TokenMacroExpansion = True
+    try:
+        for name in sorted(dir(test_tokenizer)):
+            if name.startswith("test_"):
+                print("run:", name)
+                getattr(test_tokenizer, name)()
+    finally:
+        State.TokenMacroExpansion = prev
@@ -0,0 +1,100 @@
+
+from __future__ import print_function
+
+import helpers_test  # side effect: make cparser importable
+from cparser import *
+from cparser.cparser import _Pre2ParseStream, cpre2_parse_chars, cpre2_parse_regex
+from helpers_test import assert_equal
+import test_tokenizer
+
+
+_TokenizeSamples = [
+    "int a; int b = 0x1f + 017 - 1.5e-3f * 6.075;\n",
+    "a->b->*c .* d <<= 2 >>= 1 && e || !f; x++ --y; a::b;\n",
+    'char* s = "a\\x41\\101\\u00e4\\n" "x\\"y"; char c = \'\\\'\'; char z = \'\\0\';\n',
+    "wchar_t* w = L\"wide\\t\"; int c = L'x'; int L = 1;\n",
+    "f(a[1], {2, 3});\n",
+    "int x = 1; \\\n int y;\n",
+    "__FILE__ __LINE__ __func__\n",
+    "int a = 1 \"unfinished\n",
+]
+
+_MacroSamples = [
+    ("#define X 1\n", "int a = X;\n"),
+    ("#define F(a, b) ((a) + (b))\n", "int a = F(1, F(2, 3));\n"),
+    ("#define F(a) a\n", "int F; F (1) F\n(2) F\n"),
+    ("#define G(x) x ## 1\n#define H G(\n", "H a);\n"),
+    ("#define E\n", "E int E x E;\n"),
+    ("#define S(x) #x\n", "char* s = S(a b);\n"),
+]
+
+
+def _tokenize(tokenizer, src, macros=""):
+    state = State()
+    if macros:
+        list(state.preprocess_source_code(macros))
+    tokens = list(tokenizer(state, src))
+    return tokens, state._errors
+
+
+def test_regex_tokenizer_same_tokens():
+    for src in _TokenizeSamples:
+        print("src:", repr(src))
+        assert_equal(_tokenize(cpre2_parse_regex, src), _tokenize(cpre2_parse_chars, src))
+
+
+def test_regex_tokenizer_same_tokens_macros():
+    for macros, src in _MacroSamples:
+        print("src:", repr(macros + src))
+        assert_equal(_tokenize(cpre2_parse_regex, src, macros), _tokenize(cpre2_parse_chars, src, macros))
+
+
+def test_regex_tokenizer_split_input():
+    src = "int abc = 0x1f; a <<= \"s t\";\n"
+    tokens, errors = _tokenize(cpre2_parse_regex, src)
+    assert not errors, errors
+    # Plain char input, and chunks which split tokens.
+    assert_equal(_tokenize(cpre2_parse_regex, iter(src))[0], tokens)
+    for i in range(len(src)):
+        stream = _Pre2ParseStream(iter([src[:i], src[i:]]), chunked=True)
+        assert_equal(list(cpre2_parse_regex(State(), stream)), tokens)
+
+
+def test_regex_tokenizer_repeated_macro():
+    # cpre2_parse_chars keeps A blacklisted until the next token starts.
+    tokens, errors = _tokenize(cpre2_parse_regex, "A+A, A\n", "#define A foo\n")
+    assert not errors, errors
+    assert_equal(tokens, [CIdentifier("foo"), COp("+"), CIdentifier("foo"), COp(","), CIdentifier("foo")])
+
+
+def test_regex_tokenizer_selected_by_state():
+    state = State()
+    state.RegexTokenizer = True
+    helpers_test.parse("#define N 2\nint a[N]; int f(int x) { return x * N; }\n", state=state)
+    assert not state._errors, state._errors
+    assert "a" in state.vars
+    assert "f" in state.funcs
+
+
+def test_tokenizer_tests_with_regex_tokenizer():
+    prev = State.RegexTokenizer
+    State.RegexTokenizer = True
+    try:
+        for name in sorted(dir(test_tokenizer)):
+            if name.startswith("test_"):
+                print("run:", name)
+                getattr(test_tokenizer, name)()
+    finally:
+        State.RegexTokenizer = prev
+
+
+def test_regex_tokenizer_error_position():
+    src = "int a;\nint b = 1 @ 2; int c;\n\tx = \"s\" @\n#define E\nE @\n"
+    results = []
+    for regex in (False, True):
+        state = State()
+        state.RegexTokenizer = regex
+        tokens = list(cpre2_parse(state, state.preprocess_source_code(src)))
+        results.append((tokens, state._errors))
+    assert_equal(results[1], results[0])
+    assert_equal([e.split(": ")[0] for e in results[1][1]], ["<input>:2:10", "<input>:3:12", "<input>:5:2"])
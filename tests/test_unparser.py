@@ -16,5 +16,13 @@ def test_Unparser():
     print()
 
 
+def test_Unparser_py3_nodes():
+    from six import StringIO
+    src = "def f(*args, **kwargs):\n    g(1, *args, **kwargs)\n    raise ValueError(args) from None\n"
+    output = StringIO()
+    Unparser(ast.parse(src), file=output)
+    assert output.getvalue().strip() == src.strip()
+
+
 if __name__ == "__main__":
     main(globals())